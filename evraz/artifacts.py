@@ -0,0 +1,119 @@
+"""
+Версионированные артефакты обученного пайплайна
+
+Артефакт - директория с тремя файлами:
+
+    manifest.json - версия формата, класс модели, колонки признаков и таргетов, время создания
+    schema.json   - схема AllFeaturesExtractor (колонки каждого экстрактора, см. get_schema)
+    model.joblib  - модель (BaselineModel, LightAutoMLModel или CrossValidationResult с моделями фолдов)
+
+Модель сохраняется без сжатия, поэтому numpy массивы внутри неё при загрузке отображаются в память,
+а не копируются. Схема экстракторов восстанавливается через set_schema без обращения к данным,
+так что для предсказания не требуется ни fit экстракторов, ни обучение модели
+"""
+import json
+import os
+import time
+from typing import Optional
+
+import pandas as pd
+
+from evraz.features import AllFeaturesExtractor
+from evraz.timeseries import TimeSeriesStore
+
+# 2: chronom_fe и sip_fe стали PivotFeatures (в схеме есть categories), добавлен lom_fe
+ARTIFACT_VERSION = 2
+
+MANIFEST_FILE = "manifest.json"
+SCHEMA_FILE = "schema.json"
+MODEL_FILE = "model.joblib"
+
+
+class Artifact:
+    """
+    Загруженный артефакт: манифест, схема экстракторов и модель
+    """
+    def __init__(self, manifest: dict, schema: dict, model):
+        self.manifest = manifest
+        self.schema = schema
+        self.model = model
+
+    @property
+    def feature_columns(self):
+        return self.manifest['feature_columns']
+
+    def build_extractor(self, conn, **kwargs) -> AllFeaturesExtractor:
+        """
+        AllFeaturesExtractor со схемой из артефакта, kwargs передаются в конструктор.
+
+        Если модель обучалась на признаках рядов, а хранилище не передано, используется TimeSeriesStore по умолчанию
+        """
+        if 'ts_fe' in self.schema:
+            kwargs.setdefault('timeseries', TimeSeriesStore())
+        return AllFeaturesExtractor(conn, **kwargs).set_schema(self.schema)
+
+    def predict(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Предсказание по датафрейму признаков, результат - NPLV и таргеты
+        """
+        predictions = self.model.predict(df[self.feature_columns])
+        return (
+            df[['NPLV']]
+            .reset_index(drop=True)
+            .assign(**{target: predictions[target].to_numpy() for target in self.manifest['target_columns']})
+        )
+
+
+def save_artifact(path: str, model, extractor: AllFeaturesExtractor, metadata: Optional[dict] = None) -> str:
+    """
+    Сохранение модели и схемы экстракторов в директорию path
+    """
+    import joblib
+
+    os.makedirs(path, exist_ok=True)
+
+    manifest = {
+        'version': ARTIFACT_VERSION,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'model_class': f"{type(model).__module__}.{type(model).__name__}",
+        'feature_columns': list(extractor.feature_columns),
+        'target_columns': list(extractor.target_columns),
+        'metadata': metadata or {},
+    }
+
+    joblib.dump(model, os.path.join(path, MODEL_FILE))
+    with open(os.path.join(path, SCHEMA_FILE), 'w') as f:
+        json.dump(extractor.get_schema(), f, ensure_ascii=False, indent=2)
+    # манифест пишется последним: директория без манифеста считается недописанной
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    print(f"Saved artifact {manifest['model_class']} to {path}")
+    return path
+
+
+def load_artifact(path: str, mmap_mode: Optional[str] = 'r') -> Artifact:
+    """
+    Загрузка артефакта, сохранённого save_artifact.
+
+    mmap_mode передаётся в joblib.load: массивы модели отображаются в память вместо чтения в неё
+    """
+    import joblib
+
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(f"{path} is not an artifact: {MANIFEST_FILE} is missing")
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest['version'] != ARTIFACT_VERSION:
+        raise ValueError(f"Artifact version {manifest['version']} is not supported, expected {ARTIFACT_VERSION}")
+
+    with open(os.path.join(path, SCHEMA_FILE)) as f:
+        schema = json.load(f)
+
+    start = time.time()
+    model = joblib.load(os.path.join(path, MODEL_FILE), mmap_mode=mmap_mode)
+    print(f"Loaded {manifest['model_class']} from {path} in {time.time() - start:.2f}s")
+
+    return Artifact(manifest, schema, model)
@@ -0,0 +1,270 @@
+"""
+Бенчмарки пайплайна на синтетических данных
+
+Для каждого экстрактора меряются:
+
+    query_seconds    - выполнение запроса в бд без передачи результата (select count(*) from (запрос))
+    fetch_seconds    - get_df целиком: запрос, передача и сборка датафрейма
+    transfer_seconds - fetch_seconds - query_seconds
+    merge_seconds    - присоединение признаков к таргету (pd.merge по NPLV)
+    peak_mb          - пик памяти python во время get_df (tracemalloc, отдельным прогоном)
+
+и время fit/predict модели. Результаты пишутся в json и csv вместе с коммитом, числом плавок
+и частотой газа, так что прогоны на разных коммитах можно сравнить (команда compare).
+
+Пример запуска:
+
+    PYTHONPATH=. python -m evraz.benchmark run --heats 2000 --gas-rate 1 --out ../data/benchmarks
+    PYTHONPATH=. python -m evraz.benchmark compare ../data/benchmarks/a.json ../data/benchmarks/b.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from evraz.features import AllFeaturesExtractor, DBFeatureExtractor
+from evraz.settings import Connection, DuckDBConnection
+from evraz.synthetic import generate
+
+METRICS = ['query_seconds', 'fetch_seconds', 'transfer_seconds', 'merge_seconds', 'peak_mb', 'rows', 'columns',
+           'frame_mb', 'fit_seconds', 'predict_seconds']
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def timed(func: Callable[[], object]) -> Tuple[object, float]:
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def peak_memory(func: Callable[[], object]) -> float:
+    """
+    Пик памяти python в Мб, выделенной во время func
+    """
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def query_seconds(conn, extractor: DBFeatureExtractor, mode: str) -> Optional[float]:
+    """
+    Время выполнения запроса экстрактора без передачи строк; None для экстракторов, считающих признаки в python
+    """
+    if not extractor.fusable:
+        return None
+    query = f"select count(*) from ({extractor.render_query(mode)}) benchmark"
+    _, seconds = timed(lambda: conn.read_query(query))
+    return seconds
+
+
+def benchmark_extractors(conn, fe: AllFeaturesExtractor, mode: str = 'train', memory: bool = True) -> List[dict]:
+    """
+    Замеры запроса, передачи, слияния и памяти каждого экстрактора и общего fused запроса
+    """
+    target, target_seconds = timed(lambda: fe.get_df(mode))
+    results = [{'stage': 'target', 'name': 'target', 'fetch_seconds': target_seconds, 'rows': len(target)}]
+
+    for name, extractor in fe.feature_extractors.items():
+        print(f"Benchmarking {name}")
+        df, fetch = timed(lambda: extractor.transform(None, mode=mode))
+        query = query_seconds(conn, extractor, mode)
+        _, merge = timed(lambda: pd.merge(target, df, how='left', on='NPLV'))
+
+        results.append({
+            'stage': 'extractor',
+            'name': name,
+            'query_seconds': query,
+            'fetch_seconds': fetch,
+            'transfer_seconds': fetch - query if query is not None else None,
+            'merge_seconds': merge,
+            'peak_mb': peak_memory(lambda: extractor.transform(None, mode=mode)) if memory else None,
+            'rows': len(df),
+            'columns': df.shape[1],
+            'frame_mb': df.memory_usage(deep=True).sum() / 2 ** 20,
+        })
+
+    fused, fetch = timed(lambda: fe.get_fused_df(mode))
+    query = f"select count(*) from ({fe.compile_query(mode)}) benchmark"
+    _, query = timed(lambda: conn.read_query(query))
+    results.append({
+        'stage': 'extractor',
+        'name': 'fused',
+        'query_seconds': query,
+        'fetch_seconds': fetch,
+        'transfer_seconds': fetch - query,
+        'peak_mb': peak_memory(lambda: fe.get_fused_df(mode)) if memory else None,
+        'rows': len(fused),
+        'columns': fused.shape[1],
+        'frame_mb': fused.memory_usage(deep=True).sum() / 2 ** 20,
+    })
+
+    return results
+
+
+def benchmark_model(model, X: pd.DataFrame, y: pd.DataFrame, X_test: pd.DataFrame, memory: bool = True) -> dict:
+    """
+    Время обучения и предсказания модели; пик памяти меряется по обучению
+    """
+    print(f"Benchmarking {type(model).__name__}")
+    _, fit = timed(lambda: model.fit(X, y))
+    _, predict = timed(lambda: model.predict(X_test))
+
+    return {
+        'stage': 'model',
+        'name': type(model).__name__,
+        'fit_seconds': fit,
+        'predict_seconds': predict,
+        'peak_mb': peak_memory(lambda: model.fit(X, y)) if memory else None,
+        'rows': len(X),
+        'columns': X.shape[1],
+    }
+
+
+def default_model(X: pd.DataFrame):
+    from evraz.model import BaselineModel
+
+    cat_features = list(X.select_dtypes(include=['category', 'object']).columns)
+    return BaselineModel({'verbose': 0, 'cat_features': cat_features})
+
+
+def run(conn,
+        meta: dict,
+        out_dir: str,
+        memory: bool = True,
+        model_factory: Optional[Callable[[pd.DataFrame], object]] = default_model) -> str:
+    """
+    Полный прогон: схема экстракторов, замеры экстракторов и модели, запись результатов в out_dir
+    """
+    fe = AllFeaturesExtractor(conn).fit()
+    results = benchmark_extractors(conn, fe, 'train', memory)
+
+    if model_factory is not None:
+        train = fe.transform(None, mode='train')
+        test = fe.transform(None, mode='test')
+        X = train[fe.feature_columns]
+        results.append(benchmark_model(
+            model_factory(X), X, train[fe.target_columns], test[fe.feature_columns], memory))
+
+    return save_results(results, meta, out_dir)
+
+
+def save_results(results: List[dict], meta: dict, out_dir: str) -> str:
+    """
+    Запись результатов в {out_dir}/benchmark_{коммит}_{время}.json и .csv, возвращает путь к json
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    meta = dict(meta, commit=git_commit(), created_at=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    path = os.path.join(out_dir, f"benchmark_{meta['commit']}_{time.strftime('%Y%m%d_%H%M%S')}")
+
+    with open(f"{path}.json", 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, ensure_ascii=False, indent=2)
+
+    df = pd.DataFrame(results).reindex(columns=['stage', 'name'] + METRICS)
+    df.assign(**meta).to_csv(f"{path}.csv", index=False)
+    print(df.to_string(index=False))
+
+    return f"{path}.json"
+
+
+def load_results(path: str) -> Tuple[dict, pd.DataFrame]:
+    with open(path) as f:
+        data = json.load(f)
+    return data['meta'], pd.DataFrame(data['results']).reindex(columns=['stage', 'name'] + METRICS)
+
+
+def compare(left_path: str, right_path: str, metrics: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Сравнение двух прогонов: значения метрик и отношение right / left для каждого этапа
+    """
+    metrics = metrics or ['query_seconds', 'fetch_seconds', 'merge_seconds', 'peak_mb', 'fit_seconds',
+                          'predict_seconds']
+    left_meta, left = load_results(left_path)
+    right_meta, right = load_results(right_path)
+
+    df = pd.merge(left, right, on=['stage', 'name'], how='outer', suffixes=('_left', '_right'))
+    columns = ['stage', 'name']
+    for metric in metrics:
+        df[f"{metric}_ratio"] = df[f"{metric}_right"] / df[f"{metric}_left"]
+        columns.extend([f"{metric}_left", f"{metric}_right", f"{metric}_ratio"])
+
+    print(f"left: {left_meta['commit']} ({left_meta['heats']} heats), right: {right_meta['commit']} "
+          f"({right_meta['heats']} heats)")
+    return df[columns].dropna(axis=1, how='all')
+
+
+def prepare_connection(args, data_dir: str):
+    if args.backend == "duckdb":
+        return DuckDBConnection(data_dir).open_conn().ping()
+
+    from evraz.loader import load_dir
+    from evraz.schema import create
+
+    conn = Connection(db_name=args.db_name, host=args.host, port=args.port).open_conn().ping()
+    create(conn)
+    load_dir(conn, data_dir, truncate=True)
+    return conn
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark extractors and models on synthetic data")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--heats", type=int, default=1000)
+    run_parser.add_argument("--gas-rate", type=float, default=1.0)
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--data-dir", help="reuse generated data instead of a temporary directory")
+    run_parser.add_argument("--out", default="../data/benchmarks")
+    run_parser.add_argument("--backend", choices=["duckdb", "postgres"], default="duckdb")
+    run_parser.add_argument("--db-name", default="bench")
+    run_parser.add_argument("--host", default="localhost")
+    run_parser.add_argument("--port", type=int, default=5432)
+    run_parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc passes")
+    run_parser.add_argument("--no-model", action="store_true", help="skip model fit/predict")
+
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("left")
+    compare_parser.add_argument("right")
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        print(compare(args.left, args.right).to_string(index=False))
+        return
+
+    with tempfile.TemporaryDirectory(prefix="evraz_synthetic_") as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        if not os.path.exists(os.path.join(data_dir, "target_train.csv")):
+            generate(data_dir, n_heats=args.heats, gas_rate=args.gas_rate, seed=args.seed)
+
+        conn = prepare_connection(args, data_dir)
+        meta: Dict[str, object] = {
+            'heats': args.heats,
+            'gas_rate': args.gas_rate,
+            'seed': args.seed,
+            'backend': args.backend,
+        }
+        run(conn, meta, args.out, memory=not args.no_memory, model_factory=None if args.no_model else default_model)
+
+
+if __name__ == "__main__":
+    main()
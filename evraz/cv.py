@@ -0,0 +1,260 @@
+"""
+Параллельная кросс-валидация с общим бюджетом ядер и памяти
+
+Каждая пара (фолд, таргет) обучается отдельной задачей в своём процессе.
+Бюджет cpu и памяти делится поровну между одновременно работающими задачами,
+модель получает свою долю через with_resources, а потоки blas/openmp в процессе
+ограничиваются той же долей, чтобы суммарно не занимать больше ядер, чем выделено.
+
+Оценки совпадают с последовательным cross_val_score: те же разбиения, те же
+параметры моделей и та же метрика, меняется только число потоков каждой модели.
+cross_validate_parallel дополнительно сохраняет out-of-fold предсказания и модели фолдов
+(CrossValidationResult), которыми можно предсказать тест без финального обучения на всех данных.
+"""
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator
+
+from evraz.metrics import metric
+
+# переменные окружения, которыми библиотеки ограничивают число потоков при импорте
+THREAD_ENV_VARS = (
+    'OMP_NUM_THREADS',
+    'OPENBLAS_NUM_THREADS',
+    'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS',
+    'NUMEXPR_NUM_THREADS',
+)
+
+
+@contextmanager
+def thread_env(cpu_limit: int):
+    """
+    Переменные THREAD_ENV_VARS в окружении родительского процесса на время запуска процессов пула.
+
+    Процессы запускаются через spawn и наследуют окружение родителя, поэтому библиотеки видят ограничение
+    уже при импорте (модули задачи импортируются до initializer, так что задать их в самом процессе поздно).
+    После выхода из блока окружение родителя восстанавливается
+    """
+    saved = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    os.environ.update({name: str(cpu_limit) for name in THREAD_ENV_VARS})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def _fit_predict(estimator: BaseEstimator,
+                 X_train: pd.DataFrame,
+                 y_train: pd.DataFrame,
+                 X_test: pd.DataFrame,
+                 target: Optional[str],
+                 cpu_limit: int,
+                 keep_model: bool = False) -> Tuple[Dict[str, np.ndarray], Optional[BaseEstimator], float]:
+    """
+    Обучение и предсказание одного таргета, или всех сразу, если target не задан.
+
+    При keep_model обученная модель возвращается в родительский процесс
+    """
+    from threadpoolctl import threadpool_limits
+
+    start = time.time()
+    with threadpool_limits(limits=cpu_limit):
+        if target is None:
+            predictions = estimator.fit(X_train, y_train).predict(X_test)
+            predictions = {column: predictions[column].to_numpy() for column in y_train.columns}
+        else:
+            estimator.fit_target(X_train, y_train, target)
+            predictions = {target: np.asarray(estimator.predict_target(X_test, target))}
+
+    return predictions, estimator if keep_model else None, time.time() - start
+
+
+class CrossValidationResult:
+    """
+    Результат кросс-валидации: out-of-fold предсказания, разбиения и (опционально) модели фолдов.
+
+    Метрика пересчитывается по сохранённым предсказаниям без переобучения,
+    а тестовая выборка предсказывается усреднением моделей фолдов вместо финального обучения на всех данных
+    """
+    def __init__(self,
+                 y: pd.DataFrame,
+                 oof: pd.DataFrame,
+                 folds: List[np.ndarray],
+                 models: Optional[Dict[Tuple[int, str], BaseEstimator]] = None):
+        self.y = y
+        self.oof = oof
+        # позиции тестовых строк каждого фолда
+        self.folds = folds
+        # (фолд, таргет) -> модель, multi-target модель записана под каждым таргетом
+        self.models = models or {}
+
+    @property
+    def targets(self) -> List[str]:
+        return list(self.y.columns)
+
+    def score(self, scoring: Callable[[pd.DataFrame, pd.DataFrame], float] = metric) -> float:
+        """
+        Метрика по всем out-of-fold предсказаниям сразу
+        """
+        return scoring(self.y, self.oof)
+
+    def fold_scores(self, scoring: Callable[[pd.DataFrame, pd.DataFrame], float] = metric) -> np.ndarray:
+        return np.array([
+            scoring(self.y.iloc[test_index], self.oof.iloc[test_index])
+            for test_index in self.folds
+        ])
+
+    def predict(self, X: pd.DataFrame) -> pd.DataFrame:
+        """
+        Предсказание средним по моделям фолдов
+        """
+        if not self.models:
+            raise ValueError("Fold models were not kept, run cross validation with keep_models=True")
+
+        return pd.DataFrame({
+            target: np.mean([
+                self.models[(fold, target)].predict_target(X, target) for fold in range(len(self.folds))
+            ], axis=0)
+            for target in self.targets
+        })
+
+    def save(self, path: str, models: bool = True):
+        """
+        Сохранение в директорию path: oof.csv с истинными и предсказанными значениями и номером фолда,
+        models.joblib с моделями фолдов
+        """
+        import joblib
+
+        os.makedirs(path, exist_ok=True)
+        fold = np.empty(len(self.y), dtype=int)
+        for i, test_index in enumerate(self.folds):
+            fold[test_index] = i
+
+        (
+            self.y
+            .join(self.oof.set_axis(self.y.index, axis=0), rsuffix='_pred')
+            .assign(fold=fold)
+            .to_csv(os.path.join(path, "oof.csv"), index=False)
+        )
+        if models and self.models:
+            joblib.dump(self.models, os.path.join(path, "models.joblib"))
+
+        return self
+
+    @classmethod
+    def load(cls, path: str):
+        import joblib
+
+        df = pd.read_csv(os.path.join(path, "oof.csv"))
+        targets = [column[:-len('_pred')] for column in df.columns if column.endswith('_pred')]
+        folds = [np.flatnonzero(df['fold'].to_numpy() == i) for i in range(df['fold'].max() + 1)]
+        oof = df[[f"{target}_pred" for target in targets]].set_axis(targets, axis=1)
+
+        models_path = os.path.join(path, "models.joblib")
+        models = joblib.load(models_path) if os.path.exists(models_path) else None
+
+        return cls(df[targets], oof, folds, models)
+
+
+def split_budget(n_tasks: int,
+                 cpu_budget: Optional[int] = None,
+                 memory_budget: Optional[float] = None,
+                 n_jobs: Optional[int] = None) -> Tuple[int, int, Optional[float]]:
+    """
+    Число одновременных задач, ядер и памяти (Гб) на задачу
+    """
+    cpu_budget = cpu_budget or os.cpu_count() or 1
+    n_jobs = min(n_jobs or n_tasks, n_tasks, cpu_budget)
+    cpu_limit = max(1, cpu_budget // n_jobs)
+    memory_limit = memory_budget / n_jobs if memory_budget is not None else None
+
+    return n_jobs, cpu_limit, memory_limit
+
+
+def cross_validate_parallel(estimator: BaseEstimator,
+                            X: pd.DataFrame,
+                            y: pd.DataFrame,
+                            cv,
+                            cpu_budget: Optional[int] = None,
+                            memory_budget: Optional[float] = None,
+                            n_jobs: Optional[int] = None,
+                            keep_models: bool = False) -> CrossValidationResult:
+    """
+    Кросс-валидация, в которой фолды и таргеты обучаются параллельно.
+
+    estimator должен реализовывать fit_target, predict_target и with_resources (см. evraz.model),
+    модели с multi_target=True обучаются одной задачей на фолд.
+    cpu_budget - общее число ядер (по умолчанию все), memory_budget - общий объём памяти в Гб.
+    keep_models - вернуть обученные модели фолдов, чтобы предсказывать ими тест без финального обучения
+    """
+    targets = list(y.columns)
+    folds = list(cv.split(X, y))
+    # multi-target модель обучается на все таргеты одной задачей
+    task_targets = [None] if getattr(estimator, 'multi_target', False) else targets
+    tasks = [(fold, target) for fold in range(len(folds)) for target in task_targets]
+
+    n_jobs, cpu_limit, memory_limit = split_budget(len(tasks), cpu_budget, memory_budget, n_jobs)
+    print(f"Running {len(tasks)} cv tasks, {n_jobs} at a time with {cpu_limit} cpu "
+          f"and {memory_limit if memory_limit is not None else 'unlimited'} Gb each")
+
+    start = time.time()
+    executor = ProcessPoolExecutor(max_workers=n_jobs, mp_context=multiprocessing.get_context('spawn'))
+    # процессы пула запускаются по мере отправки задач, поэтому окружение задаётся на весь блок
+    with thread_env(cpu_limit), executor:
+        futures = {}
+        for fold, target in tasks:
+            train_index, test_index = folds[fold]
+            futures[(fold, target)] = executor.submit(
+                _fit_predict,
+                estimator.with_resources(cpu_limit, memory_limit),
+                X.iloc[train_index],
+                y.iloc[train_index],
+                X.iloc[test_index],
+                target,
+                cpu_limit,
+                keep_models
+            )
+
+        oof = pd.DataFrame(np.nan, index=range(len(y)), columns=targets)
+        models = {}
+        for (fold, target), future in futures.items():
+            fold_predictions, model, elapsed = future.result()
+            _, test_index = folds[fold]
+            for column, values in fold_predictions.items():
+                oof.loc[test_index, column] = values
+                if model is not None:
+                    models[(fold, column)] = model
+            print(f"Fold {fold}, target {target or 'all'}: fitted in {elapsed:.1f}s")
+
+    print(f"Cross validation finished in {time.time() - start:.1f}s")
+
+    return CrossValidationResult(y, oof, [test_index for _, test_index in folds], models)
+
+
+def cross_val_score_parallel(estimator: BaseEstimator,
+                             X: pd.DataFrame,
+                             y: pd.DataFrame,
+                             cv,
+                             scoring: Callable[[pd.DataFrame, pd.DataFrame], float] = metric,
+                             cpu_budget: Optional[int] = None,
+                             memory_budget: Optional[float] = None,
+                             n_jobs: Optional[int] = None) -> np.ndarray:
+    """
+    Аналог sklearn.model_selection.cross_val_score поверх cross_validate_parallel.
+
+    scoring принимает истинные и предсказанные значения всех таргетов, как evraz.metrics.metric
+    """
+    result = cross_validate_parallel(estimator, X, y, cv, cpu_budget, memory_budget, n_jobs)
+    return result.fold_scores(scoring)
@@ -1,7 +1,281 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from typing import Callable, Dict, List, Optional
+
 import pandas as pd
+from pandas.api.types import (is_categorical_dtype, is_datetime64_any_dtype, is_float_dtype, is_integer_dtype,
+                              is_object_dtype)
 from sklearn.base import BaseEstimator, TransformerMixin
 
-from evraz.settings import Connection
+from slugify import slugify
+
+from evraz.intervals import feature_names, operation_aggregates, unique_slugs
+from evraz.settings import Connection, escape, quote_ident
+from evraz.timeseries import TimeSeriesStore, series_feature_names, timeseries_features
+from evraz.tracing import get_tracer, query_attrs
+
+
+class FeatureCache:
+    """
+    Дисковый кэш результатов извлечения признаков.
+
+    Каждый результат хранится в отдельном колоночном файле (parquet или feather)
+    с именем {extractor}_{mode}_{key}. Ключ - хэш от текста запроса и дешёвого
+    отпечатка исходных таблиц (количество строк и максимальный NPLV), поэтому при
+    изменении шаблона запроса или данных кэш инвалидируется автоматически,
+    а устаревшие файлы того же экстрактора и режима удаляются.
+    """
+    fingerprint_template = """select '{table}' "table", count(*) "rows", max("NPLV") "max_nplv" from {table}"""
+
+    def __init__(self, cache_dir: str = "../data/cache", fmt: str = "parquet"):
+        if fmt not in ('parquet', 'feather'):
+            raise TypeError(f"fmt must be 'parquet' or 'feather', got {fmt}")
+
+        self.cache_dir = cache_dir
+        self.fmt = fmt
+
+    def fingerprint(self, conn: Connection, tables: List[str]) -> str:
+        """
+        Отпечаток исходных таблиц: количество строк и максимальный NPLV
+        """
+        query = "\nunion all\n".join(self.fingerprint_template.format(table=table) for table in tables)
+        df = conn.read_query(query)
+        return df.sort_values("table").to_csv(index=False)
+
+    def key(self, conn: Connection, query: str, tables: List[str]) -> str:
+        digest = hashlib.sha1(query.encode())
+        digest.update(self.fingerprint(conn, tables).encode())
+        return digest.hexdigest()[:16]
+
+    def path(self, name: str, mode: str, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{name}_{mode}_{key}.{self.fmt}")
+
+    def load(self, path: str) -> pd.DataFrame:
+        if self.fmt == 'parquet':
+            return pd.read_parquet(path)
+        return pd.read_feather(path)
+
+    def save(self, df: pd.DataFrame, path: str):
+        duplicated = df.columns[df.columns.duplicated()].unique().tolist()
+        if duplicated:
+            raise ValueError(f"Can't cache {os.path.basename(path)}: duplicated columns {duplicated}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # пишем во временный файл, чтобы прерванный запуск не оставил битую запись
+        tmp_path = path + ".tmp"
+        if self.fmt == 'parquet':
+            df.to_parquet(tmp_path, index=False)
+        else:
+            df.reset_index(drop=True).to_feather(tmp_path)
+        os.replace(tmp_path, path)
+
+    def evict(self, name: str, mode: str, keep: Optional[str] = None):
+        """
+        Удаление устаревших записей экстрактора name для режима mode
+        """
+        for path in glob(os.path.join(self.cache_dir, f"{name}_{mode}_*.{self.fmt}")):
+            if path != keep:
+                os.remove(path)
+
+    def get_or_compute(self,
+                       conn: Connection,
+                       name: str,
+                       mode: str,
+                       query: str,
+                       tables: List[str],
+                       compute: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """
+        Возвращает закэшированный датафрейм или вычисляет и сохраняет его
+        """
+        path = self.path(name, mode, self.key(conn, query, tables))
+        if os.path.exists(path):
+            print(f"Loading {name} features from cache {path}")
+            return self.load(path)
+
+        df = compute()
+        self.save(df, path)
+        self.evict(name, mode, keep=path)
+
+        return df
+
+
+class FeatureStore:
+    """
+    Материализованные таблицы признаков в бд с инкрементальным обновлением.
+
+    Результат экстрактора хранится в таблице features_{экстрактор}_{mode} с ключом плавки,
+    колонками output_columns и отпечатком плавки - числом строк каждой исходной таблицы с этим NPLV.
+    refresh считает признаки только для плавок таргета, которых ещё нет в таблице или отпечаток которых
+    изменился (дописались строки газа, операций и т.д.), и заменяет их строки одной транзакцией.
+
+    Плавки добавляются по возрастанию NPLV, поэтому строки могут дописываться только последней сохранённой плавке
+    и новым: отпечатки считаются только для NPLV не меньше максимального NPLV таблицы (водяной знак),
+    и стоимость обновления пропорциональна числу новых плавок, а не всей истории.
+    Подсчёт строк по NPLV идёт по индексам (evraz.schema.INDEXES), сами исходные данные не читаются.
+    Исправления старых плавок и их удаление из таргета находит полный пересчёт отпечатков (refresh(full=True)),
+    при заданных heats проверяются ровно эти плавки.
+
+    При смене запроса экстрактора (или списка операций GasOperationFeatures) таблица пересчитывается целиком:
+    хэш запроса хранится в таблице feature_store_meta.
+    С auto_refresh=False transform только читает таблицы, а обновление запускается явно
+    (AllFeaturesExtractor.refresh), например по расписанию
+    """
+    meta_table = 'feature_store_meta'
+    fingerprint_column = 'fingerprint'
+    counts_template = 'select "NPLV", \'{table}\' "table", count(*) "rows" from {table} {cond} group by "NPLV"'
+
+    def __init__(self, conn: Connection, auto_refresh: bool = True):
+        self.conn = conn
+        self.auto_refresh = auto_refresh
+        # запись в бд из потоков AllFeaturesExtractor.map_extractors идёт по очереди
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def table_name(extractor: 'DBFeatureExtractor', mode: str) -> str:
+        return f"features_{type(extractor).__name__.lower()}_{mode}"
+
+    @staticmethod
+    def query_hash(extractor: 'DBFeatureExtractor', mode: str) -> str:
+        return hashlib.sha1(extractor.render_query(mode).encode()).hexdigest()[:16]
+
+    def select_query(self, extractor: 'DBFeatureExtractor', mode: str) -> str:
+        """
+        Запрос к материализованной таблице с теми же колонками, что и у запроса экстрактора
+        """
+        columns = ", ".join(f'"{column}"' for column in [extractor.key_column] + extractor.output_columns)
+        return f'select {columns} from "{self.table_name(extractor, mode)}"'
+
+    @staticmethod
+    def heats_condition(key_column: str, heats: Optional[List[int]] = None, since: Optional[int] = None) -> str:
+        """
+        Условие на плавки heats и/или на NPLV не меньше since
+        """
+        conditions = []
+        if heats is not None:
+            conditions.append(f'"{key_column}" in ({", ".join(str(int(nplv)) for nplv in heats) or "null"})')
+        if since is not None:
+            conditions.append(f'"{key_column}" >= {int(since)}')
+        return f"where {' and '.join(conditions)}" if conditions else ""
+
+    def fingerprints(self, extractor: 'DBFeatureExtractor', mode: str,
+                     heats: Optional[List[int]] = None, since: Optional[int] = None) -> pd.Series:
+        """
+        Отпечатки плавок таргета (только плавок heats и/или с NPLV не меньше since):
+        NPLV -> число строк каждой исходной таблицы
+        """
+        cond = self.heats_condition("NPLV", heats, since)
+        tables = extractor.source_tables(mode)
+        query = "\nunion all\n".join(self.counts_template.format(table=table, cond=cond) for table in tables)
+        counts = self.conn.read_query(query, compact=False)
+
+        target = sorted(counts.loc[counts["table"] == extractor.get_target(mode), "NPLV"].astype(int))
+        counts = (
+            counts[counts["NPLV"].isin(target)]
+            .pivot(index="NPLV", columns="table", values="rows")
+            .reindex(index=target, columns=tables)
+            .fillna(0)
+            .astype(int)
+        )
+        return pd.Series(
+            ["|".join(f"{table}:{n}" for table, n in zip(tables, row)) for row in counts.itertuples(index=False)],
+            index=counts.index, dtype=object
+        )
+
+    def stored_fingerprints(self, table: str, key_column: str,
+                            heats: Optional[List[int]] = None, since: Optional[int] = None) -> pd.Series:
+        if not self.conn.table_exists(table):
+            return pd.Series(dtype=object)
+        query = (f'select "{key_column}", "{self.fingerprint_column}" from "{table}" '
+                 f'{self.heats_condition(key_column, heats, since)}')
+        df = self.conn.read_query(query, compact=False)
+        return df.set_index(df[key_column].astype(int))[self.fingerprint_column]
+
+    def watermark(self, table: str, key_column: str) -> Optional[int]:
+        """
+        Максимальный NPLV материализованной таблицы (по индексу ключа), None - таблица пуста или её нет
+        """
+        if not self.conn.table_exists(table):
+            return None
+        df = self.conn.read_query(f'select max("{key_column}") "watermark" from "{table}"', compact=False)
+        value = df["watermark"].iloc[0]
+        return None if pd.isna(value) else int(value)
+
+    def stored_query_hash(self, table: str) -> Optional[str]:
+        if not self.conn.table_exists(self.meta_table):
+            return None
+        df = self.conn.read_query(
+            f"select query_hash from {self.meta_table} where table_name = '{table}'", compact=False)
+        return df["query_hash"].iloc[0] if len(df) else None
+
+    def refresh(self,
+                extractor: 'DBFeatureExtractor',
+                mode: str,
+                heats: Optional[List[int]] = None,
+                full: bool = False) -> int:
+        """
+        Пересчёт новых и изменившихся плавок начиная с водяного знака (при заданных heats - только среди них,
+        при full - по всей истории), удаление плавок, которых больше нет в таргете.
+        Возвращает число пересчитанных плавок
+        """
+        name = type(extractor).__name__
+        table = self.table_name(extractor, mode)
+        key_column = extractor.key_column
+        query_hash = self.query_hash(extractor, mode)
+
+        with get_tracer().span("refresh", kind="store", extractor=name, mode=mode) as span:
+            if self.stored_query_hash(table) != query_hash and self.conn.table_exists(table):
+                print(f"Query of {name} has changed, dropping {table}")
+                self.conn.execute(f'drop table "{table}"')
+
+            since = None if full or heats is not None else self.watermark(table, key_column)
+            stored = self.stored_fingerprints(table, key_column, heats, since)
+            current = self.fingerprints(extractor, mode, heats, since)
+            stale = current.index[current.ne(stored.reindex(current.index))].tolist()
+            removed = stored.index.difference(current.index).tolist()
+            span.attrs.update(since=since, stale=len(stale), removed=len(removed))
+            if not stale and not removed:
+                return 0
+
+            df = extractor.get_df(mode, heats=stale) if stale else None
+            if df is not None:
+                # плавки без строк в результате запроса тоже записываются, чтобы не пересчитывать их каждый раз
+                df = pd.merge(pd.DataFrame({key_column: stale}), df[[key_column] + extractor.output_columns],
+                              how='left', on=key_column)
+                df[self.fingerprint_column] = current.loc[stale].to_numpy()
+                # категории сохраняются строками: новые значения не должны ломать тип колонки
+                df = df.astype({
+                    column: object for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)
+                })
+
+            if df is None:
+                df = pd.DataFrame(columns=[key_column] + extractor.output_columns + [self.fingerprint_column])
+
+            with self.lock:
+                self.conn.replace_rows(table, df, key_column, stale + removed)
+                self.conn.replace_rows(
+                    self.meta_table,
+                    pd.DataFrame({'table_name': [table], 'query_hash': [query_hash],
+                                  'refreshed_at': [pd.Timestamp.now()]}),
+                    'table_name', [table]
+                )
+
+        print(f"Refreshed {len(stale)} heats of {name} in {table}, removed {len(removed)}")
+        return len(stale)
+
+    def read(self, extractor: 'DBFeatureExtractor', mode: str, heats: Optional[List[int]] = None) -> pd.DataFrame:
+        """
+        Признаки из материализованной таблицы; при auto_refresh таблица сначала обновляется
+        """
+        if self.auto_refresh:
+            self.refresh(extractor, mode, heats)
+        query = self.select_query(extractor, mode)
+        if heats is not None:
+            query = extractor.restrict_query(query, heats)
+        return extractor.read_query(query)
 
 
 class DBFeatureExtractor(TransformerMixin, BaseEstimator):
@@ -11,9 +285,27 @@ class DBFeatureExtractor(TransformerMixin, BaseEstimator):
     Для добавления новых признаков требуется всего определить поле query_template
     """
     query_template = ""
+    # колонка с номером плавки в результате запроса
+    key_column = 'NPLV'
+    # можно ли встроить запрос в общий запрос AllFeaturesExtractor (признаки считаются в sql)
+    fusable = True
+    # атрибуты, которые определяет fit и которые сохраняются в схему (get_schema/set_schema)
+    schema_attributes = ('time_columns', 'float_columns', 'int_columns', 'cat_columns', 'feature_columns',
+                         'output_columns', 'keep_columns')
+    # значения атрибутов, которых нет в схемах, сохранённых до их появления
+    schema_defaults = {'keep_columns': None}
 
-    def __init__(self, conn: Connection):
+    def __init__(self,
+                 conn: Connection,
+                 cache: Optional[FeatureCache] = None,
+                 timeout: Optional[float] = None,
+                 store: Optional[FeatureStore] = None):
         self.conn = conn
+        self.cache = cache
+        # материализованные таблицы признаков в бд, см. FeatureStore
+        self.store = store
+        # ограничение времени выполнения запроса в секундах
+        self.timeout = timeout
 
         self.id_column = 'NPLV'
         self.target_columns = ['TST', 'C']
@@ -22,47 +314,228 @@ class DBFeatureExtractor(TransformerMixin, BaseEstimator):
         self.cat_columns = None
         self.feature_columns = None
         self.int_columns = None
+        # все колонки результата, кроме ключей и таргетов, в порядке запроса
+        self.output_columns = None
+        # колонки, оставленные отбором признаков (prune, evraz.pruning), None - все
+        self.keep_columns = None
 
-    def get_df(self, mode: str, cond: str = "") -> pd.DataFrame:
-        """
-        Метод для получения датафрейма из query_template
-        """
+    @staticmethod
+    def get_target(mode: str) -> str:
         if mode == 'train':
-            target = 'target_train'
+            return 'target_train'
         elif mode == 'test':
-            target = 'sample_submission'
-        else:
-            raise TypeError(f"mode must be 'train' or 'test', got {mode}")
+            return 'sample_submission'
+        raise TypeError(f"mode must be 'train' or 'test', got {mode}")
 
+    def render_query(self, mode: str, cond: str = "") -> str:
+        """
+        Подстановка режима и условия в query_template, после prune - только оставленные колонки
+        """
         query = self.query_template.format(
-            target=target,
+            target=self.get_target(mode),
             mode=mode,
             cond=cond
         )
-        print(query)
-        return self.conn.read_query(query)
+        return query if self.keep_columns is None else self.project_query(query)
 
-    def fit(self, X=None, y: pd.DataFrame=None, **kwargs):
+    def project_query(self, query: str) -> str:
         """
-        Инференс типов данных
+        Ключ и оставленные колонки результата query.
+
+        Наследники, которые сами строят список выражений, не вычисляют выброшенные колонки вовсе,
+        для остальных лишние колонки отбрасывает планировщик бд
+        """
+        columns = [self.key_column] + self.keep_columns
+        return f"select {', '.join(quote_ident(column) for column in columns)} from ({query}) pruned"
+
+    def keeps_any(self, columns: List[str]) -> bool:
+        """
+        Нужна ли после prune хотя бы одна из колонок columns
+        """
+        return self.keep_columns is None or not set(columns).isdisjoint(self.keep_columns)
+
+    def pruning_comment(self) -> str:
+        """
+        Строка запроса с хэшем оставленных колонок для экстракторов, которые считают признаки в python:
+        от неё зависят ключ кэша и FeatureStore
+        """
+        if self.keep_columns is None:
+            return ""
+        return f"-- keep_columns: {hashlib.sha1(json.dumps(self.keep_columns).encode()).hexdigest()[:16]}"
+
+    def source_tables(self, mode: str, query: Optional[str] = None) -> List[str]:
+        """
+        Таблицы, которые читает запрос (по умолчанию query_template) в режиме mode
+        """
+        query = self.render_query(mode) if query is None else query
+        tables = set(re.findall(rf'\b(\w+_{mode})\b', query))
+        return sorted(tables | {self.get_target(mode)})
+
+    @staticmethod
+    def heats_of(X) -> Optional[List[int]]:
+        """
+        Плавки, которыми ограничивается transform.
+
+        X - None (все плавки режима), последовательность NPLV или датафрейм с колонкой NPLV
         """
+        if X is None:
+            return None
+        if isinstance(X, pd.DataFrame):
+            X = X['NPLV']
+        return [int(nplv) for nplv in X]
 
-        df = self.get_df("train", cond="limit 500")
+    def restrict_query(self, query: str, heats: List[int], key_column: Optional[str] = None) -> str:
+        """
+        Запрос, оставляющий только плавки heats; условие на ключ бд проталкивает внутрь подзапроса
+        """
+        key_column = self.key_column if key_column is None else key_column
+        values = ", ".join(str(int(nplv)) for nplv in heats) or "null"
+        return f'select * from ({query}) restricted where restricted."{key_column}" in ({values})'
+
+    def get_df(self, mode: str, cond: str = "", heats: Optional[List[int]] = None) -> pd.DataFrame:
+        """
+        Метод для получения датафрейма из query_template, при заданных heats - только по этим плавкам
+        """
+        query = self.render_query(mode, cond)
+        if heats is not None:
+            query = self.restrict_query(query, heats)
+        return self.read_query(query)
+
+    def read_query(self, query: str) -> pd.DataFrame:
+        """
+        Выполнение запроса экстрактора; при включённом tracer.explain план запроса записывается отдельным span
+        """
+        df = self.conn.read_query(query, timeout=self.timeout)
+
+        tracer = get_tracer()
+        if tracer.enabled and tracer.explain:
+            with tracer.span("explain", kind="explain", **query_attrs(query)) as span:
+                span.attrs['plan'] = self.conn.explain_analyze(query)
+        return df
+
+    def get_cached_df(self,
+                      mode: str,
+                      query: Optional[str] = None,
+                      compute: Optional[Callable[[], pd.DataFrame]] = None) -> pd.DataFrame:
+        """
+        Получение датафрейма через дисковый кэш, если он задан
+
+        По умолчанию кэшируется результат get_df, query и compute позволяют закэшировать другой запрос
+        """
+        query = self.render_query(mode) if query is None else query
+        compute = (lambda: self.get_df(mode)) if compute is None else compute
+        if self.cache is None:
+            return compute()
+
+        return self.cache.get_or_compute(
+            conn=self.conn,
+            name=type(self).__name__,
+            mode=mode,
+            query=query,
+            tables=self.source_tables(mode, query),
+            compute=compute
+        )
+
+    def columns_of(self, df: pd.DataFrame, predicate: Callable) -> List[str]:
+        """
+        Колонки признаков, тип которых удовлетворяет predicate
+
+        Проверяются семейства типов, а не конкретные float64/int64/object,
+        чтобы компактные типы (float32, int32, category) классифицировались так же
+        """
+        mask = df.dtypes.map(predicate).to_numpy(dtype=bool)
+        return df.columns[mask].difference(self.target_columns + [self.id_column, 'tgt_NPLV']).tolist()
+
+    def fit(self, X=None, y: pd.DataFrame=None, sample: bool = False, **kwargs):
+        """
+        Инференс типов данных
+
+        Типы колонок берутся из метаданных запроса с limit 0, который бд не выполняет целиком.
+        Если бэкенд не может описать типы (или sample=True), выполняется запрос на 500 строк
+        """
+        df = None if sample else self.conn.describe_query(self.render_query("train", cond="limit 0"))
+        if df is None:
+            df = self.get_df("train", cond="limit 500")
 
-        self.time_columns = df.columns[df.dtypes == 'datetime64[ns]'].difference(
-            self.target_columns + [self.id_column, 'tgt_NPLV']).tolist()
-        self.float_columns = df.columns[df.dtypes == 'float64'].difference(
-            self.target_columns + [self.id_column, 'tgt_NPLV']).tolist()
-        self.int_columns = df.columns[df.dtypes == 'int64'].difference(self.target_columns + [self.id_column, 'tgt_NPLV']).tolist()
-        self.cat_columns = df.columns[df.dtypes == 'object'].difference(self.target_columns + [self.id_column, 'tgt_NPLV']).tolist()
+        self.time_columns = self.columns_of(df, is_datetime64_any_dtype)
+        self.float_columns = self.columns_of(df, is_float_dtype)
+        self.int_columns = self.columns_of(df, is_integer_dtype)
+        self.cat_columns = self.columns_of(df, lambda dtype: is_object_dtype(dtype) or is_categorical_dtype(dtype))
 
         self.feature_columns = self.float_columns + self.int_columns + self.cat_columns
+        excluded = self.target_columns + [self.id_column, 'tgt_NPLV']
+        self.output_columns = [column for column in df.columns if column not in excluded]
         print("Feature columns", self.feature_columns)
 
         return self
 
+    def schema_hash(self) -> str:
+        """
+        Хэш запроса, по которому определялась схема: сохранённая схема устаревает при его изменении.
+
+        Берётся запрос без prune, чтобы сохранённый результат отбора признаков не делал схему устаревшей
+        """
+        query = self.query_template.format(target=self.get_target("train"), mode="train", cond="")
+        return hashlib.sha1(query.encode()).hexdigest()[:16]
+
+    def schema_matches(self, schema: dict) -> bool:
+        """
+        Подходит ли сохранённая схема вместо fit: по умолчанию - если не изменился запрос
+        """
+        return schema.get('query_hash') == self.schema_hash()
+
+    def get_schema(self) -> dict:
+        """
+        Результат fit в виде словаря, который можно сохранить в json
+        """
+        schema = {attribute: getattr(self, attribute) for attribute in self.schema_attributes}
+        schema['query_hash'] = self.schema_hash()
+        return schema
+
+    def set_schema(self, schema: dict):
+        """
+        Восстановление результата fit из словаря get_schema без запросов к бд
+        """
+        for attribute in self.schema_attributes:
+            if attribute in schema or attribute not in self.schema_defaults:
+                setattr(self, attribute, schema[attribute])
+            else:
+                setattr(self, attribute, self.schema_defaults[attribute])
+        return self
+
+    def prune(self, columns: List[str]):
+        """
+        Оставить из результата fit только колонки columns: запрос перестаёт их вычислять,
+        а список колонок сохраняется в схему (keep_columns)
+        """
+        keep = set(columns)
+        self.keep_columns = [column for column in self.output_columns if column in keep]
+        for attribute in ('time_columns', 'float_columns', 'int_columns', 'cat_columns', 'feature_columns',
+                          'output_columns'):
+            setattr(self, attribute, [column for column in getattr(self, attribute) if column in keep])
+        return self
+
+    def select_kept(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Ключ и оставленные колонки датафрейма, посчитанного в python
+        """
+        return df if self.keep_columns is None else df[[self.key_column] + self.keep_columns]
+
     def transform(self, X=None, mode: str = 'train'):
-        df = self.get_df(mode).astype({n: pd.CategoricalDtype() for n in self.cat_columns})
+        """
+        Признаки всех плавок режима mode или только плавок из X (см. heats_of).
+
+        Выборка по отдельным плавкам идёт мимо кэша. С FeatureStore признаки читаются
+        из материализованной таблицы, в которой предварительно обновляются новые плавки
+        """
+        heats = self.heats_of(X)
+        with get_tracer().span(type(self).__name__, kind="extractor", mode=mode) as span:
+            if self.store is not None:
+                df = self.store.read(self, mode, heats)
+            else:
+                df = self.get_cached_df(mode) if heats is None else self.get_df(mode, heats=heats)
+            df = df.astype({n: pd.CategoricalDtype() for n in self.cat_columns})
+            span.record_frame(df)
         return df
         # return df if mode == 'test' else df.dropna(subset=self.target_columns)
 
@@ -75,39 +548,259 @@ class AllFeaturesExtractor(DBFeatureExtractor):
     order by "NPLV"
     """
 
-    def __init__(self, conn):
+    def __init__(self,
+                 conn,
+                 cache: Optional[FeatureCache] = None,
+                 timeout: Optional[float] = None,
+                 n_jobs: int = 1,
+                 fused: bool = False,
+                 store: Optional[FeatureStore] = None,
+                 timeseries: Optional[TimeSeriesStore] = None):
         """
         Класс для сбора всех имеющихся признаков
+
+        При n_jobs > 1 запросы экстракторов отправляются одновременно
+        в n_jobs потоках, каждый из которых берёт своё соединение из пула sqlalchemy.
+        timeout ограничивает время выполнения запроса каждого экстрактора.
+        При fused=True sql экстракторы компилируются в один запрос (см. compile_query).
+        store материализует признаки всех экстракторов в таблицах бд (таргет читается как обычно).
+        С timeseries добавляются признаки рядов gas и produv из хранилища evraz.timeseries (ts_fe)
         """
-        super().__init__(conn)
+        super().__init__(conn, cache, timeout, store)
+        self.n_jobs = n_jobs
+        self.fused = fused
 
         self.feature_extractors = dict(
-            static_fe=StaticFeatures(conn),
-            chronom_fe=ChronomRawFeatures(conn),
-            sip_fe=SipFeatures(conn),
-            gas_fe=GasRawFeatures(conn),
-            gas_proc_fe=GasProcessFeatures(conn)
+            static_fe=StaticFeatures(conn, cache, timeout, store),
+            chronom_fe=ChronomPivotFeatures(conn, cache, timeout, store),
+            sip_fe=SipPivotFeatures(conn, cache, timeout, store),
+            lom_fe=LomPivotFeatures(conn, cache, timeout, store),
+            gas_fe=GasRawFeatures(conn, cache, timeout, store),
+            gas_op_fe=GasOperationFeatures(conn, cache, timeout, store)
         )
+        self.timeseries = timeseries
+        if timeseries is not None:
+            self.feature_extractors['ts_fe'] = TimeSeriesFeatures(conn, cache, timeout, store, timeseries)
+        # экстракторы, у которых prune не оставил ни одной колонки: не выполняются, но остаются в схеме
+        self.pruned_extractors: Dict[str, DBFeatureExtractor] = {}
 
-    def fit(self, X=None, y=None, **kwargs):
-        self.feature_columns = []
+    def map_extractors(self,
+                       func: Callable[[str, DBFeatureExtractor], object],
+                       before: Optional[Callable[[], object]] = None,
+                       names: Optional[List[str]] = None):
+        """
+        Применение func к экстракторам names (по умолчанию ко всем) с сохранением порядка feature_extractors.
+
+        before выполняется в основном потоке, пока экстракторы работают в пуле
+        """
+        extractors = {
+            name: extractor for name, extractor in self.feature_extractors.items()
+            if names is None or name in names
+        }
+        if self.n_jobs == 1:
+            head = before() if before is not None else None
+            return head, {name: func(name, extractor) for name, extractor in extractors.items()}
 
+        # span'ы экстракторов в потоках пула вкладываются в текущий span вызывающего потока
+        tracer = get_tracer()
+        parent_id = tracer.current_id()
+
+        def run(name, extractor):
+            with tracer.attach(parent_id):
+                return func(name, extractor)
+
+        with ThreadPoolExecutor(max_workers=self.n_jobs) as executor:
+            futures = {
+                name: executor.submit(run, name, extractor)
+                for name, extractor in extractors.items()
+            }
+            head = before() if before is not None else None
+            return head, {name: future.result() for name, future in futures.items()}
+
+    @property
+    def extractor_columns(self) -> Dict[str, List[str]]:
+        """
+        Колонки, которые добавляет каждый экстрактор
+        """
+        return {name: extractor.output_columns for name, extractor in self.feature_extractors.items()}
+
+    def compile_query(self, mode: str, heats: Optional[List[int]] = None) -> str:
+        """
+        Один запрос вместо запроса таргета и запросов всех sql экстракторов.
+
+        Запрос каждого экстрактора становится CTE, которые присоединяются к таргету по NPLV,
+        поэтому результат приходит одной выборкой без цепочки pd.merge на стороне python.
+        При заданных heats каждый CTE ограничивается этими плавками,
+        с FeatureStore CTE экстрактора читает его материализованную таблицу.
+        Требует fit: список колонок каждого экстрактора берётся из output_columns
+        """
+        def render(extractor: DBFeatureExtractor) -> str:
+            if extractor.store is not None and extractor is not self:
+                query = extractor.store.select_query(extractor, mode)
+            else:
+                query = extractor.render_query(mode)
+            return query if heats is None else extractor.restrict_query(query, heats)
+
+        ctes = [f"fused_target as ({render(self)})"]
+        columns = ["fused_target.*"]
+        joins = []
+        seen = set()
         for name, extractor in self.feature_extractors.items():
+            if not extractor.fusable:
+                continue
+
+            duplicated = seen.intersection(extractor.output_columns)
+            if duplicated:
+                raise ValueError(f"Columns {sorted(duplicated)} of {name} are already selected by another extractor")
+            seen.update(extractor.output_columns)
+
+            ctes.append(f"{name} as ({render(extractor)})")
+            columns.extend(f'{name}."{column}"' for column in extractor.output_columns)
+            joins.append(f'left join {name} on {name}."{extractor.key_column}" = fused_target."{self.id_column}"')
+
+        return "\n".join([
+            "with " + ",\n".join(ctes),
+            "select " + ",\n       ".join(columns),
+            "from fused_target",
+            *joins,
+            f'order by fused_target."{self.id_column}"'
+        ])
+
+    def fit(self, X=None, y=None, schema_path: Optional[str] = None, **kwargs):
+        """
+        Определение схемы всех экстракторов
+
+        Если задан schema_path и файл существует, схема читается из него, а заново определяются
+        только экстракторы, схема которых устарела (см. schema_matches). Итоговая схема сохраняется в schema_path
+        """
+        schema = {}
+        if schema_path is not None and os.path.exists(schema_path):
+            with open(schema_path) as f:
+                schema = json.load(f)
+
+        def fit_extractor(name, extractor):
+            if name in schema and extractor.schema_matches(schema[name]):
+                print(f"Load {name} feature extractor schema from {schema_path}")
+                return extractor.set_schema(schema[name])
             print(f"Fit {name} feature extractor")
-            extractor.fit()
+            return extractor.fit(**kwargs)
+
+        self.map_extractors(fit_extractor)
+        self.update_columns()
+
+        if schema_path is not None:
+            self.save_schema(schema_path)
+        return self
+
+    def update_columns(self):
+        """
+        Экстракторы без оставленных колонок убираются из feature_extractors, feature_columns собираются заново
+        """
+        for name, extractor in list(self.feature_extractors.items()):
+            if extractor.keep_columns == []:
+                print(f"Skip {name} feature extractor: all its columns are pruned")
+                self.pruned_extractors[name] = self.feature_extractors.pop(name)
+
+        self.feature_columns = []
+        for extractor in self.feature_extractors.values():
             self.feature_columns.extend(extractor.feature_columns)
         return self
 
+    def prune(self, columns: List[str]):
+        """
+        Оставить только признаки columns: запросы экстракторов считают только их,
+        экстракторы без оставленных признаков не выполняются. Результат сохраняется в схему
+        """
+        for extractor in self.feature_extractors.values():
+            extractor.prune(columns)
+        return self.update_columns()
+
+    def get_schema(self) -> dict:
+        extractors = dict(self.feature_extractors, **self.pruned_extractors)
+        return {name: extractor.get_schema() for name, extractor in extractors.items()}
+
+    def set_schema(self, schema: dict):
+        for name, extractor in self.feature_extractors.items():
+            extractor.set_schema(schema[name])
+        return self.update_columns()
+
+    def save_schema(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.get_schema(), f, ensure_ascii=False, indent=2)
+        return self
+
+    def load_schema(self, path: str):
+        with open(path) as f:
+            return self.set_schema(json.load(f))
+
+    def get_fused_df(self, mode: str, heats: Optional[List[int]] = None) -> pd.DataFrame:
+        """
+        Таргет и признаки всех sql экстракторов одним запросом
+        """
+        if self.store is not None and self.store.auto_refresh:
+            self.refresh(mode, heats, names=[name for name, e in self.feature_extractors.items() if e.fusable])
+        query = self.compile_query(mode, heats)
+
+        def compute():
+            return self.read_query(query)
+
+        # материализованные таблицы обновляются на месте, их отпечаток для кэша ненадёжен
+        if heats is not None or self.store is not None:
+            df = compute()
+        else:
+            df = self.get_cached_df(mode, query=query, compute=compute)
+        cat_columns = [
+            column
+            for extractor in self.feature_extractors.values() if extractor.fusable
+            for column in extractor.cat_columns
+        ]
+        return df.astype({n: pd.CategoricalDtype() for n in cat_columns})
+
+    def refresh(self,
+                mode: str,
+                heats: Optional[List[int]] = None,
+                names: Optional[List[str]] = None,
+                full: bool = False) -> Dict[str, int]:
+        """
+        Обновление материализованных таблиц экстракторов names (по умолчанию всех),
+        full - с полным пересчётом отпечатков (см. FeatureStore.refresh).
+        Возвращает число пересчитанных плавок каждого экстрактора
+        """
+        if self.store is None:
+            raise ValueError("FeatureStore is not set")
+
+        _, refreshed = self.map_extractors(
+            lambda name, extractor: self.store.refresh(extractor, mode, heats, full), names=names)
+        return refreshed
+
     def transform(self, X=None, mode: str = 'train'):
-        target = self.get_df(mode)
+        with get_tracer().span(type(self).__name__, kind="extractor", mode=mode) as span:
+            df = self._transform(X, mode)
+            span.record_frame(df)
+        return df
+
+    def _transform(self, X=None, mode: str = 'train'):
+        def transform_extractor(name, extractor):
+            print(f"Extracting features from {name} extractor")
+            return extractor.transform(X, mode=mode)
+
+        heats = self.heats_of(X)
+        if self.fused:
+            names = [name for name, extractor in self.feature_extractors.items() if not extractor.fusable]
+            target, features = self.map_extractors(
+                transform_extractor, before=lambda: self.get_fused_df(mode, heats), names=names)
+        else:
+            names = list(self.feature_extractors)
+            target, features = self.map_extractors(
+                transform_extractor, before=lambda: self.get_df(mode, heats=heats))
+
         if mode == "train":
             target = target.dropna(subset=["TST", "C"])
 
-        for name, extractor in self.feature_extractors.items():
-            print(f"Extracting features from {name} extractor")
-            features = extractor.transform(mode=mode)
-            print(features)
-            target = pd.merge(target, features, how='left', on='NPLV')
+        for name in names:
+            target = pd.merge(target, features[name], how='left', on='NPLV')
 
         return target
 
@@ -115,7 +808,15 @@ class AllFeaturesExtractor(DBFeatureExtractor):
 class StaticFeatures(DBFeatureExtractor):
     """
     Статические признаки изделия
+
+    После prune вместо plavki.* и chugun.* выбираются только оставленные колонки,
+    а таблица без оставленных колонок не присоединяется
     """
+    key_column = 'tgt_NPLV'
+    tables = ('plavki', 'chugun')
+    schema_attributes = DBFeatureExtractor.schema_attributes + ('table_columns',)
+    schema_defaults = dict(DBFeatureExtractor.schema_defaults, table_columns=None)
+
     query_template = """
     select target."NPLV" "tgt_NPLV",
            plavki.*,
@@ -126,162 +827,77 @@ class StaticFeatures(DBFeatureExtractor):
     {cond}
     """
 
-    def transform(self, X=None, mode: str = 'train'):
-        return super().transform(X, mode).drop(columns=["NPLV"]).rename(columns={'tgt_NPLV': 'NPLV'})
+    def __init__(self,
+                 conn: Connection,
+                 cache: Optional[FeatureCache] = None,
+                 timeout: Optional[float] = None,
+                 store: Optional[FeatureStore] = None):
+        super().__init__(conn, cache, timeout, store)
+        # таблица -> её колонки, найденные при fit
+        self.table_columns = None
 
+    def render_query(self, mode: str, cond: str = "") -> str:
+        if self.keep_columns is None or self.table_columns is None:
+            return super().render_query(mode, cond)
 
-class ChronomRawFeatures(DBFeatureExtractor):
-    """
-    Признаки наличия некоторых операций и их длительностей
-    """
-    query_template = """
-    select target."NPLV",
-       --  количество O2 использованного в процессе
-       sum(coalesce(chronom."O2", 0)) "sum_O2",
-       -- общее время нагрева лома
-       coalesce(sum(datediff_minutes(chronom."VR_KON", chronom."VR_NACH"))
-                filter (where chronom."NOP" = 'Нагрев лома'), 0)          as         lom_nagrev_total_minutes,
-       -- наличие торкретирования
-       count(*) filter (where chronom."NOP" = 'Полусухое торкрет.')       as         torcr_count,
-       -- общее время слива шлака
-       coalesce(sum(datediff_seconds(chronom."VR_KON", chronom."VR_NACH"))
-                filter ( where chronom."NOP" = 'Слив шлака'), 0)          as         sliv_shlaka_total_sec,
-       -- проводилось ли наведение гарнисажа
-       count(*) filter (where chronom."NOP" = 'Наведение гарнисажа')      as         garnisazh_cnt,
-       -- общее время обрыва горловины
-       coalesce(sum(datediff_seconds(chronom."VR_KON", chronom."VR_NACH"))
-                filter (where chronom."NOP" = 'Обрыв горловины'), 0)      as         obr_gorl_total_sec,
-       -- общее время Отсутствие O2
-       coalesce(sum(datediff_seconds(chronom."VR_KON", chronom."VR_NACH"))
-                filter (where chronom."NOP" = 'Отсутствие O2'), 0)        as         ots_02_total_sec,
-       -- общее время отсутствия чугуна
-       coalesce(sum(datediff_minutes(chronom."VR_KON", chronom."VR_NACH"))
-                filter (where chronom."NOP" = 'Отсутствие чугуна'), 0)    as         ots_chugun_total_sec,
-       -- время простоя из-за неисправностей
-       coalesce(sum(datediff_minutes(chronom."VR_KON", chronom."VR_NACH"))
-                filter (where chronom."NOP" like 'Неиспр.%%'), 0)          as         neispr_total_min,
-       -- время ожидания чего-то (Ожидание)
-       coalesce(sum(datediff_minutes(chronom."VR_KON", chronom."VR_NACH"))
-                filter (where chronom."NOP" like 'Ожидание%%'), 0)         as         ozhidanie_total_min,
-       -- время замера положения фурм (Замер положения фурм)
-       coalesce(sum(datediff_minutes(chronom."VR_KON", chronom."VR_NACH"))
-                filter (where chronom."NOP" = 'Замер положения фурм'), 0) as         zamer_furm_total_min
-    from {target} target
-             left join chronom_{mode} chronom using ("NPLV")
-             left join plavki_{mode} plavki using ("NPLV")
-    where chronom."VR_KON" < plavki."plavka_VR_KON"
-    group by target."NPLV"
-    {cond}
-    """
+        columns = [f'target."NPLV" "{self.key_column}"']
+        joins = []
+        for table in self.tables:
+            kept = [column for column in self.table_columns[table] if column in self.keep_columns]
+            if kept:
+                columns.extend(f'{table}.{quote_ident(column)}' for column in kept)
+                joins.append(f'left join {table}_{mode} {table} using ("NPLV")')
 
+        return "\n".join([
+            "select " + ",\n       ".join(columns),
+            f"from {self.get_target(mode)} target",
+            *joins,
+            cond,
+        ])
 
-class SipFeatures(DBFeatureExtractor):
-    """
-    Признаки количества, средних, std используемых сыпучих материалов
-    """
-    query_template = """
-    with grouped_features as (
-        select "NPLV",
-               -- кол-во, сумма, среднее, отклонение, скошенность засыпанного Уголь ТО
-               count("VSSYP") filter (where "NMSYP" = 'Уголь ТО') ugol_cnt,
-               coalesce(sum("VSSYP") filter (where "NMSYP" = 'Уголь ТО'), 0) ugol_sum,
-               coalesce(avg("VSSYP") filter (where "NMSYP" = 'Уголь ТО'), 0) ugol_avg,
-               coalesce(stddev("VSSYP") filter (where "NMSYP" = 'Уголь ТО'), 0) ugol_std,
-               -- кол-во, сумма, среднее, отклонение, скошенность засыпанного ФЛЮМАГ
-               count("VSSYP") filter (where "NMSYP" = 'ФЛЮМАГ') flumag_cnt,
-               coalesce(sum("VSSYP") filter (where "NMSYP" = 'ФЛЮМАГ'), 0) flumag_sum,
-               coalesce(avg("VSSYP") filter (where "NMSYP" = 'ФЛЮМАГ'), 0) flumag_avg,
-               coalesce(stddev("VSSYP") filter (where "NMSYP" = 'ФЛЮМАГ'), 0) flumag_std,
-               -- кол-во, сумма, среднее, отклонение, скошенность засыпанного изв_ЦОИ
-               count("VSSYP") filter (where "NMSYP" = 'изв_ЦОИ') uzvcoi_cnt,
-               coalesce(sum("VSSYP") filter (where "NMSYP" = 'изв_ЦОИ'), 0) uzvcoi_sum,
-               coalesce(avg("VSSYP") filter (where "NMSYP" = 'изв_ЦОИ'), 0) uzvcoi_avg,
-               coalesce(stddev("VSSYP") filter (where "NMSYP" = 'изв_ЦОИ'), 0) uzvcoi_std,
-               -- кол-во, сумма, среднее, отклонение, скошенность засыпанного Флюс ФОМИ
-               count("VSSYP") filter (where "NMSYP" = 'Флюс ФОМИ') flusfomi_cnt,
-               coalesce(sum("VSSYP") filter (where "NMSYP" = 'Флюс ФОМИ'), 0) flusfomi_sum,
-               coalesce(avg("VSSYP") filter (where "NMSYP" = 'Флюс ФОМИ'), 0) flusfomi_avg,
-               coalesce(stddev("VSSYP") filter (where "NMSYP" = 'Флюс ФОМИ'), 0) flusfomi_std
-        from sip_{mode} sip
-        left join plavki_{mode} plavki using ("NPLV")
-        where sip."DAT_OTD" < plavki."plavka_VR_KON"
-        group by "NPLV"
-    ), numbered as (
-    -- проставление порядкого номера процессов внутри одной плавки
-        select sip.*,
-               row_number() over (partition by "NPLV" order by "DAT_OTD") rank,
-               row_number() over (partition by "NPLV" order by "DAT_OTD" desc) rank_inv
-        from sip_{mode} sip
-        left join plavki_{mode} plavki using ("NPLV")
-        where sip."DAT_OTD" < plavki."plavka_VR_KON"
-    ), sip_features as (
-    -- объединение признаков сыпучих
-        select gp.*,
-               -- первое название сыпучих
-               first_n."NMSYP" first_sip,
-               -- последнее название
-               last_n."NMSYP" last_sip
-        from grouped_features gp
-        left join numbered first_n using("NPLV")
-        left join numbered last_n using("NPLV")
-        where 1=1
-        -- первая строка
-        and first_n.rank = 1
-        -- последняя
-        and last_n.rank_inv = 1
-    )
-    select * from sip_features
-    {cond}
-    """
+    def fit(self, X=None, y: pd.DataFrame=None, **kwargs):
+        """
+        Типы колонок и принадлежность колонок таблицам (для запроса после prune)
+        """
+        super().fit(X, y, **kwargs)
+        self.table_columns = {
+            table: [
+                column for column in self.conn.read_query(f"select * from {table}_train limit 0").columns
+                if column != self.id_column
+            ]
+            for table in self.tables
+        }
+        return self
+
+    def get_df(self, mode: str, cond: str = "", heats: Optional[List[int]] = None) -> pd.DataFrame:
+        """
+        Без колонок NPLV из plavki.* и chugun.*: ключ - tgt_NPLV, а повторяющиеся имена не пишутся в parquet кэша
+        """
+        df = super().get_df(mode, cond, heats)
+        return df.loc[:, df.columns != self.id_column]
+
+    def transform(self, X=None, mode: str = 'train'):
+        return super().transform(X, mode).rename(columns={'tgt_NPLV': 'NPLV'})
 
 
 class GasRawFeatures(DBFeatureExtractor):
     """
     Простые аггрегаты колонок из таблицы gas
+
+    Мин, среднее, макс и откл объёма, температуры и состава газа (AR, CO, CO2, H2, O2, N2),
+    после prune запрос считает только оставленные аггрегаты
     """
+    signals = ['V', 'T', 'AR', 'CO', 'CO2', 'H2', 'O2', 'N2']
+    # префикс колонки -> аггрегатная функция
+    aggregates = {
+        'min': 'min',
+        'max': 'max',
+        'avg': 'avg',
+        'srd': 'stddev',
+    }
+
     query_template = """
-    select "NPLV",
-           -- мин, среднее, макс, откл
-           -- объём
-           min("V") min_V,
-           max("V") max_V,
-           avg("V") avg_V,
-           stddev("V") srd_V,
-           -- температура
-           min("T") min_T,
-           max("T") max_T,
-           avg("T") avg_T,
-           stddev("T") srd_T,
-           -- AR
-           min("AR") min_AR,
-           max("AR") max_AR,
-           avg("AR") avg_AR,
-           stddev("AR") srd_AR,
-           -- CO
-           min("CO") min_CO,
-           max("CO") max_CO,
-           avg("CO") avg_CO,
-           stddev("CO") srd_CO,
-           -- CO2
-           min("CO2") min_CO2,
-           max("CO2") max_CO2,
-           avg("CO2") avg_CO2,
-           stddev("CO2") srd_CO2,
-           -- H2
-           min("H2") min_H2,
-           max("H2") max_H2,
-           avg("H2") avg_H2,
-           stddev("H2") srd_H2,
-           -- O2
-           min("O2") min_O2,
-           max("O2") max_O2,
-           avg("O2") avg_O2,
-           stddev("O2") srd_O2,
-           -- N2
-           min("N2") min_N2,
-           max("N2") max_N2,
-           avg("N2") avg_N2,
-           stddev("N2") srd_N2
+    select "NPLV"{columns}
     from gas_{mode} gas
     left join plavki_{mode} plavki using ("NPLV")
         where gas."Time" < plavki."plavka_VR_KON"
@@ -289,30 +905,473 @@ class GasRawFeatures(DBFeatureExtractor):
     {cond}
     """
 
+    def select_expressions(self) -> Dict[str, str]:
+        """
+        Колонка -> выражение, без выброшенных prune колонок
+        """
+        expressions = {
+            f"{prefix}_{signal.lower()}": f'{function}("{signal}")'
+            for signal in self.signals
+            for prefix, function in self.aggregates.items()
+        }
+        return {
+            column: expression for column, expression in expressions.items()
+            if self.keep_columns is None or column in self.keep_columns
+        }
+
+    def render_query(self, mode: str, cond: str = "") -> str:
+        columns = "".join(
+            f',\n           {expression} "{column}"' for column, expression in self.select_expressions().items())
+        return self.query_template.format(target=self.get_target(mode), mode=mode, cond=cond, columns=columns)
+
+    def schema_hash(self) -> str:
+        description = [self.query_template, self.signals, self.aggregates]
+        return hashlib.sha1(json.dumps(description).encode()).hexdigest()[:16]
 
-class GasProcessFeatures(DBFeatureExtractor):
+
+class GasOperationFeatures(DBFeatureExtractor):
     """
-    Аггрегаты состава газов при некоторых процессах
+    Аггрегаты сигналов газа во время каждой операции из chronom
+
+    Вместо range join в бд отсчёты газа сопоставляются операциям бинарным поиском (evraz.intervals),
+    а среднее, std, min, max и 10%/90% персентили считаются одним проходом для всех операций, найденных при fit
     """
-    query_template = """
-    select gas."NPLV",
-       -- среднее значение температуры во время продувки
-       avg(gas."T") filter ( where chronom."NOP" = 'Продувка' ) avg_t_produvka,
-       -- std температуры во время продувки
-       stddev(gas."T") filter ( where chronom."NOP" = 'Продувка' ) std_t_produvka,
-       -- минимальное значение температуры во время продувки
-       min(gas."T") filter ( where chronom."NOP" = 'Продувка' ) min_t_produvka,
-       -- 10%% персентиль температуры во время продувки
-       percentile_cont(0.1) within group ( order by gas."T" ) filter ( where chronom."NOP" = 'Продувка' ) percentile_10_produvka,
-       -- 90%% персентиль температуры во время продувки
-       percentile_cont(0.9) within group ( order by gas."T" ) filter ( where chronom."NOP" = 'Продувка' ) percentile_90_produvka
+    # признаки считаются в python, а не в sql
+    fusable = False
+    schema_attributes = DBFeatureExtractor.schema_attributes + ('operations',)
+    # сигналы газа, по которым считаются аггрегаты
+    signals = ['T']
+
+    gas_query_template = """
+    select gas."NPLV", gas."Time", {signals}
     from gas_{mode} gas
-    left join chronom_{mode} chronom
-    on gas."NPLV" = chronom."NPLV"
-    and gas."Time" between chronom."VR_NACH" and chronom."VR_KON"
-    left join plavki_{mode} plavki 
+    left join plavki_{mode} plavki
     on plavki."NPLV" = gas."NPLV"
         where gas."Time" < plavki."plavka_VR_KON"
-    group by gas."NPLV"
     {cond}
     """
+    chronom_query_template = """
+    select chronom."NPLV", chronom."NOP", chronom."VR_NACH", chronom."VR_KON"
+    from chronom_{mode} chronom
+    {cond}
+    """
+    operations_query_template = """
+    select distinct chronom."NOP"
+    from chronom_{mode} chronom
+    order by chronom."NOP"
+    """
+
+    def __init__(self,
+                 conn: Connection,
+                 cache: Optional[FeatureCache] = None,
+                 timeout: Optional[float] = None,
+                 store: Optional[FeatureStore] = None):
+        super().__init__(conn, cache, timeout, store)
+        # операции, найденные при fit
+        self.operations = None
+
+    def kept_signals(self) -> List[str]:
+        return [signal for signal in self.signals if self.keeps_any(feature_names([signal], self.operations or []))]
+
+    def kept_operations(self) -> List[str]:
+        slugs = unique_slugs(self.operations or [])
+        return [op for op in self.operations or [] if self.keeps_any(feature_names(self.signals, [op], slugs))]
+
+    def render_query(self, mode: str, cond: str = "") -> str:
+        """
+        Тексты запросов и список операций: от них зависит результат, в том числе ключ кэша
+        """
+        signals = ", ".join(f'gas."{signal}"' for signal in self.kept_signals())
+        return "\n".join([
+            self.gas_query_template.format(mode=mode, cond=cond, signals=signals),
+            self.chronom_query_template.format(mode=mode, cond=cond),
+            f"-- operations: {self.operations}",
+            self.pruning_comment()
+        ]).rstrip("\n")
+
+    def get_df(self, mode: str, cond: str = "", heats: Optional[List[int]] = None) -> pd.DataFrame:
+        """
+        После prune читаются только нужные сигналы, а аггрегаты считаются только по нужным операциям
+        """
+        # проверка режима
+        self.get_target(mode)
+        signals = self.kept_signals()
+
+        gas_query = self.gas_query_template.format(
+            mode=mode, cond=cond, signals=", ".join(f'gas."{signal}"' for signal in signals))
+        chronom_query = self.chronom_query_template.format(mode=mode, cond=cond)
+        if heats is not None:
+            gas_query = self.restrict_query(gas_query, heats)
+            chronom_query = self.restrict_query(chronom_query, heats)
+
+        gas = self.read_query(gas_query)
+        chronom = self.read_query(chronom_query)
+
+        with get_tracer().span("operation_aggregates", kind="compute", rows_in=len(gas)) as span:
+            df = operation_aggregates(gas, chronom, signals=signals, operations=self.kept_operations(),
+                                      slugs=unique_slugs(self.operations))
+            df = self.select_kept(df)
+            span.record_frame(df)
+        return df
+
+    def schema_hash(self) -> str:
+        # список операций определяется при fit, в хэш идут только шаблоны запросов
+        return hashlib.sha1(
+            (self.gas_query_template + self.chronom_query_template + " ".join(self.signals)).encode()
+        ).hexdigest()[:16]
+
+    def query_operations(self) -> List[str]:
+        operations = self.conn.read_query(self.operations_query_template.format(mode='train'))
+        return operations["NOP"].astype(str).tolist()
+
+    def schema_matches(self, schema: dict) -> bool:
+        """
+        Схема устаревает и при появлении в chronom_train новых операций (или исчезновении старых)
+        """
+        return super().schema_matches(schema) and schema.get('operations') == self.query_operations()
+
+    def fit(self, X=None, y: pd.DataFrame=None, **kwargs):
+        """
+        Список операций берётся из chronom_train, типы колонок известны заранее
+        """
+        self.operations = self.query_operations()
+        # операции с одинаковым slug различаются суффиксом, см. unique_slugs
+        columns = feature_names(self.signals, self.operations)
+
+        self.time_columns = []
+        self.float_columns = columns
+        self.int_columns = []
+        self.cat_columns = []
+
+        self.feature_columns = self.float_columns + self.int_columns + self.cat_columns
+        self.output_columns = list(self.feature_columns)
+        print("Feature columns", self.feature_columns)
+
+        return self
+
+
+class PivotFeatures(DBFeatureExtractor):
+    """
+    Аггрегаты значения по каждой категории таблицы одним проходом
+
+    Категории (материалы, операции) находятся при fit по таблице режима train, для каждой считаются
+    количество, сумма, среднее и std value_expression через filter, первая и последняя категория плавки
+    берутся из array_agg с сортировкой по order_column. Все признаки считаются за один проход по таблице,
+    поэтому новые категории не добавляют чтений. Наследникам достаточно задать поля таблицы
+    """
+    table = ''
+    prefix = ''
+    category_column = ''
+    # выражение над строкой t, которое аггрегируется по категориям
+    value_expression = ''
+    # колонка времени для первой/последней категории, None - без них
+    order_column = None
+    # строки, у которых end_column не раньше окончания плавки, отбрасываются; None - без отсечения
+    end_column = None
+    aggregates = ('cnt', 'sum', 'avg', 'std')
+    # дополнительные аггрегаты по всем строкам: имя -> выражение
+    totals: Dict[str, str] = {}
+
+    schema_attributes = DBFeatureExtractor.schema_attributes + ('categories',)
+
+    aggregate_templates = {
+        'cnt': "count({value}) filter (where {condition})",
+        'sum': "coalesce(sum({value}) filter (where {condition}), 0)",
+        'avg': "coalesce(avg({value}) filter (where {condition}), 0)",
+        'std': "coalesce(stddev({value}) filter (where {condition}), 0)",
+    }
+    categories_query_template = """
+    select distinct t."{category}"
+    from {table}_{mode} t
+    where t."{category}" is not null
+    order by t."{category}"
+    """
+
+    def __init__(self,
+                 conn: Connection,
+                 cache: Optional[FeatureCache] = None,
+                 timeout: Optional[float] = None,
+                 store: Optional[FeatureStore] = None):
+        super().__init__(conn, cache, timeout, store)
+        # категории, найденные при fit
+        self.categories = None
+
+    @classmethod
+    def column_name(cls, category: str, aggregate: str, slugs: Optional[Dict[str, str]] = None) -> str:
+        """
+        slugs - slug категорий (unique_slugs всех категорий), без него slug считается по одной категории
+        """
+        slug = slugs[category] if slugs is not None else slugify(category, separator='_')
+        return f"{cls.prefix}_{slug}_{aggregate}"
+
+    def select_expressions(self) -> List[str]:
+        """
+        Выражения всех колонок, кроме выброшенных prune
+        """
+        category = f't."{self.category_column}"'
+        slugs = unique_slugs(self.categories or [])
+        expressions = {}
+        for value in self.categories or []:
+            condition = f"{category} = '{escape(value)}'"
+            for aggregate in self.aggregates:
+                expressions[self.column_name(value, aggregate, slugs)] = (
+                    self.aggregate_templates[aggregate].format(value=self.value_expression, condition=condition))
+        for name, expression in self.totals.items():
+            expressions[f"{self.prefix}_{name}"] = expression
+        if self.order_column is not None:
+            expressions[f"{self.prefix}_first"] = f'(array_agg({category} order by t."{self.order_column}"))[1]'
+            expressions[f"{self.prefix}_last"] = f'(array_agg({category} order by t."{self.order_column}" desc))[1]'
+        return [
+            f'{expression} "{column}"' for column, expression in expressions.items()
+            if self.keep_columns is None or column in self.keep_columns
+        ]
+
+    def render_query(self, mode: str, cond: str = "") -> str:
+        # проверка режима
+        self.get_target(mode)
+        join = ""
+        if self.end_column is not None:
+            join = (f'join plavki_{mode} plavki using ("NPLV")\n'
+                    f'    where t."{self.end_column}" < plavki."plavka_VR_KON"')
+
+        return "\n".join([
+            "select " + ",\n       ".join(['t."NPLV"'] + self.select_expressions()),
+            f"from {self.table}_{mode} t",
+            join,
+            'group by t."NPLV"',
+            cond,
+        ])
+
+    def schema_hash(self) -> str:
+        # категории определяются при fit, в хэш идёт только описание таблицы
+        description = [self.table, self.prefix, self.category_column, self.value_expression, self.order_column,
+                       self.end_column, list(self.aggregates), self.totals]
+        return hashlib.sha1(json.dumps(description, ensure_ascii=False).encode()).hexdigest()[:16]
+
+    def query_categories(self) -> List[str]:
+        categories = self.conn.read_query(self.categories_query_template.format(
+            category=self.category_column, table=self.table, mode='train'))
+        return categories[self.category_column].astype(str).tolist()
+
+    def schema_matches(self, schema: dict) -> bool:
+        """
+        Схема устаревает и при изменении набора категорий в таблице режима train
+        """
+        return super().schema_matches(schema) and schema.get('categories') == self.query_categories()
+
+    def fit(self, X=None, y: pd.DataFrame=None, **kwargs):
+        """
+        Категории из таблицы режима train, типы колонок - как у остальных sql экстракторов
+        """
+        # категории с одинаковым slug различаются суффиксом, см. unique_slugs
+        self.categories = self.query_categories()
+        return super().fit(X, y, **kwargs)
+
+
+class SipPivotFeatures(PivotFeatures):
+    """
+    Количество, сумма, среднее и std массы каждого сыпучего материала, первый и последний материал
+    """
+    table = 'sip'
+    prefix = 'sip'
+    category_column = 'NMSYP'
+    value_expression = 't."VSSYP"'
+    order_column = 'DAT_OTD'
+    end_column = 'DAT_OTD'
+
+
+class ChronomPivotFeatures(PivotFeatures):
+    """
+    Количество операций каждого типа и их суммарная, средняя длительность и её std в секундах,
+    первая и последняя операция плавки, общий объём O2
+    """
+    table = 'chronom'
+    prefix = 'chronom'
+    category_column = 'NOP'
+    value_expression = 'datediff_seconds(t."VR_KON", t."VR_NACH")'
+    order_column = 'VR_NACH'
+    end_column = 'VR_KON'
+    totals = {'o2_sum': 'sum(coalesce(t."O2", 0))'}
+
+
+class LomPivotFeatures(PivotFeatures):
+    """
+    Количество, суммарный, средний вес каждого вида лома и его std, общий вес лома
+    """
+    table = 'lom'
+    prefix = 'lom'
+    category_column = 'NML'
+    value_expression = 't."VES"'
+    totals = {'ves_sum': 'coalesce(sum(t."VES"), 0)'}
+
+
+class TimeSeriesFeatures(DBFeatureExtractor):
+    """
+    Оконные признаки временных рядов gas и produv (evraz.timeseries)
+
+    Для каждого сигнала: среднее, std и наклон за плавку, наклон за последние window_seconds,
+    те же статистики по n_phases равным по времени фазам и кривая, передискретизированная в n_points точек.
+    Ряды читаются срезами отдельных плавок из хранилища с отображением в память,
+    из бд запрашиваются только плавки таргета и время их окончания
+    """
+    # признаки считаются в python, а не в sql
+    fusable = False
+    # таблица -> сигналы
+    signals = {
+        'gas': ['V', 'T', 'CO', 'CO2', 'O2'],
+        'produv': ['RAS', 'POL'],
+    }
+    n_phases = 3
+    n_points = 10
+    window_seconds = 300
+
+    heats_query_template = """
+    select target."NPLV", plavki."plavka_VR_KON"
+    from {target} target
+    left join plavki_{mode} plavki using ("NPLV")
+    {cond}
+    """
+
+    def __init__(self,
+                 conn: Connection,
+                 cache: Optional[FeatureCache] = None,
+                 timeout: Optional[float] = None,
+                 store: Optional[FeatureStore] = None,
+                 timeseries: Optional[TimeSeriesStore] = None):
+        super().__init__(conn, cache, timeout, store)
+        self.timeseries = TimeSeriesStore() if timeseries is None else timeseries
+
+    def params_text(self) -> str:
+        return f"{self.signals} {self.n_phases} {self.n_points} {self.window_seconds}"
+
+    def render_query(self, mode: str, cond: str = "") -> str:
+        """
+        Запрос плавок и исходные таблицы рядов с параметрами признаков: от них зависят ключ кэша и FeatureStore
+        """
+        return "\n".join([
+            self.heats_query_template.format(target=self.get_target(mode), mode=mode, cond=cond),
+            f"-- timeseries: {', '.join(f'{table}_{mode}' for table in self.signals)}",
+            f"-- params: {self.params_text()}",
+            self.pruning_comment()
+        ]).rstrip("\n")
+
+    def signal_prefix(self, table: str, signal: str) -> str:
+        return f"{table}_{slugify(signal, separator='_')}"
+
+    def kept_signals(self) -> Dict[str, List[str]]:
+        """
+        Сигналы, у которых после prune остались признаки; таблицы без них не читаются
+        """
+        kept = {
+            table: [
+                signal for signal in signals
+                if self.keeps_any(series_feature_names(self.signal_prefix(table, signal),
+                                                       self.n_phases, self.n_points))
+            ]
+            for table, signals in self.signals.items()
+        }
+        return {table: signals for table, signals in kept.items() if signals}
+
+    def get_df(self, mode: str, cond: str = "", heats: Optional[List[int]] = None) -> pd.DataFrame:
+        query = self.heats_query_template.format(target=self.get_target(mode), mode=mode, cond=cond)
+        if heats is not None:
+            query = self.restrict_query(query, heats)
+        target = self.read_query(query)
+
+        signals = self.kept_signals()
+        series = {table: self.timeseries.get(self.conn, table, mode) for table in signals}
+        ends = dict(zip(target["NPLV"].astype(int), target["plavka_VR_KON"].to_numpy(dtype='datetime64[ns]')))
+
+        with get_tracer().span("timeseries_features", kind="compute", heats=len(target)) as span:
+            df = timeseries_features(series, signals, list(ends), ends,
+                                     self.n_phases, self.n_points, self.window_seconds)
+            df = self.select_kept(df)
+            span.record_frame(df)
+        return df
+
+    def schema_hash(self) -> str:
+        return hashlib.sha1((self.heats_query_template + self.params_text()).encode()).hexdigest()[:16]
+
+    def fit(self, X=None, y: pd.DataFrame=None, **kwargs):
+        """
+        Колонки определяются параметрами признаков, запросы к бд не нужны
+        """
+        self.time_columns = []
+        self.float_columns = [
+            name
+            for table, signals in self.signals.items()
+            for signal in signals
+            for name in series_feature_names(self.signal_prefix(table, signal), self.n_phases, self.n_points)
+        ]
+        self.int_columns = []
+        self.cat_columns = []
+
+        self.feature_columns = self.float_columns + self.int_columns + self.cat_columns
+        self.output_columns = list(self.feature_columns)
+        print("Feature columns", self.feature_columns)
+
+        return self
+
+
+def compare_backends(left, right, mode: str = 'train', rtol: float = 1e-6) -> dict:
+    """
+    Сравнение результатов запросов всех экстракторов на двух бэкендах (например, Connection и DuckDBConnection)
+
+    Возвращает словарь имя экстрактора -> None, если результаты совпадают, иначе описание расхождения
+    """
+    report = {}
+    # fit находит категории PivotFeatures, от которых зависят запросы; на каждом бэкенде свои,
+    # так что разные категории тоже попадут в расхождения
+    right_extractors = AllFeaturesExtractor(right).fit().feature_extractors
+    for name, extractor in AllFeaturesExtractor(left).fit().feature_extractors.items():
+        frames = []
+        for df in (extractor.get_df(mode), right_extractors[name].get_df(mode)):
+            # порядок строк в запросах без order by не определён, первая колонка - ключ плавки
+            frames.append(df.sort_values(df.columns[0], kind='mergesort').reset_index(drop=True))
+
+        try:
+            pd.testing.assert_frame_equal(*frames, check_dtype=False, check_categorical=False, rtol=rtol)
+            report[name] = None
+        except AssertionError as e:
+            report[name] = str(e)
+
+    return report
+
+
+def check_cache(conn, cache: FeatureCache, mode: str = 'train') -> dict:
+    """
+    Проверка, что результат каждого экстрактора переживает запись в кэш и чтение из него без изменений
+
+    Возвращает словарь имя экстрактора -> None, если результаты совпадают, иначе описание расхождения
+    """
+    report = {}
+    fe = AllFeaturesExtractor(conn).fit()
+    for name, extractor in fe.feature_extractors.items():
+        df = extractor.get_df(mode)
+        path = cache.path(f"check_{type(extractor).__name__}", mode, "roundtrip")
+        try:
+            cache.save(df, path)
+            pd.testing.assert_frame_equal(cache.load(path), df.reset_index(drop=True), check_dtype=False,
+                                          check_categorical=False)
+            report[name] = None
+        except (AssertionError, ValueError) as e:
+            report[name] = str(e)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+    return report
+
+
+def compare_transports(conn: Connection, mode: str = 'train', rtol: float = 1e-9) -> dict:
+    """
+    Сравнение результатов sql экстракторов, полученных через DBAPI и через COPY + pyarrow (Connection.read_query)
+
+    Возвращает словарь имя экстрактора -> None, если результаты совпадают, иначе описание расхождения
+    """
+    # fit находит категории PivotFeatures, от которых зависят запросы
+    fe = AllFeaturesExtractor(conn).fit()
+    extractors = dict(target=fe, **fe.feature_extractors)
+    return {
+        name: conn.compare_transports(extractor.render_query(mode), rtol=rtol)
+        for name, extractor in extractors.items() if extractor.fusable
+    }
@@ -0,0 +1,56 @@
+"""
+Предсказание по сохранённому артефакту без обучения
+
+Экстракторы получают схему из артефакта (fit не вызывается), модель загружается с отображением в память,
+catboost/lightautoml импортируются только при распаковке модели.
+
+Пример запуска:
+
+    PYTHONPATH=. python -m evraz.inference ../data/artifacts/baseline --output ../data/submissions/baseline.csv
+    PYTHONPATH=. python -m evraz.inference ../data/artifacts/baseline --backend duckdb --data-dir ../data/raw
+"""
+import argparse
+import time
+
+from evraz.artifacts import load_artifact
+from evraz.features import FeatureStore
+from evraz.settings import Connection, DuckDBConnection
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Score heats with a saved model artifact")
+    parser.add_argument("artifact", help="artifact directory written by evraz.artifacts.save_artifact")
+    parser.add_argument("--mode", default="test")
+    parser.add_argument("--output", help="csv file for predictions, printed to stdout if omitted")
+    parser.add_argument("--backend", choices=["postgres", "duckdb"], default="postgres")
+    parser.add_argument("--data-dir", default="../data/raw", help="raw files for the duckdb backend")
+    parser.add_argument("--db-name", default="lake")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--jobs", type=int, default=5)
+    parser.add_argument("--materialize", action="store_true",
+                        help="keep features in db tables, only heats scored for the first time are computed")
+    args = parser.parse_args()
+
+    start = time.time()
+    artifact = load_artifact(args.artifact)
+
+    if args.backend == "duckdb":
+        conn = DuckDBConnection(args.data_dir).open_conn().set_streaming().ping()
+    else:
+        conn = Connection(db_name=args.db_name, host=args.host, port=args.port).open_conn().set_streaming().ping()
+
+    store = FeatureStore(conn) if args.materialize else None
+    fe = artifact.build_extractor(conn, n_jobs=args.jobs, fused=True, store=store)
+    predictions = artifact.predict(fe.transform(mode=args.mode)).sort_values("NPLV")
+
+    if args.output:
+        predictions.to_csv(args.output, index=False)
+    else:
+        print(predictions.to_csv(index=False))
+
+    print(f"Scored {len(predictions)} heats in {time.time() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Быстрое сопоставление отсчётов временного ряда интервалам операций
+
+Заменяет range join вида gas."Time" between chronom."VR_NACH" and chronom."VR_KON":
+отсчёты и интервалы сортируются внутри каждой плавки, границы интервалов ищутся бинарным поиском,
+после чего агрегаты по всем операциям считаются одним векторизованным проходом.
+"""
+import hashlib
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from slugify import slugify
+
+# имя агрегата -> функция pandas; квантили считаются отдельно
+AGGREGATES: Dict[str, str] = {
+    'avg': 'mean',
+    'std': 'std',
+    'min': 'min',
+    'max': 'max',
+}
+QUANTILES: Dict[str, float] = {
+    'p10': 0.1,
+    'p90': 0.9,
+}
+
+
+def interval_join(point_keys: np.ndarray,
+                  point_times: np.ndarray,
+                  interval_keys: np.ndarray,
+                  interval_starts: np.ndarray,
+                  interval_ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Все пары (отсчёт, интервал) с совпадающим ключом и start <= time <= end.
+
+    Возвращает индексы отсчётов и интервалов в исходных массивах.
+    Результат совпадает с between join, в том числе для пересекающихся интервалов;
+    отсчёты и интервалы с пустым временем пропускаются.
+    Сложность O((n + m) log(n + m) + размер результата)
+    """
+    point_times = np.asarray(point_times, dtype='datetime64[ns]')
+    interval_starts = np.asarray(interval_starts, dtype='datetime64[ns]')
+    interval_ends = np.asarray(interval_ends, dtype='datetime64[ns]')
+
+    # ключ и время сворачиваются в одно монотонное число: ранг ключа * base + ранг времени
+    times, time_ranks = np.unique(
+        np.concatenate([point_times, interval_starts, interval_ends]), return_inverse=True)
+    _, key_ranks = np.unique(np.concatenate([point_keys, interval_keys]), return_inverse=True)
+    base = len(times) + 1
+
+    n, m = len(point_times), len(interval_starts)
+    point_comp = key_ranks[:n].astype(np.int64) * base + time_ranks[:n]
+    start_comp = key_ranks[n:].astype(np.int64) * base + time_ranks[n:n + m]
+    end_comp = key_ranks[n:].astype(np.int64) * base + time_ranks[n + m:]
+
+    valid_points = ~np.isnat(point_times)
+    valid_intervals = ~(np.isnat(interval_starts) | np.isnat(interval_ends))
+
+    order = np.flatnonzero(valid_points)
+    order = order[np.argsort(point_comp[order], kind='stable')]
+    sorted_comp = point_comp[order]
+
+    lo = np.searchsorted(sorted_comp, start_comp, side='left')
+    hi = np.searchsorted(sorted_comp, end_comp, side='right')
+    counts = np.where(valid_intervals, np.maximum(hi - lo, 0), 0)
+
+    # развёртка диапазонов [lo, hi) в плоский массив позиций
+    interval_idx = np.repeat(np.arange(m), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    point_idx = order[np.repeat(lo, counts) + offsets]
+
+    return point_idx, interval_idx
+
+
+def unique_slugs(values: Sequence[str]) -> Dict[str, str]:
+    """
+    Значение -> slug для имени колонки.
+
+    Значения с одинаковым slug (например, различающиеся только регистром или знаками препинания)
+    все получают суффикс из хэша значения, так что имена уникальны и не зависят от порядка значений
+    """
+    slugs = {value: slugify(value, separator='_') for value in values}
+    counts = Counter(slugs.values())
+    return {
+        value: slug if counts[slug] == 1 else f"{slug}_{hashlib.sha1(value.encode()).hexdigest()[:6]}"
+        for value, slug in slugs.items()
+    }
+
+
+def feature_name(aggregate: str, signal: str, operation: str, slugs: Optional[Dict[str, str]] = None) -> str:
+    """
+    slugs - slug операций (unique_slugs всех операций), без него slug считается по одной операции
+    """
+    operation_slug = slugs[operation] if slugs is not None else slugify(operation, separator='_')
+    return f"{aggregate}_{slugify(signal, separator='_')}_{operation_slug}"
+
+
+def operation_aggregates(points: pd.DataFrame,
+                         intervals: pd.DataFrame,
+                         signals: Sequence[str],
+                         operations: Sequence[str],
+                         key: str = 'NPLV',
+                         time: str = 'Time',
+                         operation: str = 'NOP',
+                         start: str = 'VR_NACH',
+                         end: str = 'VR_KON',
+                         slugs: Optional[Dict[str, str]] = None) -> pd.DataFrame:
+    """
+    Агрегаты сигналов signals по каждой операции из operations для каждой плавки.
+
+    Колонки результата: key и {агрегат}_{сигнал}_{операция} в фиксированном порядке,
+    операции, которых нет в operations, отбрасываются.
+    slugs - slug операций, если operations - часть полного списка (по умолчанию unique_slugs(operations))
+    """
+    slugs = unique_slugs(operations) if slugs is None else slugs
+    point_idx, interval_idx = interval_join(
+        points[key].to_numpy(), points[time].to_numpy(),
+        intervals[key].to_numpy(), intervals[start].to_numpy(), intervals[end].to_numpy())
+
+    joined = pd.DataFrame({
+        key: points[key].to_numpy()[point_idx],
+        operation: intervals[operation].to_numpy()[interval_idx],
+        **{signal: points[signal].to_numpy()[point_idx] for signal in signals}
+    })
+    joined = joined[joined[operation].isin(operations)]
+    if joined.empty:
+        # типы как у непустого результата: целый ключ и float64 признаки
+        return pd.DataFrame({
+            key: pd.Series(dtype=np.int64),
+            **{name: pd.Series(dtype=np.float64) for name in feature_names(signals, operations, slugs)},
+        })
+
+    grouped = joined.groupby([key, operation], sort=False)[list(signals)]
+    stats = {name: grouped.agg(func) for name, func in AGGREGATES.items()}
+    stats.update({name: grouped.quantile(q) for name, q in QUANTILES.items()})
+
+    columns = {}
+    for name, frame in stats.items():
+        wide = frame.unstack(operation)
+        for signal in signals:
+            for op in operations:
+                values = wide[(signal, op)] if (signal, op) in wide.columns else np.nan
+                columns[feature_name(name, signal, op, slugs)] = values
+
+    index = pd.Index(np.unique(joined[key].to_numpy()), name=key)
+    df = pd.DataFrame({name: columns[name] for name in feature_names(signals, operations, slugs)}, index=index)
+
+    return df.reset_index()
+
+
+def feature_names(signals: Sequence[str],
+                  operations: Sequence[str],
+                  slugs: Optional[Dict[str, str]] = None) -> List[str]:
+    """
+    Порядок колонок, который возвращает operation_aggregates
+    """
+    slugs = unique_slugs(operations) if slugs is None else slugs
+    return [
+        feature_name(name, signal, op, slugs)
+        for signal in signals
+        for op in operations
+        for name in list(AGGREGATES) + list(QUANTILES)
+    ]
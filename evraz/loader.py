@@ -0,0 +1,148 @@
+"""
+Загрузка сырых csv в postgres через COPY FROM STDIN
+
+Пример запуска:
+
+    PYTHONPATH=. python -m evraz.loader ../data/raw --db-name lake --jobs 4
+"""
+import argparse
+import csv
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from string import ascii_lowercase
+from typing import Dict, List, Optional
+
+from evraz.settings import Connection, quote_ident
+
+
+def table_name(path: str) -> str:
+    """
+    Имя таблицы совпадает с именем файла без расширения
+    """
+    return os.path.basename(path).split('.csv')[0]
+
+
+def column_names(header: List[str]) -> List[str]:
+    """
+    Имена колонок из заголовка csv.
+
+    Пустые имена заменяются буквами по позиции, как это делает csvsql
+    (поэтому безымянный индекс в chronom превращается в колонку a)
+    """
+    return [
+        name if name.strip() else ascii_lowercase[i % len(ascii_lowercase)]
+        for i, name in enumerate(header)
+    ]
+
+
+class ProgressReader:
+    """
+    Файл для copy_expert: отдаёт сырые байты без разбора csv и печатает прогресс после каждого куска
+    """
+    def __init__(self, f, table: str, start: float):
+        self.f = f
+        self.table = table
+        self.start = start
+        self.bytes = 0
+        self.lines = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.f.read(size)
+        if data:
+            self.bytes += len(data)
+            self.lines += data.count(b"\n")
+            elapsed = max(time.time() - self.start, 1e-9)
+            print(f"{self.table}: {self.bytes / 2 ** 20:.0f} Mb, ~{self.lines} rows, {self.lines / elapsed:.0f} rows/s")
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        return self.f.readline(size)
+
+
+def copy_csv(conn: Connection,
+             path: str,
+             table: Optional[str] = None,
+             chunk_size: int = 8 * 2 ** 20,
+             truncate: bool = False) -> int:
+    """
+    Потоковая загрузка одного csv в таблицу через COPY FROM STDIN.
+
+    Из файла разбирается только заголовок, остальное отправляется в COPY как есть кусками по chunk_size байт.
+    Загрузка (вместе с TRUNCATE) идёт одной транзакцией: при ошибке таблица остаётся в прежнем состоянии
+    """
+    table = table or table_name(path)
+    start = time.time()
+
+    raw_conn = conn.conn.raw_connection()
+    try:
+        with open(path, 'rb') as f:
+            header = next(csv.reader([f.readline().decode('utf-8')]))
+            columns = ", ".join(quote_ident(name) for name in column_names(header))
+            statement = f"COPY {quote_ident(table)} ({columns}) FROM STDIN WITH (FORMAT csv, ENCODING 'UTF8')"
+
+            reader = ProgressReader(f, table, start)
+            with raw_conn.cursor() as cursor:
+                if truncate:
+                    cursor.execute(f"TRUNCATE {quote_ident(table)}")
+                cursor.copy_expert(statement, reader, size=chunk_size)
+                # COPY возвращает число загруженных строк, число переводов строк - оценка на случай его отсутствия
+                rows = cursor.rowcount if cursor.rowcount >= 0 else reader.lines
+            raw_conn.commit()
+    except Exception:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+
+    elapsed = time.time() - start
+    print(f"{table}: loaded {rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)")
+
+    return rows
+
+
+def load_dir(conn: Connection,
+             data_dir: str,
+             n_jobs: int = 4,
+             chunk_size: int = 8 * 2 ** 20,
+             truncate: bool = False) -> Dict[str, int]:
+    """
+    Загрузка всех csv из data_dir, n_jobs таблиц параллельно.
+
+    Самые большие файлы (gas, produv) отправляются первыми, чтобы не ждать их в конце
+    """
+    paths = sorted(glob(os.path.join(data_dir, "*.csv")), key=os.path.getsize, reverse=True)
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {
+            table_name(path): executor.submit(copy_csv, conn, path, chunk_size=chunk_size, truncate=truncate)
+            for path in paths
+        }
+        loaded = {table: future.result() for table, future in futures.items()}
+
+    elapsed = time.time() - start
+    total = sum(loaded.values())
+    print(f"Loaded {len(loaded)} tables, {total} rows in {elapsed:.1f}s ({total / max(elapsed, 1e-9):.0f} rows/s)")
+
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk load raw csv files into postgres with COPY")
+    parser.add_argument("data_dir")
+    parser.add_argument("--db-name", default="lake")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--chunk-size", type=int, default=8 * 2 ** 20, help="bytes sent to COPY at a time")
+    parser.add_argument("--truncate", action="store_true", help="truncate tables before loading")
+    args = parser.parse_args()
+
+    conn = Connection(db_name=args.db_name, host=args.host, port=args.port).open_conn().ping()
+    load_dir(conn, args.data_dir, n_jobs=args.jobs, chunk_size=args.chunk_size, truncate=args.truncate)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,30 @@ import pandas as pd
 import numpy as np
 from sklearn.base import BaseEstimator
 
+# allowed absolute error of each target
+THRESHOLDS = {
+    'TST': 20,
+    'C': 0.02,
+}
+
+
+def hit_rate(y_test, y_pred, target: str) -> float:
+    """
+    Share of predictions of one target within its threshold
+    """
+    delta = np.abs(np.array(y_test[target]) - np.array(y_pred[target]))
+    return np.mean(delta < THRESHOLDS[target])
+
 
 def metric(y_test, y_pred):
     """
     Business metrics
     """
     delta_c = np.abs(np.array(y_test['C']) - np.array(y_pred['C']))
-    hit_rate_c = np.int64(delta_c < 0.02)
+    hit_rate_c = np.int64(delta_c < THRESHOLDS['C'])
 
     delta_t = np.abs(np.array(y_test['TST']) - np.array(y_pred['TST']))
-    hit_rate_t = np.int64(delta_t < 20)
+    hit_rate_t = np.int64(delta_t < THRESHOLDS['TST'])
 
     n_samples = np.size(y_test['C'])
 
@@ -1,18 +1,144 @@
-from typing import Tuple, Optional, Sequence
+"""
+Модели
+
+catboost и lightautoml импортируются при создании модели, а не при импорте модуля,
+поэтому загрузка модуля (и сохранённых артефактов, см. evraz.artifacts) не тянет за собой тяжёлые библиотеки
+"""
+import os
+import shutil
+import tempfile
+import weakref
+from typing import TYPE_CHECKING, Dict, Tuple, Optional, Sequence
 
 from sklearn.base import BaseEstimator, RegressorMixin
-from catboost import CatBoostRegressor
+import numpy as np
 import pandas as pd
-from lightautoml.automl.presets.tabular_presets import TabularAutoML
-from lightautoml.tasks import Task
 
 from evraz.metrics import metric
+from evraz.tracing import get_tracer
+
+if TYPE_CHECKING:
+    from catboost import Pool
+
+
+class QuantizedDataset:
+    """
+    Квантованная матрица признаков, общая для обоих таргетов и всех фолдов
+
+    Границы бинов считаются один раз по всей матрице X, пул для каждой разметки
+    (TST, C или обе сразу для multi-target) квантуется по этим границам один раз,
+    а обучающие выборки фолдов получаются срезом готового пула без повторного квантования.
+    Строки выборки ищутся по индексу X, поэтому модели можно передавать обычные срезы датафрейма.
+
+    Пулы catboost не сериализуются, поэтому в другой процесс (evraz.cv.cross_validate_parallel)
+    передаются готовые границы бинов: процесс квантует свой пул по ним, не пересчитывая границы по всей матрице
+    """
+    def __init__(self,
+                 X: pd.DataFrame,
+                 y: pd.DataFrame,
+                 cat_features: Optional[Sequence[str]] = None,
+                 border_count: int = 254):
+        self.X = X
+        self.y = y
+        self.cat_features = (
+            list(X.select_dtypes(include=['category', 'object']).columns)
+            if cat_features is None else list(cat_features)
+        )
+        self.border_count = border_count
+
+        # параметры стандартизации таргетов для multi-target режима
+        self.label_mean = y.mean()
+        self.label_std = y.std().replace(0, 1)
+
+        self._borders_path = None
+        self._pools = {}
+
+    def positions(self, X: pd.DataFrame) -> np.ndarray:
+        positions = self.X.index.get_indexer(X.index)
+        if (positions < 0).any():
+            raise ValueError("X contains rows which are not present in the quantized dataset")
+        return positions
+
+    def standardized(self, targets: Sequence[str]) -> pd.DataFrame:
+        return (self.y[targets] - self.label_mean[targets]) / self.label_std[targets]
+
+    def pool(self, targets: Sequence[str]) -> 'Pool':
+        """
+        Квантованный пул всей матрицы с разметкой targets (несколько таргетов стандартизуются)
+        """
+        from catboost import Pool
+
+        key = tuple(targets)
+        if key not in self._pools:
+            label = self.y[targets[0]] if len(targets) == 1 else self.standardized(targets)
+            pool = Pool(self.X, label=label, cat_features=self.cat_features)
+
+            if self._borders_path is None:
+                pool.quantize(border_count=self.border_count)
+                self._borders_path = self.borders_file()
+                pool.save_quantization_borders(self._borders_path)
+            else:
+                pool.quantize(input_borders=self._borders_path)
+
+            self._pools[key] = pool
+
+        return self._pools[key]
+
+    def subset(self, X: pd.DataFrame, targets: Sequence[str]) -> 'Pool':
+        return self.pool(targets).slice(self.positions(X))
+
+    def borders_file(self) -> str:
+        """
+        Путь файла границ во временной директории, которая удаляется вместе с датасетом
+        """
+        directory = tempfile.mkdtemp(prefix='evraz_borders_')
+        weakref.finalize(self, shutil.rmtree, directory, ignore_errors=True)
+        return os.path.join(directory, 'borders.tsv')
+
+    def borders(self) -> str:
+        """
+        Границы бинов в формате save_quantization_borders; считаются при первом обращении
+        """
+        if self._borders_path is None:
+            self.pool(self.targets[:1])
+        with open(self._borders_path) as f:
+            return f.read()
+
+    @property
+    def targets(self) -> list:
+        return list(self.y.columns)
+
+    def __getstate__(self):
+        # вместо пулов передаются границы: в процессе пул квантуется по ним без повторного подсчёта
+        state = self.__dict__.copy()
+        state['_borders_path'] = None
+        state['_pools'] = {}
+        state['_borders'] = self.borders()
+        return state
+
+    def __setstate__(self, state):
+        borders = state.pop('_borders', None)
+        self.__dict__.update(state)
+        if borders is not None:
+            self._borders_path = self.borders_file()
+            with open(self._borders_path, 'w') as f:
+                f.write(borders)
+
+    def __deepcopy__(self, memo):
+        # датасет только читается, поэтому клоны моделей (sklearn.clone) используют один и тот же кэш пулов
+        return self
 
 
 class BaselineModel(RegressorMixin, BaseEstimator):
     """Модель регрессии сразу двух параметров
 
-    Простейшая модель, которая использует CatBoost регрессора для каждой из двух переменной
+    Простейшая модель, которая использует CatBoost регрессора для каждой из двух переменной.
+
+    dataset - общий QuantizedDataset, из которого берутся уже квантованные обучающие выборки,
+    multi_target - одна модель MultiRMSE на стандартизованные TST и C вместо двух отдельных,
+    target_params - параметры отдельных таргетов поверх model_params, например найденные evraz.tuning.
+
+    base_parameters - значения по умолчанию, параметры из model_params их перекрывают
     """
     base_parameters = {
         'random_state': 42,
@@ -21,35 +147,147 @@ class BaselineModel(RegressorMixin, BaseEstimator):
         'iterations': 1000
     }
 
-    def __init__(self, model_params: dict):
+    multi_target_parameters = {
+        'loss_function': 'MultiRMSE',
+        'eval_metric': 'MultiRMSE',
+    }
+
+    targets = ['TST', 'C']
+
+    def __init__(self,
+                 model_params: dict,
+                 multi_target: bool = False,
+                 dataset: Optional[QuantizedDataset] = None,
+                 target_params: Optional[Dict[str, dict]] = None):
+        from catboost import CatBoostRegressor
+
         self.model_params = model_params
-        self.model_params.update(self.base_parameters)
+        for name, value in self.base_parameters.items():
+            self.model_params.setdefault(name, value)
+        self.multi_target = multi_target
+        self.dataset = dataset
+        self.target_params = target_params
+
+        if self.multi_target:
+            self.model = CatBoostRegressor(**dict(self.model_params, **self.multi_target_parameters))
+            self.label_mean = None
+            self.label_std = None
+        else:
+            self.model_t = CatBoostRegressor(**self.params_for('TST'))
+            self.model_c = CatBoostRegressor(**self.params_for('C'))
+            self.models = {'TST': self.model_t, 'C': self.model_c}
+
+    def is_fitted(self) -> bool:
+        models = [self.model] if self.multi_target else self.models.values()
+        return any(model.is_fitted() for model in models)
+
+    def __getstate__(self):
+        # датасет нужен только для обучения: обученная модель (в артефакте или вернувшаяся
+        # из процесса кросс-валидации) сериализуется без копии обучающей выборки
+        state = super().__getstate__()
+        if self.is_fitted():
+            state['dataset'] = None
+        return state
 
-        self.model_t = CatBoostRegressor(**self.model_params)
-        self.model_c = CatBoostRegressor(**self.model_params)
+    def params_for(self, target: str) -> dict:
+        """
+        Параметры модели одного таргета
+        """
+        return dict(self.model_params, **(self.target_params or {}).get(target, {}))
 
     def fit(self,
             X: pd.DataFrame,
             y: pd.DataFrame,
             eval_set: Optional[Sequence[Tuple[pd.DataFrame, pd.DataFrame]]] = None,
             **kwargs):
-        self.model_t.fit(X, y['TST'],
-                         eval_set=[(features, target['TST']) for features, target in eval_set],
-                         **kwargs)
-        self.model_c.fit(X, y['C'],
-                         eval_set=[(features, target['C']) for features, target in eval_set],
-                         **kwargs)
+        if self.multi_target:
+            return self.fit_multi_target(X, y, eval_set=eval_set, **kwargs)
+
+        for target in self.targets:
+            self.fit_target(X, y, target, eval_set=eval_set, **kwargs)
+        return self
+
+    def fit_target(self,
+                   X: pd.DataFrame,
+                   y: pd.DataFrame,
+                   target: str,
+                   eval_set: Optional[Sequence[Tuple[pd.DataFrame, pd.DataFrame]]] = None,
+                   **kwargs):
+        """
+        Обучение модели одной целевой переменной
+        """
+        if eval_set is not None:
+            kwargs['eval_set'] = [(features, labels[target]) for features, labels in eval_set]
+
+        with get_tracer().span(f"{type(self).__name__}.fit", kind="model", target=target) as span:
+            if self.dataset is not None:
+                self.models[target].fit(self.dataset.subset(X, [target]), **kwargs)
+            else:
+                self.models[target].fit(X, y[target], **kwargs)
+            span.record_frame(X)
+        return self
+
+    def fit_multi_target(self,
+                         X: pd.DataFrame,
+                         y: pd.DataFrame,
+                         eval_set: Optional[Sequence[Tuple[pd.DataFrame, pd.DataFrame]]] = None,
+                         **kwargs):
+        """
+        Обучение одной модели сразу на оба таргета.
+
+        Таргеты стандартизуются, чтобы TST (~1600) не перевешивал C (~0.05) в MultiRMSE
+        """
+        if self.dataset is not None:
+            self.label_mean = self.dataset.label_mean[self.targets]
+            self.label_std = self.dataset.label_std[self.targets]
+        else:
+            self.label_mean = y[self.targets].mean()
+            self.label_std = y[self.targets].std().replace(0, 1)
+
+        if eval_set is not None:
+            kwargs['eval_set'] = [
+                (features, (labels[self.targets] - self.label_mean) / self.label_std)
+                for features, labels in eval_set
+            ]
+
+        with get_tracer().span(f"{type(self).__name__}.fit", kind="model", target="all") as span:
+            if self.dataset is not None:
+                self.model.fit(self.dataset.subset(X, self.targets), **kwargs)
+            else:
+                self.model.fit(X, (y[self.targets] - self.label_mean) / self.label_std, **kwargs)
+            span.record_frame(X)
         return self
 
+    def predict_target(self, X: pd.DataFrame, target: str) -> np.ndarray:
+        if self.multi_target:
+            return self.predict(X)[target].to_numpy()
+        with get_tracer().span(f"{type(self).__name__}.predict", kind="model", target=target) as span:
+            predictions = self.models[target].predict(X)
+            span.record_frame(X)
+        return predictions
+
     def predict(self,
                 X: pd.DataFrame):
-        t_predictions = self.model_t.predict(X)
-        c_predictions = self.model_c.predict(X)
+        if self.multi_target:
+            with get_tracer().span(f"{type(self).__name__}.predict", kind="model", target="all") as span:
+                predictions = self.model.predict(X) * self.label_std.to_numpy() + self.label_mean.to_numpy()
+                span.record_frame(X)
+            return pd.DataFrame(predictions, columns=self.targets)
+
         return pd.DataFrame.from_dict({
-            'TST': t_predictions,
-            'C': c_predictions
+            target: self.predict_target(X, target) for target in self.targets
         })
 
+    def with_resources(self, cpu_limit: int, memory_limit: Optional[float] = None):
+        """
+        Копия модели с ограничением на число потоков и память (Гб)
+        """
+        model_params = dict(self.model_params, thread_count=cpu_limit)
+        if memory_limit is not None:
+            model_params['used_ram_limit'] = f"{memory_limit:.1f}gb"
+        return type(self)(model_params, multi_target=self.multi_target, dataset=self.dataset,
+                          target_params=self.target_params)
+
     def eval_metric(self, X, y):
         y_pred = self.predict(X)
         return {
@@ -61,38 +299,72 @@ class LightAutoMLModel(RegressorMixin, BaseEstimator):
     """
     Обертка над двумя моделями LightAutoML
     """
-    def __init__(self, automl_params: dict, verbose: int = 1):
+    targets = ['TST', 'C']
+
+    def __init__(self, automl_params: dict, verbose: int = 1, cpu_limit: int = 4, memory_limit: float = 5):
+        from lightautoml.automl.presets.tabular_presets import TabularAutoML
+        from lightautoml.tasks import Task
+
         self.automl_params = automl_params
+        self.cpu_limit = cpu_limit
+        self.memory_limit = memory_limit
 
         self.model_t = TabularAutoML(
             task=Task('reg', loss='mse'),
-            cpu_limit=4,
-            memory_limit=5,
+            cpu_limit=self.cpu_limit,
+            memory_limit=self.memory_limit,
             **self.automl_params
         )
         self.model_c = TabularAutoML(
             task=Task('reg', loss='mse'),
-            cpu_limit=4,
-            memory_limit=5,
+            cpu_limit=self.cpu_limit,
+            memory_limit=self.memory_limit,
             **self.automl_params
         )
+        self.models = {'TST': self.model_t, 'C': self.model_c}
 
         self.verbose = verbose
 
     def fit(self, X: pd.DataFrame, y: pd.DataFrame):
+        for target in self.targets:
+            self.fit_target(X, y, target)
+
+        return self
+
+    def fit_target(self, X: pd.DataFrame, y: pd.DataFrame, target: str):
+        """
+        Обучение модели одной целевой переменной, остальные таргеты выбрасываются
+        """
         df = pd.concat([X, y], axis=1)
-        print("Start fitting TST model")
-        self.model_t.fit_predict(df, roles={'target': 'TST', 'drop': 'C'}, verbose=self.verbose)
-        print("Start fitting C model")
-        self.model_c.fit_predict(df, roles={'target': 'C', 'drop': 'TST'}, verbose=self.verbose)
+        print(f"Start fitting {target} model")
+        with get_tracer().span(f"{type(self).__name__}.fit", kind="model", target=target) as span:
+            self.models[target].fit_predict(
+                df,
+                roles={'target': target, 'drop': [t for t in self.targets if t != target]},
+                verbose=self.verbose
+            )
+            span.record_frame(X)
 
         return self
 
-    def predict(self, X: pd.DataFrame) -> pd.DataFrame:
-        t = self.model_t.predict(X).data[:, 0]
-        c = self.model_c.predict(X).data[:, 0]
+    def predict_target(self, X: pd.DataFrame, target: str) -> np.ndarray:
+        with get_tracer().span(f"{type(self).__name__}.predict", kind="model", target=target) as span:
+            predictions = self.models[target].predict(X).data[:, 0]
+            span.record_frame(X)
+        return predictions
 
+    def predict(self, X: pd.DataFrame) -> pd.DataFrame:
         return pd.DataFrame.from_dict({
-            'TST': t,
-            'C': c
+            target: self.predict_target(X, target) for target in self.targets
         })
+
+    def with_resources(self, cpu_limit: int, memory_limit: Optional[float] = None):
+        """
+        Копия модели с ограничением на число потоков и память (Гб)
+        """
+        return type(self)(
+            self.automl_params,
+            verbose=self.verbose,
+            cpu_limit=cpu_limit,
+            memory_limit=self.memory_limit if memory_limit is None else memory_limit
+        )
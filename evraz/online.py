@@ -0,0 +1,410 @@
+"""
+Инкрементальный расчёт признаков для плавки в процессе
+
+Пакетные экстракторы считают признаки после окончания плавки. Здесь те же аггрегаты
+обновляются за O(1) на каждое событие из потоков gas, chronom, sip и lom:
+min/max/avg/std по формулам Уэлфорда, счётчики и суммы, а персентили - скетчем P^2.
+Вектор признаков можно получить в любой момент, не перечитывая историю плавки.
+
+Имена признаков совпадают с GasRawFeatures, ChronomPivotFeatures, SipPivotFeatures, LomPivotFeatures
+и GasOperationFeatures, категории и операции берутся из обученного AllFeaturesExtractor
+(OnlineFeatureEngine.from_extractor), совпадение имён проверяет compare_feature_names.
+Время окончания плавки онлайн неизвестно, поэтому учитываются все пришедшие события.
+"""
+import math
+from typing import Dict, Iterable, List, Optional, Sequence, Type
+
+import numpy as np
+import pandas as pd
+
+from evraz.features import (AllFeaturesExtractor, ChronomPivotFeatures, GasRawFeatures, LomPivotFeatures,
+                            PivotFeatures, SipPivotFeatures)
+from evraz.intervals import feature_name, unique_slugs
+
+# экстрактор AllFeaturesExtractor -> класс, признаки которого считаются онлайн
+PIVOT_EXTRACTORS: Dict[str, Type[PivotFeatures]] = {
+    'chronom_fe': ChronomPivotFeatures,
+    'sip_fe': SipPivotFeatures,
+    'lom_fe': LomPivotFeatures,
+}
+ONLINE_EXTRACTORS = ['gas_fe', 'gas_op_fe'] + list(PIVOT_EXTRACTORS)
+
+
+class RunningStats:
+    """
+    Количество, сумма, min, max, среднее и выборочное std за O(1) на значение (алгоритм Уэлфорда)
+    """
+    __slots__ = ('count', 'sum', 'min', 'max', 'mean', 'm2')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.nan
+        self.max = math.nan
+        self.mean = math.nan
+        self.m2 = 0.0
+
+    def update(self, x: float):
+        if x is None or x != x:
+            return
+
+        self.count += 1
+        self.sum += x
+        if self.count == 1:
+            self.min = self.max = self.mean = x
+            return
+
+        self.min = min(self.min, x)
+        self.max = max(self.max, x)
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def std(self) -> float:
+        # как stddev в postgres: null для одного значения
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else math.nan
+
+
+class P2Quantile:
+    """
+    Потоковая оценка квантиля p алгоритмом P^2 (Jain, Chlamtac): пять маркеров, O(1) памяти и времени
+
+    Пока значений не больше пяти, квантиль считается точно с линейной интерполяцией, как percentile_cont
+    """
+    __slots__ = ('p', 'heights', 'positions', 'desired', 'increments')
+
+    def __init__(self, p: float):
+        self.p = p
+        self.heights: List[float] = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def update(self, x: float):
+        if x is None or x != x:
+            return
+
+        q = self.heights
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if q[i] <= x < q[i + 1])
+
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                candidate = self.parabolic(i, d)
+                if q[i - 1] < candidate < q[i + 1]:
+                    q[i] = candidate
+                else:
+                    q[i] = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                n[i] += d
+
+    def parabolic(self, i: int, d: int) -> float:
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    @property
+    def value(self) -> float:
+        if not self.heights:
+            return math.nan
+        if self.positions[4] <= 5:
+            return float(np.quantile(self.heights, self.p))
+        return self.heights[2]
+
+
+class OperationStats:
+    """
+    Аггрегаты сигнала за время одной операции: avg, std, min, max и персентили, как в GasOperationFeatures
+    """
+    __slots__ = ('stats', 'p10', 'p90')
+
+    def __init__(self):
+        self.stats = RunningStats()
+        self.p10 = P2Quantile(0.1)
+        self.p90 = P2Quantile(0.9)
+
+    def update(self, x: float):
+        self.stats.update(x)
+        self.p10.update(x)
+        self.p90.update(x)
+
+    def features(self) -> Dict[str, float]:
+        return {
+            'avg': self.stats.mean,
+            'std': self.stats.std,
+            'min': self.stats.min,
+            'max': self.stats.max,
+            'p10': self.p10.value,
+            'p90': self.p90.value,
+        }
+
+
+def duration(start, end, unit: str) -> int:
+    """
+    Длительность как datediff_minutes/datediff_seconds
+    """
+    seconds = (pd.Timestamp(end) - pd.Timestamp(start)).total_seconds()
+    return math.trunc(seconds / 60) if unit == 'min' else round(seconds)
+
+
+class PivotState:
+    """
+    Аггрегаты значения по категориям, итоги по всем строкам и первая/последняя категория, как в PivotFeatures
+    """
+
+    def __init__(self, extractor_class: Type[PivotFeatures], categories: Sequence[str]):
+        self.extractor_class = extractor_class
+        self.slugs = unique_slugs(categories)
+        self.stats = {category: RunningStats() for category in categories}
+        self.totals = {name: 0.0 for name in extractor_class.totals}
+        self.first = (None, None)
+        self.last = (None, None)
+
+    def update(self, category: str, value: float, time=None, totals: Optional[Dict[str, float]] = None):
+        if category in self.stats:
+            self.stats[category].update(value)
+        for name, increment in (totals or {}).items():
+            self.totals[name] += 0.0 if increment is None or increment != increment else increment
+
+        if time is not None:
+            if self.first[0] is None or time < self.first[0]:
+                self.first = (time, category)
+            if self.last[0] is None or time > self.last[0]:
+                self.last = (time, category)
+
+    def features(self) -> Dict[str, object]:
+        extractor_class = self.extractor_class
+        features = {}
+        for category, stats in self.stats.items():
+            values = {
+                'cnt': stats.count,
+                'sum': stats.sum,
+                'avg': stats.mean if stats.count else 0.0,
+                'std': 0.0 if math.isnan(stats.std) else stats.std,
+            }
+            for aggregate in extractor_class.aggregates:
+                features[extractor_class.column_name(category, aggregate, self.slugs)] = values[aggregate]
+        for name, value in self.totals.items():
+            features[f"{extractor_class.prefix}_{name}"] = value
+        if extractor_class.order_column is not None:
+            features[f"{extractor_class.prefix}_first"] = self.first[1]
+            features[f"{extractor_class.prefix}_last"] = self.last[1]
+        return features
+
+
+class HeatState:
+    """
+    Состояние признаков одной плавки
+    """
+
+    def __init__(self, operations: Sequence[str], signals: Sequence[str], categories: Dict[str, Sequence[str]]):
+        self.operations = list(operations)
+        self.signals = list(signals)
+        self.slugs = unique_slugs(self.operations)
+
+        self.gas = {signal: RunningStats() for signal in GasRawFeatures.signals}
+        self.operation_stats = {(signal, op): OperationStats() for signal in self.signals for op in self.operations}
+        # операции из self.operations, которые идут сейчас: (NOP, VR_NACH) -> VR_KON (None, пока не закончилась)
+        self.active = {}
+
+        self.pivots = {
+            name: PivotState(extractor_class, categories.get(extractor_class.table, []))
+            for name, extractor_class in PIVOT_EXTRACTORS.items()
+        }
+
+    def update_gas(self, event: dict):
+        time = pd.Timestamp(event['Time'])
+        for signal, stats in self.gas.items():
+            stats.update(event.get(signal))
+
+        expired = []
+        for (op, start), end in self.active.items():
+            if end is not None and end < time:
+                # отсчёты приходят по времени, закончившаяся операция больше не получит значений
+                expired.append((op, start))
+            elif start <= time:
+                for signal in self.signals:
+                    self.operation_stats[(signal, op)].update(event.get(signal))
+        for key in expired:
+            del self.active[key]
+
+    def update_chronom(self, event: dict):
+        """
+        Операция может прийти дважды: при начале (VR_KON пустой) и при окончании.
+        В аггрегаты попадают только законченные операции (в бд отбрасываются строки без VR_KON)
+        """
+        nop = event['NOP']
+        start = pd.Timestamp(event['VR_NACH'])
+        end = event.get('VR_KON')
+        end = None if end is None or pd.isna(end) else pd.Timestamp(end)
+
+        if nop in self.operations:
+            self.active[(nop, start)] = end
+
+        if end is None:
+            return
+
+        self.pivots['chronom_fe'].update(nop, duration(start, end, 'sec'), start, totals={'o2_sum': event.get('O2')})
+
+    def update_sip(self, event: dict):
+        self.pivots['sip_fe'].update(event['NMSYP'], event['VSSYP'], pd.Timestamp(event['DAT_OTD']))
+
+    def update_lom(self, event: dict):
+        self.pivots['lom_fe'].update(event['NML'], event['VES'], totals={'ves_sum': event['VES']})
+
+    def features_by_extractor(self) -> Dict[str, Dict[str, object]]:
+        """
+        Признаки, сгруппированные по экстракторам AllFeaturesExtractor, которые они повторяют
+        """
+        gas = {}
+        for signal, stats in self.gas.items():
+            values = {'min': stats.min, 'max': stats.max, 'avg': stats.mean, 'srd': stats.std}
+            for prefix in GasRawFeatures.aggregates:
+                gas[f"{prefix}_{signal.lower()}"] = values[prefix]
+
+        gas_op = {}
+        for signal in self.signals:
+            for op in self.operations:
+                for name, value in self.operation_stats[(signal, op)].features().items():
+                    gas_op[feature_name(name, signal, op, self.slugs)] = value
+
+        return {
+            'gas_fe': gas,
+            'gas_op_fe': gas_op,
+            **{name: pivot.features() for name, pivot in self.pivots.items()},
+        }
+
+    def features(self) -> Dict[str, object]:
+        features = {}
+        for extractor_features in self.features_by_extractor().values():
+            features.update(extractor_features)
+        return features
+
+
+class OnlineFeatureEngine:
+    """
+    Признаки для плавок в процессе по потокам событий gas, chronom, sip и lom
+
+    События - словари с полями одноимённых таблиц
+    (NPLV, Time, T, ... / NOP, VR_NACH, VR_KON, O2 / NMSYP, VSSYP, DAT_OTD / NML, VES).
+    operations - операции, для которых считаются аггрегаты газа (например, GasOperationFeatures.operations после fit),
+    categories - таблица -> категории PivotFeatures после fit ('chronom', 'sip', 'lom').
+    Отсчёты газа приписываются операциям, начало которых уже пришло из chronom
+    """
+
+    def __init__(self,
+                 operations: Sequence[str] = ('Продувка',),
+                 signals: Sequence[str] = ('T',),
+                 categories: Optional[Dict[str, Sequence[str]]] = None):
+        self.operations = list(operations)
+        self.signals = list(signals)
+        self.categories = {table: list(values) for table, values in (categories or {}).items()}
+        self.heats: Dict[int, HeatState] = {}
+
+    @classmethod
+    def from_extractor(cls, fe: AllFeaturesExtractor):
+        """
+        Движок с операциями и категориями обученного AllFeaturesExtractor (в том числе загруженного из схемы)
+        """
+        extractors = dict(fe.feature_extractors, **fe.pruned_extractors)
+        gas_op = extractors['gas_op_fe']
+        return cls(
+            operations=gas_op.operations,
+            signals=gas_op.signals,
+            categories={extractors[name].table: extractors[name].categories for name in PIVOT_EXTRACTORS},
+        )
+
+    def heat(self, nplv: int) -> HeatState:
+        if nplv not in self.heats:
+            self.heats[nplv] = HeatState(self.operations, self.signals, self.categories)
+        return self.heats[nplv]
+
+    def update_gas(self, event: dict):
+        self.heat(event['NPLV']).update_gas(event)
+        return self
+
+    def update_chronom(self, event: dict):
+        self.heat(event['NPLV']).update_chronom(event)
+        return self
+
+    def update_sip(self, event: dict):
+        self.heat(event['NPLV']).update_sip(event)
+        return self
+
+    def update_lom(self, event: dict):
+        self.heat(event['NPLV']).update_lom(event)
+        return self
+
+    def update(self, source: str, event: dict):
+        """
+        Обработка события из потока source: 'gas', 'chronom', 'sip' или 'lom'
+        """
+        handlers = {'gas': self.update_gas, 'chronom': self.update_chronom, 'sip': self.update_sip,
+                    'lom': self.update_lom}
+        if source not in handlers:
+            raise TypeError(f"source must be one of {list(handlers)}, got {source}")
+        return handlers[source](event)
+
+    def finish(self, nplv: int) -> Optional[Dict[str, object]]:
+        """
+        Признаки закончившейся плавки; состояние плавки освобождается
+        """
+        state = self.heats.pop(nplv, None)
+        return None if state is None else state.features()
+
+    def features(self, nplv: int) -> Dict[str, object]:
+        return self.heat(nplv).features()
+
+    def to_frame(self, nplvs: Optional[Iterable[int]] = None) -> pd.DataFrame:
+        """
+        Текущие признаки плавок nplvs (по умолчанию всех открытых) в виде датафрейма с колонкой NPLV
+        """
+        nplvs = list(self.heats) if nplvs is None else list(nplvs)
+        rows = [{'NPLV': nplv, **self.features(nplv)} for nplv in nplvs]
+        return pd.DataFrame(rows)
+
+
+def compare_feature_names(fe: AllFeaturesExtractor, engine: Optional[OnlineFeatureEngine] = None) -> dict:
+    """
+    Сравнение имён признаков онлайн движка с колонками экстракторов, которые он повторяет
+
+    Возвращает словарь имя экстрактора -> None, если имена совпадают, иначе описание расхождения.
+    После prune экстрактор выдаёт только часть колонок, тогда проверяется, что онлайн считаются все оставленные
+    """
+    engine = OnlineFeatureEngine.from_extractor(fe) if engine is None else engine
+    online = HeatState(engine.operations, engine.signals, engine.categories).features_by_extractor()
+
+    report = {}
+    for name in ONLINE_EXTRACTORS:
+        extractor = fe.feature_extractors.get(name)
+        if extractor is None:
+            # экстрактор выброшен prune или не входит в fe
+            report[name] = None
+            continue
+        missing = [column for column in extractor.output_columns if column not in online[name]]
+        extra = [column for column in online[name] if column not in extractor.output_columns]
+        if extractor.keep_columns is not None:
+            extra = []
+        report[name] = f"missing online: {missing}, extra online: {extra}" if missing or extra else None
+    return report
@@ -0,0 +1,239 @@
+"""
+Отбор признаков с учётом стоимости их извлечения
+
+Для каждого признака считаются:
+
+    importance - вклад в модель: нативная важность catboost (PredictionValuesChange) или падение
+                 хит-рейта бизнес-метрики при перестановке признака на отложенной выборке, нормированные
+                 на сумму по каждому таргету и усреднённые по TST и C
+    cost       - время извлечения: у экстрактора замеряются время get_df со всеми колонками и после prune
+                 до одной колонки (минимум из repeats прогонов). Второе - общая часть (чтение таблиц, группировка),
+                 которая платится, если оставлена хоть одна колонка, разница делится поровну между колонками
+
+Признаки отбираются жадно по importance / приросту времени (для первой колонки экстрактора - вместе с общей частью),
+пока не набрана доля keep_importance общей важности, так что из двух одинаково полезных признаков остаётся
+более дешёвый, а экстрактор с дорогим чтением и слабыми признаками выбрасывается целиком. Результат применяется через
+AllFeaturesExtractor.prune: запросы экстракторов считают только оставленные колонки, экстракторы
+без оставленных колонок не выполняются, а отбор сохраняется в схему (и в артефакт вместе с моделью).
+
+    pruner = FeaturePruner({'verbose': 0}).fit(fe, df)
+    pruner.print_summary()
+    fe = pruner.transform(fe)
+"""
+import copy
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+from evraz.features import AllFeaturesExtractor
+from evraz.metrics import THRESHOLDS
+from evraz.model import BaselineModel
+
+
+def get_df_seconds(extractor, mode: str, repeats: int) -> float:
+    """
+    Время get_df в секундах (минимум из repeats прогонов), мимо кэша и FeatureStore
+    """
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        extractor.get_df(mode)
+        seconds.append(time.perf_counter() - start)
+    return min(seconds)
+
+
+def extractor_costs(fe: AllFeaturesExtractor, mode: str = 'train', repeats: int = 3) -> pd.DataFrame:
+    """
+    Стоимость экстракторов в секундах: seconds - get_df со всеми колонками,
+    base - общая часть (get_df после prune до одной колонки), column - прирост на каждую следующую колонку
+    """
+    costs = {}
+    for name, extractor in fe.feature_extractors.items():
+        columns = extractor.feature_columns
+        seconds = get_df_seconds(extractor, mode, repeats)
+        base = seconds
+        if len(columns) > 1:
+            base = min(get_df_seconds(copy.copy(extractor).prune(columns[:1]), mode, repeats), seconds)
+        costs[name] = {
+            'seconds': seconds,
+            'base': base,
+            'column': (seconds - base) / max(len(columns) - 1, 1),
+        }
+        print(f"Extractor {name}: {seconds:.3f}s for {len(columns)} columns, {base:.3f}s for one column")
+    return pd.DataFrame.from_dict(costs, orient='index')
+
+
+def native_importance(model: BaselineModel) -> Dict[str, np.ndarray]:
+    """
+    Важность PredictionValuesChange моделей каждого таргета
+    """
+    return {target: model.models[target].get_feature_importance() for target in model.targets}
+
+
+def permutation_importance(model: BaselineModel,
+                           X: pd.DataFrame,
+                           y: pd.DataFrame,
+                           n_repeats: int = 3,
+                           random_state: int = 42) -> Dict[str, np.ndarray]:
+    """
+    Падение хит-рейта каждого таргета при перестановке признака, отрицательные значения обнуляются
+    """
+    rng = np.random.default_rng(random_state)
+    importance = {}
+    for target in model.targets:
+        def score(features: pd.DataFrame) -> float:
+            return np.mean(np.abs(model.predict_target(features, target) - y[target].to_numpy()) < THRESHOLDS[target])
+
+        baseline = score(X)
+        drops = np.zeros(X.shape[1])
+        for i, column in enumerate(X.columns):
+            permuted = X.copy()
+            for _ in range(n_repeats):
+                permuted[column] = X[column].to_numpy()[rng.permutation(len(X))]
+                drops[i] += (baseline - score(permuted)) / n_repeats
+        importance[target] = np.clip(drops, 0, None)
+    return importance
+
+
+class FeaturePruner:
+    """
+    Отбор признаков AllFeaturesExtractor по важности и стоимости извлечения
+
+    model_params - параметры BaselineModel, на которой считается важность,
+    method - 'native' (важность catboost) или 'permutation' (перестановки на отложенных test_size плавок),
+    keep_importance - доля суммарной важности, которую должны набрать оставленные признаки,
+    repeats - прогонов каждого запроса при замере стоимости (берётся минимальное время)
+    """
+    def __init__(self,
+                 model_params: Optional[dict] = None,
+                 method: str = 'native',
+                 keep_importance: float = 0.99,
+                 test_size: float = 0.25,
+                 n_repeats: int = 3,
+                 mode: str = 'train',
+                 repeats: int = 3,
+                 random_state: int = 42):
+        if method not in ('native', 'permutation'):
+            raise ValueError(f"method must be 'native' or 'permutation', got {method}")
+        self.model_params = model_params if model_params is not None else {'verbose': 0}
+        self.method = method
+        self.keep_importance = keep_importance
+        self.test_size = test_size
+        self.n_repeats = n_repeats
+        self.mode = mode
+        self.repeats = repeats
+        self.random_state = random_state
+
+        self.costs_ = None
+        self.report_ = None
+        self.kept_columns_: List[str] = []
+
+    def feature_importance(self, X: pd.DataFrame, y: pd.DataFrame) -> pd.Series:
+        """
+        Важность признаков, нормированная по каждому таргету и усреднённая по таргетам
+        """
+        cat_features = list(X.select_dtypes(include=['category', 'object']).columns)
+        model_params = dict(self.model_params, cat_features=cat_features)
+
+        if self.method == 'native':
+            model = BaselineModel(model_params).fit(X, y)
+            importance = native_importance(model)
+        else:
+            X_train, X_test, y_train, y_test = train_test_split(
+                X, y, test_size=self.test_size, random_state=self.random_state)
+            model = BaselineModel(model_params).fit(X_train, y_train)
+            importance = permutation_importance(model, X_test, y_test, self.n_repeats, self.random_state)
+
+        normalized = [values / values.sum() if values.sum() > 0 else values for values in importance.values()]
+        return pd.Series(np.mean(normalized, axis=0), index=X.columns)
+
+    def select(self, report: pd.DataFrame) -> List[int]:
+        """
+        Жадный отбор строк report: на каждом шаге признак с наибольшей importance на прирост времени,
+        пока набранная доля важности меньше keep_importance
+        """
+        importance = report['importance'].to_dict()
+        extractors = report['extractor'].to_dict()
+        base, column = self.costs_['base'].to_dict(), self.costs_['column'].to_dict()
+
+        need = self.keep_importance * report['importance'].sum()
+        candidates = [i for i, value in importance.items() if value > 0]
+        opened, selected, gained = set(), [], 0.0
+
+        def efficiency(i):
+            extractor = extractors[i]
+            cost = column[extractor] + (0 if extractor in opened else base[extractor])
+            return importance[i] / max(cost, 1e-9), importance[i]
+
+        while candidates and gained < need:
+            best = max(candidates, key=efficiency)
+            candidates.remove(best)
+            opened.add(extractors[best])
+            selected.append(best)
+            gained += importance[best]
+        return selected
+
+    def fit(self, fe: AllFeaturesExtractor, df: Optional[pd.DataFrame] = None):
+        """
+        Замер стоимости экстракторов, важность признаков на df (по умолчанию fe.transform) и отбор
+        """
+        if df is None:
+            df = fe.transform(mode=self.mode)
+        self.costs_ = extractor_costs(fe, self.mode, self.repeats)
+        importance = self.feature_importance(df[fe.feature_columns], df[fe.target_columns])
+
+        report = pd.DataFrame([
+            {
+                'extractor': name,
+                'column': column,
+                # общая часть делится поровну, чтобы сумма по экстрактору была равна его времени
+                'cost': costs['column'] + (costs['base'] - costs['column']) / len(extractor.feature_columns),
+                'importance': importance[column],
+            }
+            for name, extractor in fe.feature_extractors.items()
+            for costs in [self.costs_.loc[name]]
+            for column in extractor.feature_columns
+        ])
+        report['efficiency'] = report['importance'] / report['cost'].clip(lower=1e-9)
+
+        # сначала отобранные в порядке отбора, затем остальные
+        selected = self.select(report)
+        report['keep'] = report.index.isin(selected)
+        rest = report.drop(index=selected).sort_values(['efficiency', 'importance'], ascending=False).index
+        report = report.loc[selected + rest.tolist()].reset_index(drop=True)
+
+        self.report_ = report
+        self.kept_columns_ = report.loc[report['keep'], 'column'].tolist()
+        return self
+
+    def summary(self) -> pd.DataFrame:
+        """
+        По экстракторам: колонки до и после отбора, время запроса и оценка времени после отбора
+        """
+        summary = (
+            self.report_.groupby('extractor', sort=False)
+            .agg(columns=('column', 'count'),
+                 kept=('keep', 'sum'),
+                 importance=('importance', 'sum'))
+            .reset_index()
+        )
+        costs = self.costs_.loc[summary['extractor']].reset_index(drop=True)
+        summary['seconds'] = costs['seconds']
+        kept_seconds = costs['base'] + costs['column'] * (summary['kept'] - 1)
+        summary['kept_seconds'] = kept_seconds.where(summary['kept'] > 0, 0)
+        return summary
+
+    def print_summary(self):
+        summary = self.summary()
+        print(summary.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+        print(f"Kept {summary['kept'].sum()} of {summary['columns'].sum()} features, "
+              f"estimated extraction time {summary['kept_seconds'].sum():.2f}s of {summary['seconds'].sum():.2f}s")
+
+    def transform(self, fe: AllFeaturesExtractor) -> AllFeaturesExtractor:
+        """
+        Применение отбора к экстрактору (fe изменяется на месте)
+        """
+        return fe.prune(self.kept_columns_)
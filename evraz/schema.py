@@ -0,0 +1,281 @@
+"""
+Управление схемой бд: типизированные таблицы, индексы и функции
+
+devops/schemas.sql описывает таблицы так, как их сгенерировал csvsql: все ключи и измерения
+объявлены как DECIMAL, индексов нет, а datediff_* написаны на plpgsql.
+Здесь те же таблицы объявлены с нативными типами (integer NPLV, float8 измерения, timestamp),
+добавлены индексы по (NPLV, время), а функции переписаны на sql, чтобы планировщик мог их инлайнить.
+
+Пример запуска:
+
+    PYTHONPATH=. python -m evraz.schema create
+    PYTHONPATH=. python -m evraz.schema migrate --timings
+"""
+import argparse
+import time
+from typing import Dict, List, Optional, Tuple
+
+from evraz.settings import Connection, quote_ident
+
+MODES = ('train', 'test')
+
+# таблица -> [(колонка, тип, not null)]
+TABLES: Dict[str, List[Tuple[str, str, bool]]] = {
+    'chronom': [
+        ('a', 'integer', True),
+        ('NPLV', 'integer', True),
+        ('TYPE_OPER', 'varchar', True),
+        ('NOP', 'varchar', True),
+        ('VR_NACH', 'timestamp', False),
+        ('VR_KON', 'timestamp', False),
+        ('O2', 'float8', False),
+    ],
+    'chugun': [
+        ('NPLV', 'integer', True),
+        ('VES', 'float8', True),
+        ('T', 'float8', True),
+        ('SI', 'float8', True),
+        ('MN', 'float8', True),
+        ('S', 'float8', True),
+        ('P', 'float8', True),
+        ('CR', 'float8', True),
+        ('NI', 'float8', True),
+        ('CU', 'float8', True),
+        ('V', 'float8', True),
+        ('TI', 'float8', True),
+        ('DATA_ZAMERA', 'timestamp', False),
+    ],
+    'gas': [
+        ('NPLV', 'integer', True),
+        ('Time', 'timestamp', False),
+        ('V', 'float8', True),
+        ('T', 'float8', True),
+        ('O2', 'float8', True),
+        ('N2', 'float8', True),
+        ('H2', 'float8', True),
+        ('CO2', 'float8', True),
+        ('CO', 'float8', True),
+        ('AR', 'float8', True),
+        ('T фурмы 1', 'float8', True),
+        ('T фурмы 2', 'float8', True),
+        ('O2_pressure', 'float8', True),
+    ],
+    'lom': [
+        ('NPLV', 'integer', True),
+        ('VDL', 'float8', True),
+        ('NML', 'varchar', True),
+        ('VES', 'float8', True),
+    ],
+    'plavki': [
+        ('NPLV', 'integer', True),
+        ('plavka_VR_NACH', 'timestamp', False),
+        ('plavka_VR_KON', 'timestamp', False),
+        ('plavka_NMZ', 'varchar', True),
+        ('plavka_NAPR_ZAD', 'varchar', True),
+        ('plavka_STFUT', 'float8', True),
+        ('plavka_TIPE_FUR', 'varchar', True),
+        ('plavka_ST_FURM', 'float8', True),
+        ('plavka_TIPE_GOL', 'varchar', True),
+        ('plavka_ST_GOL', 'float8', True),
+    ],
+    'produv': [
+        ('NPLV', 'integer', True),
+        ('SEC', 'timestamp', False),
+        ('RAS', 'float8', True),
+        ('POL', 'float8', True),
+    ],
+    'sip': [
+        ('NPLV', 'integer', True),
+        ('VDSYP', 'float8', True),
+        ('NMSYP', 'varchar', True),
+        ('VSSYP', 'float8', True),
+        ('DAT_OTD', 'timestamp', False),
+    ],
+}
+
+# таблицы без суффикса режима
+TARGET_TABLES: Dict[str, List[Tuple[str, str, bool]]] = {
+    'target_train': [
+        ('NPLV', 'integer', True),
+        ('TST', 'float8', False),
+        ('C', 'float8', False),
+    ],
+    'sample_submission': [
+        ('NPLV', 'integer', True),
+        ('TST', 'float8', False),
+        ('C', 'float8', False),
+    ],
+}
+
+# таблица -> колонки индекса; временная колонка идёт второй,
+# чтобы фильтры по plavka_VR_KON и выборки рядов по времени шли по индексу
+INDEXES: Dict[str, Tuple[str, ...]] = {
+    'chronom': ('NPLV', 'VR_NACH'),
+    'chugun': ('NPLV',),
+    'gas': ('NPLV', 'Time'),
+    'lom': ('NPLV',),
+    'plavki': ('NPLV',),
+    'produv': ('NPLV', 'SEC'),
+    'sip': ('NPLV', 'DAT_OTD'),
+    'target_train': ('NPLV',),
+    'sample_submission': ('NPLV',),
+}
+
+# sql функции без begin/end инлайнятся планировщиком в вызывающий запрос,
+# результат совпадает с plpgsql версиями из devops/schemas.sql
+FUNCTIONS = """
+create or replace function datediff_minutes(end_date timestamp without time zone,
+                                            start_date timestamp without time zone) returns integer as
+$$
+    select (trunc(extract(epoch from end_date - start_date) / 60))::integer
+$$ language sql immutable parallel safe;
+
+create or replace function datediff_seconds(end_date timestamp without time zone,
+                                            start_date timestamp without time zone) returns integer as
+$$
+    select (trunc(extract(epoch from end_date - start_date) / 60) * 60
+        + date_part('second', end_date - start_date))::integer
+$$ language sql immutable parallel safe;
+"""
+
+
+def all_tables() -> Dict[str, List[Tuple[str, str, bool]]]:
+    """
+    Полный список таблиц бд с колонками
+    """
+    tables = {f"{name}_{mode}": columns for name, columns in TABLES.items() for mode in MODES}
+    tables.update(TARGET_TABLES)
+    return tables
+
+
+def base_name(table: str) -> str:
+    for mode in MODES:
+        if table.endswith(f"_{mode}") and table[:-len(mode) - 1] in TABLES:
+            return table[:-len(mode) - 1]
+    return table
+
+
+def create_table_sql(table: str, columns: List[Tuple[str, str, bool]]) -> str:
+    definitions = ",\n    ".join(
+        f"{quote_ident(name)} {type_}{' NOT NULL' if not_null else ''}"
+        for name, type_, not_null in columns
+    )
+    return f"create table if not exists {quote_ident(table)} (\n    {definitions}\n);"
+
+
+def alter_table_sql(table: str, columns: List[Tuple[str, str, bool]]) -> str:
+    """
+    Приведение типов существующей таблицы одним alter table, т.е. одной перезаписью
+    """
+    alters = ",\n    ".join(
+        f"alter column {quote_ident(name)} type {type_} using {quote_ident(name)}::{type_}"
+        for name, type_, _ in columns
+    )
+    return f"alter table {quote_ident(table)}\n    {alters};"
+
+
+def create_index_sql(table: str) -> str:
+    columns = INDEXES[base_name(table)]
+    index_name = f"{table}_{'_'.join(columns)}_idx".lower().replace(' ', '_')
+    return (
+        f"create index if not exists {quote_ident(index_name)} "
+        f"on {quote_ident(table)} ({', '.join(quote_ident(c) for c in columns)});"
+    )
+
+
+def execute(conn: Connection, statements: List[str]):
+    with conn.conn.begin() as c:
+        for statement in statements:
+            print(statement)
+            c.execute(statement)
+
+
+def create(conn: Connection):
+    """
+    Создание функций, таблиц и индексов в пустой бд
+    """
+    statements = [FUNCTIONS]
+    for table, columns in all_tables().items():
+        statements.append(create_table_sql(table, columns))
+        statements.append(create_index_sql(table))
+    execute(conn, statements)
+
+    return conn
+
+
+def existing_tables(conn: Connection) -> List[str]:
+    df = conn.read_query("select table_name from information_schema.tables where table_schema = 'public'")
+    return df['table_name'].tolist()
+
+
+def migrate(conn: Connection):
+    """
+    Миграция существующей бд на месте: замена функций, приведение типов, индексы и analyze.
+
+    Всё выполняется в одной транзакции, поэтому при ошибке бд остаётся в исходном состоянии
+    """
+    present = set(existing_tables(conn))
+    statements = [FUNCTIONS]
+    for table, columns in all_tables().items():
+        if table not in present:
+            print(f"Table {table} does not exist, skipping")
+            continue
+        statements.append(alter_table_sql(table, columns))
+        statements.append(create_index_sql(table))
+        statements.append(f"analyze {quote_ident(table)};")
+    execute(conn, statements)
+
+    return conn
+
+
+def time_extractors(conn: Connection, mode: str = 'train') -> Dict[str, float]:
+    """
+    Время выполнения запроса каждого экстрактора в секундах
+    """
+    # импорт здесь, чтобы модуль схемы не зависел от модуля признаков при импорте
+    from evraz.features import AllFeaturesExtractor
+
+    timings = {}
+    # fit находит категории PivotFeatures, от которых зависят запросы
+    for name, extractor in AllFeaturesExtractor(conn).fit().feature_extractors.items():
+        start = time.time()
+        extractor.get_df(mode)
+        timings[name] = time.time() - start
+
+    return timings
+
+
+def print_timings(before: Dict[str, float], after: Optional[Dict[str, float]] = None):
+    print(f"{'extractor':<16}{'before, s':>12}{'after, s':>12}{'speedup':>10}")
+    for name, seconds in before.items():
+        if after is None:
+            print(f"{name:<16}{seconds:>12.2f}")
+        else:
+            print(f"{name:<16}{seconds:>12.2f}{after[name]:>12.2f}{seconds / max(after[name], 1e-9):>9.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage feature lake schema")
+    parser.add_argument("command", choices=["create", "migrate", "timings"])
+    parser.add_argument("--db-name", default="lake")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--mode", default="train")
+    parser.add_argument("--timings", action="store_true", help="time extractor queries before and after migration")
+    args = parser.parse_args()
+
+    conn = Connection(db_name=args.db_name, host=args.host, port=args.port).open_conn().ping()
+
+    if args.command == "create":
+        create(conn)
+    elif args.command == "timings":
+        print_timings(time_extractors(conn, args.mode))
+    else:
+        before = time_extractors(conn, args.mode) if args.timings else None
+        migrate(conn)
+        if before is not None:
+            print_timings(before, time_extractors(conn, args.mode))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""
+Локальный http сервис предсказаний TST/C для отдельных плавок
+
+Модель и схема экстракторов загружаются из артефакта (evraz.artifacts) один раз при старте.
+Одновременные запросы собираются в микробатчи: признаки всех плавок батча считаются
+одним запуском AllFeaturesExtractor, ограниченным этими плавками, после чего модель вызывается один раз.
+
+Запросы:
+
+    POST /predict {"NPLV": [520001, 520002]}          - признаки считаются из бд
+    POST /predict {"features": [{"VES": 250.1, ...}]}  - готовые признаки, отсутствующие числовые считаются пропусками
+    GET  /stats                                        - p50/p99 задержки, пропускная способность, размер батчей
+    GET  /health
+
+Пример запуска:
+
+    PYTHONPATH=. python -m evraz.service ../data/artifacts/baseline --port 8000
+    PYTHONPATH=. python -m evraz.service ../data/artifacts/baseline --backend duckdb --data-dir ../data/raw
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from evraz.artifacts import Artifact, load_artifact
+from evraz.features import FeatureStore
+from evraz.settings import Connection, DuckDBConnection
+
+
+class PendingRequest:
+    """
+    Запрос, ожидающий своего батча
+    """
+    def __init__(self, heats: Optional[List[int]] = None, features: Optional[pd.DataFrame] = None):
+        self.heats = heats or []
+        self.features = features
+        self.created = time.perf_counter()
+        self.done = threading.Event()
+        self.result: Optional[pd.DataFrame] = None
+        self.error: Optional[Exception] = None
+
+
+class LatencyStats:
+    """
+    Задержки последних window запросов и счётчики с момента старта
+    """
+    def __init__(self, window: int = 10_000):
+        self.latencies = deque(maxlen=window)
+        self.started = time.time()
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.lock = threading.Lock()
+
+    def record_batch(self, requests: List[PendingRequest], rows: int):
+        now = time.perf_counter()
+        with self.lock:
+            self.latencies.extend(now - request.created for request in requests)
+            self.requests += len(requests)
+            self.rows += rows
+            self.batches += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            elapsed = max(time.time() - self.started, 1e-9)
+            return {
+                'requests': self.requests,
+                'rows': self.rows,
+                'batches': self.batches,
+                'mean_batch_size': self.requests / max(self.batches, 1),
+                'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'requests_per_sec': self.requests / elapsed,
+                'rows_per_sec': self.rows / elapsed,
+            }
+
+
+class PredictionService:
+    """
+    Микробатчинг запросов поверх артефакта.
+
+    Батч закрывается, когда в нём max_batch_size запросов или с момента первого запроса прошло max_wait_ms.
+    Батчи обрабатываются одним потоком, поэтому экстракторы и модель не используются конкурентно.
+    С FeatureStore признаки плавок батча читаются из материализованных таблиц (и досчитываются, если их там нет)
+    """
+    def __init__(self,
+                 artifact: Artifact,
+                 conn,
+                 mode: str = 'test',
+                 max_batch_size: int = 64,
+                 max_wait_ms: float = 5.0,
+                 n_jobs: int = 5,
+                 store: Optional[FeatureStore] = None):
+        self.artifact = artifact
+        self.mode = mode
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+
+        self.extractor = artifact.build_extractor(conn, n_jobs=n_jobs, fused=True, store=store)
+        self.cat_columns = [
+            column
+            for extractor in self.extractor.feature_extractors.values()
+            for column in extractor.cat_columns
+        ]
+        self.stats = LatencyStats()
+
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.worker.start()
+        return self
+
+    def submit(self,
+               heats: Optional[List[int]] = None,
+               features: Optional[List[dict]] = None,
+               timeout: Optional[float] = None) -> pd.DataFrame:
+        """
+        Предсказание для плавок heats или для готовых признаков features, блокирует до обработки батча
+        """
+        request = PendingRequest(
+            heats=[int(nplv) for nplv in heats or []],
+            features=self.features_frame(features) if features else None
+        )
+        self.queue.put(request)
+        if not request.done.wait(timeout):
+            raise TimeoutError("Prediction was not ready in time")
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def features_frame(self, rows: List[dict]) -> pd.DataFrame:
+        """
+        Признаки из запроса в колонках и типах, на которых обучалась модель.
+
+        Отсутствующие числовые признаки считаются пропусками, категориальные обязательны
+        """
+        df = pd.DataFrame.from_records(rows).reindex(columns=self.artifact.feature_columns)
+        missing = [column for column in self.cat_columns if df[column].isna().any()]
+        if missing:
+            raise ValueError(f"Categorical features {missing} are required")
+        numeric = [column for column in df.columns if column not in self.cat_columns]
+        return df.astype({column: float for column in numeric})
+
+    def _collect(self) -> List[PendingRequest]:
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                rows = self._process(batch)
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                rows = 0
+            self.stats.record_batch(batch, rows)
+            for request in batch:
+                request.done.set()
+
+    def _process(self, batch: List[PendingRequest]) -> int:
+        """
+        Одно извлечение признаков и один вызов модели на весь батч
+        """
+        heats = sorted({nplv for request in batch for nplv in request.heats})
+        frames = []
+        if heats:
+            frames.append(self.extractor.transform(heats, mode=self.mode)[['NPLV'] + self.artifact.feature_columns])
+        frames.extend(
+            request.features.assign(NPLV=np.nan)[['NPLV'] + self.artifact.feature_columns]
+            for request in batch if request.features is not None
+        )
+        if not frames:
+            for request in batch:
+                request.result = pd.DataFrame(columns=['NPLV'] + self.artifact.manifest['target_columns'])
+            return 0
+
+        df = (
+            pd.concat(frames, ignore_index=True)
+            .astype({column: pd.CategoricalDtype() for column in self.cat_columns})
+        )
+        predictions = self.artifact.predict(df).astype({'NPLV': 'Int64'})
+
+        # строки батча в порядке: плавки из бд, затем готовые признаки запросов по очереди
+        n_heats = len(predictions) - sum(len(r.features) for r in batch if r.features is not None)
+        by_heat = predictions.iloc[:n_heats].set_index('NPLV', drop=False)
+        offset = n_heats
+        for request in batch:
+            parts = [by_heat.loc[by_heat.index.intersection(request.heats)].reset_index(drop=True)]
+            if request.features is not None:
+                parts.append(predictions.iloc[offset:offset + len(request.features)])
+                offset += len(request.features)
+            request.result = pd.concat(parts, ignore_index=True)
+
+        return len(predictions)
+
+
+def make_handler(service: PredictionService):
+    class Handler(BaseHTTPRequestHandler):
+        def send_json(self, status: int, payload: dict):
+            body = json.dumps(payload, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self.send_json(200, service.stats.snapshot())
+            elif self.path == '/health':
+                self.send_json(200, {'status': 'ok'})
+            else:
+                self.send_json(404, {'error': f"unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self.send_json(404, {'error': f"unknown path {self.path}"})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                heats = payload.get('NPLV', [])
+                heats = [heats] if isinstance(heats, (int, str)) else heats
+                predictions = service.submit(heats=heats, features=payload.get('features'))
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            except Exception as e:
+                self.send_json(500, {'error': str(e)})
+                return
+
+            found = set(predictions['NPLV'].dropna().astype(int))
+            self.send_json(200, {
+                'predictions': json.loads(predictions.to_json(orient='records')),
+                'missing': [int(nplv) for nplv in heats if int(nplv) not in found],
+            })
+
+        def log_message(self, format, *args):
+            # лог каждого запроса заметно замедляет сервис под нагрузкой, статистика доступна в /stats
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve TST/C predictions for individual heats")
+    parser.add_argument("artifact", help="artifact directory written by evraz.artifacts.save_artifact")
+    parser.add_argument("--bind", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--mode", default="test", help="tables the heats are read from")
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--backend", choices=["postgres", "duckdb"], default="postgres")
+    parser.add_argument("--data-dir", default="../data/raw", help="raw files for the duckdb backend")
+    parser.add_argument("--db-name", default="lake")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--db-port", type=int, default=5432)
+    parser.add_argument("--jobs", type=int, default=5)
+    parser.add_argument("--materialize", action="store_true", help="read features from materialized db tables")
+    args = parser.parse_args()
+
+    artifact = load_artifact(args.artifact)
+    if args.backend == "duckdb":
+        conn = DuckDBConnection(args.data_dir).open_conn().ping()
+    else:
+        conn = Connection(db_name=args.db_name, host=args.host, port=args.db_port).open_conn().ping()
+
+    service = PredictionService(
+        artifact, conn,
+        mode=args.mode,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        n_jobs=args.jobs,
+        store=FeatureStore(conn) if args.materialize else None
+    ).start()
+
+    server = ThreadingHTTPServer((args.bind, args.port), make_handler(service))
+    print(f"Serving predictions on http://{args.bind}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(service.stats.snapshot(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,189 @@
-from typing import Optional
+from typing import List, Optional
+import io
+import json
 import os
 
 from sqlalchemy import create_engine
+import numpy as np
 import pandas as pd
 import pandas.io.sql as psql
+from pandas.api.types import union_categoricals
+
+from evraz.tracing import get_tracer, query_attrs
+
+
+def compact_dtypes(df: pd.DataFrame, float_rtol: float = 1e-6) -> pd.DataFrame:
+    """
+    Casts columns to compact dtypes
+
+    float64 -> float32 when values fit and round-trip within float_rtol,
+    int64 -> int32 when values fit (NPLV and counters),
+    object columns holding only strings (VARCHAR) -> category.
+    Columns are processed by position, so duplicated names (plavki.*, chugun.*) are kept
+    """
+    columns = df.columns
+    data = {}
+    for i in range(df.shape[1]):
+        series = df.iloc[:, i]
+
+        if series.dtype == np.float64:
+            values = series.to_numpy()
+            finite = values[np.isfinite(values)]
+            if finite.size == 0 or np.abs(finite).max() < np.finfo(np.float32).max:
+                compact = values.astype(np.float32)
+                if np.allclose(compact, values, rtol=float_rtol, atol=0, equal_nan=True):
+                    series = pd.Series(compact, index=series.index)
+        elif series.dtype == np.int64:
+            info = np.iinfo(np.int32)
+            if series.empty or (series.min() >= info.min and series.max() <= info.max):
+                series = series.astype(np.int32)
+        elif series.dtype == object:
+            non_null = series.dropna()
+            if not non_null.empty and non_null.map(type).eq(str).all():
+                series = series.astype('category')
+
+        data[i] = series
+
+    df = pd.DataFrame(data, index=df.index)
+    df.columns = columns
+    return df
+
+
+def cast_chunk(chunk: pd.DataFrame, dtypes: List[Optional[str]]) -> pd.DataFrame:
+    """
+    Casts a fetched chunk to the dtypes of the result columns (see PG_DTYPES), by position
+
+    from_records infers dtypes from the values of one chunk, so a column that is NULL in the whole chunk
+    comes out as object. int and bool columns holding NULLs become float64 and object, as in read_sql_query;
+    concat_chunks brings such chunks to a common dtype. dtype None leaves the column as is
+    """
+    columns = chunk.columns
+    data = {}
+    for i, dtype in enumerate(dtypes):
+        series = chunk.iloc[:, i]
+        has_nulls = series.isna().any()
+        if dtype in ('float64', 'datetime64[ns]') or (dtype == 'int64' and not has_nulls):
+            series = series.astype(dtype)
+        elif dtype == 'int64':
+            series = series.astype('float64')
+        elif dtype == 'bool' and not has_nulls:
+            series = series.astype('bool')
+        data[i] = series
+
+    df = pd.DataFrame(data, index=chunk.index)
+    df.columns = columns
+    return df
+
+
+def concat_chunks(chunks: List[pd.DataFrame], compact: bool = False) -> pd.DataFrame:
+    """
+    Concatenates chunks column by column so that dtypes do not depend on where the chunks were split
+
+    Categorical chunks are merged with union_categoricals (chunks where the column is all NULL join as empty
+    categoricals), numeric chunks of different dtypes (int32 and float64 of an int column with NULLs,
+    float32 and float64) are cast to their common dtype and, with compact, compacted again as a whole column
+    """
+    if len(chunks) == 1:
+        return chunks[0]
+
+    data = {}
+    for i in range(chunks[0].shape[1]):
+        parts = [chunk.iloc[:, i] for chunk in chunks]
+        categorical = [isinstance(part.dtype, pd.CategoricalDtype) for part in parts]
+        dtypes = {part.dtype for part in parts}
+
+        if any(categorical) and all(is_cat or part.isna().all() for is_cat, part in zip(categorical, parts)):
+            parts = [part if is_cat else part.astype('category') for is_cat, part in zip(categorical, parts)]
+            data[i] = pd.Series(union_categoricals(parts))
+        elif len(dtypes) > 1 and all(np.issubdtype(dtype, np.number) for dtype in dtypes):
+            series = pd.concat([part.astype(np.result_type(*dtypes)) for part in parts], ignore_index=True)
+            data[i] = compact_dtypes(series.to_frame()).iloc[:, 0] if compact else series
+        else:
+            data[i] = pd.concat(parts, ignore_index=True)
+
+    df = pd.DataFrame(data)
+    df.columns = chunks[0].columns
+    return df
+
+
+# postgres type oid -> dtype pandas would produce for it through read_sql_query
+PG_DTYPES = {
+    16: 'bool',              # bool
+    20: 'int64',             # int8
+    21: 'int64',             # int2
+    23: 'int64',             # int4
+    700: 'float64',          # float4
+    701: 'float64',          # float8
+    1700: 'float64',         # numeric, coerced from Decimal
+    18: 'object',            # char
+    19: 'object',            # name
+    25: 'object',            # text
+    1042: 'object',          # bpchar
+    1043: 'object',          # varchar
+    1114: 'datetime64[ns]',  # timestamp
+}
+
+
+# postgres type oid -> arrow type alias the COPY csv output is parsed into, see Connection._fetch_copy
+PG_ARROW_TYPES = {
+    16: 'bool',
+    20: 'int64',
+    21: 'int64',
+    23: 'int64',
+    700: 'double',
+    701: 'double',
+    1700: 'double',
+    18: 'string',
+    19: 'string',
+    25: 'string',
+    1042: 'string',
+    1043: 'string',
+    1114: 'timestamp[ns]',
+}
+
+TRANSPORTS = ('dbapi', 'copy')
+
+
+def read_copy_csv(data, description: List[tuple]) -> pd.DataFrame:
+    """
+    Parses output of COPY ... TO STDOUT WITH (FORMAT csv) into a DataFrame through pyarrow
+
+    description - (name, type oid) of every column; names may be duplicated
+    """
+    import pyarrow as pa
+    from pyarrow import csv
+
+    if not len(data):
+        return empty_frame([name for name, _ in description], [PG_DTYPES[type_code] for _, type_code in description])
+
+    names = [f"c{i}" for i in range(len(description))]
+    table = csv.read_csv(
+        pa.py_buffer(data),
+        read_options=csv.ReadOptions(column_names=names),
+        convert_options=csv.ConvertOptions(
+            column_types={
+                name: pa.type_for_alias(PG_ARROW_TYPES[type_code]) for name, (_, type_code) in zip(names, description)
+            },
+            # postgres writes NULL as an empty unquoted field and an empty string as ""
+            null_values=[""],
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False,
+            true_values=["t"],
+            false_values=["f"],
+        )
+    )
+    df = table.to_pandas()
+    df.columns = [name for name, _ in description]
+    return df
+
+
+def empty_frame(columns: List[str], dtypes: List[str]) -> pd.DataFrame:
+    """
+    Empty DataFrame with given (possibly duplicated) column names and dtypes
+    """
+    df = pd.DataFrame({i: pd.Series(dtype=dtype) for i, dtype in enumerate(dtypes)})
+    df.columns = columns
+    return df
 
 
 class Connection:
@@ -23,12 +203,226 @@ class Connection:
         # instance of sqlalchemy connection pool
         self.conn = None
 
-    def read_query(self, query: str) -> pd.DataFrame:
-        with self.conn.begin() as conn:
-            df = psql.read_sql_query(query, conn)
+        # streaming fetch settings, see set_streaming
+        self.chunksize = None
+        self.compact = False
 
+        # result transport, see set_transport
+        self.transport = 'dbapi'
+
+    def read_query(self,
+                   query: str,
+                   timeout: Optional[float] = None,
+                   chunksize: Optional[int] = None,
+                   compact: Optional[bool] = None,
+                   transport: Optional[str] = None) -> pd.DataFrame:
+        """
+        Executes query on a pooled connection
+
+        timeout (seconds) is applied as a transaction-local statement_timeout,
+        so a query that runs too long is cancelled by the server itself.
+
+        With chunksize the result is fetched through a server-side cursor chunksize rows at a time,
+        and with compact every chunk is cast to compact dtypes as it arrives (see compact_dtypes),
+        so only one chunk of python objects is alive at any moment.
+        Both default to the values from set_streaming.
+
+        transport='copy' exports the result with COPY ... TO STDOUT and parses it with pyarrow
+        instead of the DBAPI cursor (see _fetch_copy), chunksize is ignored then.
+        Defaults to the value from set_transport.
+        Every call is recorded as a span of the process tracer (see evraz.tracing)
+        """
+        transport = self.transport if transport is None else transport
+        if transport not in TRANSPORTS:
+            raise ValueError(f"transport must be one of {TRANSPORTS}, got {transport}")
+
+        with get_tracer().span("read_query", kind="query", transport=transport, **query_attrs(query)) as span:
+            df = None
+            if transport == 'copy':
+                df = self._fetch_copy(query, timeout)
+                df = compact_dtypes(df) if df is not None and (self.compact if compact is None else compact) else df
+            if df is None:
+                df = self._fetch(query, timeout, chunksize, compact)
+            span.record_frame(df)
         return df
 
+    def _fetch(self,
+               query: str,
+               timeout: Optional[float] = None,
+               chunksize: Optional[int] = None,
+               compact: Optional[bool] = None) -> pd.DataFrame:
+        chunksize = self.chunksize if chunksize is None else chunksize
+        compact = self.compact if compact is None else compact
+
+        if not chunksize:
+            with self.conn.begin() as conn:
+                if timeout is not None:
+                    conn.execute(f"set local statement_timeout = {int(timeout * 1000)}")
+                df = psql.read_sql_query(query, conn)
+
+            return compact_dtypes(df) if compact else df
+
+        chunks = []
+        with self.conn.execution_options(stream_results=True).begin() as conn:
+            if timeout is not None:
+                conn.execute(f"set local statement_timeout = {int(timeout * 1000)}")
+            result = conn.execute(query)
+            columns = list(result.keys())
+            # dtypes are taken once from the cursor description, not inferred from every chunk
+            dtypes = [PG_DTYPES.get(column.type_code) for column in result.cursor.description]
+
+            while True:
+                rows = result.fetchmany(chunksize)
+                # an empty result still produces one (empty) chunk to keep the columns
+                if rows or not chunks:
+                    chunk = cast_chunk(pd.DataFrame.from_records(rows, columns=columns, coerce_float=True), dtypes)
+                    chunks.append(compact_dtypes(chunk) if compact else chunk)
+                if not rows:
+                    break
+
+        return concat_chunks(chunks, compact)
+
+    def _fetch_copy(self, query: str, timeout: Optional[float] = None) -> Optional[pd.DataFrame]:
+        """
+        Bulk export through COPY (query) TO STDOUT in csv, parsed by pyarrow straight into columnar buffers
+
+        Column types come from the cursor metadata of the query with limit 0 (see PG_ARROW_TYPES),
+        so numeric is parsed as float64 without Decimal objects and timestamps without datetime objects.
+        Returns None when a column type has no arrow counterpart, the caller falls back to the DBAPI path
+        """
+        description = self.describe_columns(f"select * from ({query}) described limit 0")
+        if any(type_code not in PG_ARROW_TYPES for _, type_code in description):
+            return None
+
+        # the DBAPI path sends the query through psycopg2 formatting, which turns %% into %
+        statement = f"COPY ({query.replace('%%', '%')}) TO STDOUT WITH (FORMAT csv)"
+
+        buffer = io.BytesIO()
+        raw_conn = self.conn.raw_connection()
+        try:
+            with raw_conn.cursor() as cursor:
+                if timeout is not None:
+                    cursor.execute(f"set local statement_timeout = {int(timeout * 1000)}")
+                cursor.copy_expert(statement, buffer)
+            raw_conn.rollback()
+        finally:
+            raw_conn.close()
+
+        return read_copy_csv(buffer.getbuffer(), description)
+
+    def describe_columns(self, query: str) -> List[tuple]:
+        """
+        (name, type oid) of every column of the query result; the query should not produce rows
+        """
+        raw_conn = self.conn.raw_connection()
+        try:
+            with raw_conn.cursor() as cursor:
+                cursor.execute(query)
+                description = cursor.description
+            raw_conn.rollback()
+        finally:
+            raw_conn.close()
+
+        return [(column.name, column.type_code) for column in description]
+
+    def explain_analyze(self, query: str) -> object:
+        """
+        EXPLAIN (ANALYZE, BUFFERS) plan of the query as parsed json; the query is executed once more
+        """
+        with self.conn.begin() as conn:
+            plan = conn.execute(f"explain (analyze, buffers, format json) {query}").scalar()
+        return json.loads(plan) if isinstance(plan, str) else plan
+
+    def describe_query(self, query: str) -> Optional[pd.DataFrame]:
+        """
+        Empty DataFrame with the columns and dtypes of the query result, taken from cursor metadata
+
+        The query should not produce rows (e.g. end with limit 0): postgres stops executing it
+        as soon as the limit is reached, so no aggregation is computed.
+        Returns None when a column type has no known pandas counterpart
+        """
+        description = self.describe_columns(query)
+        if any(type_code not in PG_DTYPES for _, type_code in description):
+            return None
+
+        return empty_frame([name for name, _ in description], [PG_DTYPES[type_code] for _, type_code in description])
+
+    def table_exists(self, table: str) -> bool:
+        with self.conn.begin() as conn:
+            return conn.execute("select to_regclass(%s) is not null", (quote_ident(table),)).scalar()
+
+    def execute(self, statement: str):
+        """
+        Executes a statement that returns no rows (ddl, delete) in its own transaction
+        """
+        with self.conn.begin() as conn:
+            conn.execute(statement)
+        return self
+
+    def replace_rows(self, table: str, df: pd.DataFrame, key_column: str, keys: List[object]) -> int:
+        """
+        Deletes rows whose key_column is in keys and appends df, in one transaction
+
+        The table is created from the dtypes of df (with an index on key_column) if it does not exist,
+        rows are sent through COPY FROM STDIN. Returns the number of appended rows
+        """
+        if not self.table_exists(table):
+            df.head(0).to_sql(table, self.conn, index=False)
+            self.execute(f"create index on {quote_ident(table)} ({quote_ident(key_column)})")
+
+        columns = ", ".join(quote_ident(column) for column in df.columns)
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+
+        raw_conn = self.conn.raw_connection()
+        try:
+            with raw_conn.cursor() as cursor:
+                if keys:
+                    cursor.execute(f"delete from {quote_ident(table)} where {quote_ident(key_column)} = any(%s)",
+                                   (list(keys),))
+                cursor.copy_expert(f"COPY {quote_ident(table)} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+            raw_conn.commit()
+        except Exception:
+            raw_conn.rollback()
+            raise
+        finally:
+            raw_conn.close()
+
+        return len(df)
+
+    def set_streaming(self, chunksize: Optional[int] = 50_000, compact: bool = True):
+        """
+        Default fetch mode for read_query: server-side cursor with chunksize rows per fetch
+        and compact dtypes. chunksize=None switches back to fetching the whole result at once
+        """
+        self.chunksize = chunksize
+        self.compact = compact
+
+        return self
+
+    def set_transport(self, transport: str = 'copy'):
+        """
+        Default transport for read_query: 'dbapi' (sqlalchemy cursor) or 'copy' (COPY TO STDOUT + pyarrow)
+        """
+        if transport not in TRANSPORTS:
+            raise ValueError(f"transport must be one of {TRANSPORTS}, got {transport}")
+        self.transport = transport
+
+        return self
+
+    def compare_transports(self, query: str, rtol: float = 1e-9) -> Optional[str]:
+        """
+        Runs query through both transports: None if the results are equal, otherwise the difference
+        """
+        left = self.read_query(query, transport='dbapi', chunksize=0, compact=False)
+        right = self.read_query(query, transport='copy', compact=False)
+        try:
+            pd.testing.assert_frame_equal(left, right, check_dtype=False, rtol=rtol)
+        except AssertionError as e:
+            return str(e)
+        return None
+
     def set_credentials(self,
                         username: Optional[str] = None,
                         password: Optional[str] = None):
@@ -74,3 +468,205 @@ class Connection:
             conn.execute("select 1")
 
         return self
+
+
+def escape(literal: str) -> str:
+    """
+    Escapes a string for use inside a single-quoted sql literal
+    """
+    return literal.replace("'", "''")
+
+
+def quote_ident(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+class DuckDBConnection:
+    """
+    In-process backend: raw csv/parquet files are loaded into an embedded duckdb database
+
+    Exposes the same read_query interface as Connection, so every DBFeatureExtractor
+    runs its query_template unchanged without a running postgres.
+    Tables are named after the files (plavki_train.csv -> plavki_train),
+    csv files are loaded into memory once, parquet files are queried in place
+    """
+    # same semantics as datediff_* in devops/schemas.sql
+    macros = """
+    create or replace macro datediff_minutes(end_date, start_date) as
+        cast(trunc((epoch_ms(end_date) - epoch_ms(start_date)) / 60000.0) as integer);
+    create or replace macro datediff_seconds(end_date, start_date) as
+        cast((epoch_ms(end_date) - epoch_ms(start_date)) / 1000.0 as integer);
+    """
+
+    def __init__(self,
+                 data_dir: str = "../data/raw",
+                 threads: Optional[int] = None):
+        self.data_dir = data_dir
+        self.threads = threads
+
+        # instance of duckdb connection
+        self.conn = None
+
+        # same defaults as Connection, see Connection.set_streaming
+        self.chunksize = None
+        self.compact = False
+
+    def read_query(self,
+                   query: str,
+                   timeout: Optional[float] = None,
+                   chunksize: Optional[int] = None,
+                   compact: Optional[bool] = None,
+                   transport: Optional[str] = None) -> pd.DataFrame:
+        """
+        Executes query on a separate cursor, so it is safe to call from several threads
+
+        timeout, chunksize and transport are accepted for compatibility with Connection and ignored:
+        results are already materialized in columnar form
+        """
+        compact = self.compact if compact is None else compact
+
+        with get_tracer().span("read_query", kind="query", **query_attrs(query)) as span:
+            df = self._fetch(query)
+            df = compact_dtypes(df) if compact else df
+            span.record_frame(df)
+        return df
+
+    def _fetch(self, query: str) -> pd.DataFrame:
+        cursor = self.cursor()
+        try:
+            result = cursor.execute(query)
+            df = result.fetchdf()
+            # duckdb renames duplicated columns (NPLV from plavki.* and chugun.*), postgres keeps them
+            df.columns = [column[0] for column in result.description]
+        finally:
+            cursor.close()
+
+        return df
+
+    def explain_analyze(self, query: str) -> str:
+        """
+        EXPLAIN ANALYZE plan of the query as text; the query is executed once more
+        """
+        cursor = self.cursor()
+        try:
+            rows = cursor.execute(f"explain analyze {query}").fetchall()
+        finally:
+            cursor.close()
+        return "\n".join(row[-1] for row in rows)
+
+    def describe_query(self, query: str) -> Optional[pd.DataFrame]:
+        """
+        Empty DataFrame with the columns and dtypes of the query result, see Connection.describe_query
+        """
+        return self.read_query(query, compact=False)
+
+    def table_exists(self, table: str) -> bool:
+        cursor = self.cursor()
+        try:
+            return cursor.execute(
+                "select count(*) from information_schema.tables where table_name = ?", [table]).fetchone()[0] > 0
+        finally:
+            cursor.close()
+
+    def execute(self, statement: str):
+        cursor = self.cursor()
+        try:
+            cursor.execute(statement)
+        finally:
+            cursor.close()
+        return self
+
+    def replace_rows(self, table: str, df: pd.DataFrame, key_column: str, keys: List[object]) -> int:
+        """
+        Deletes rows whose key_column is in keys and appends df in one transaction, see Connection.replace_rows
+        """
+        columns = ", ".join(quote_ident(column) for column in df.columns)
+        cursor = self.cursor()
+        try:
+            cursor.register("replace_rows_frame", df)
+            cursor.execute("begin transaction")
+            cursor.execute(f"create table if not exists {quote_ident(table)} as "
+                           f"select * from replace_rows_frame limit 0")
+            if keys:
+                cursor.execute(f"delete from {quote_ident(table)} where {quote_ident(key_column)} in "
+                               f"(select unnest(?))", [list(keys)])
+            cursor.execute(f"insert into {quote_ident(table)} ({columns}) select {columns} from replace_rows_frame")
+            cursor.execute("commit")
+        except Exception:
+            cursor.execute("rollback")
+            raise
+        finally:
+            cursor.close()
+
+        return len(df)
+
+    def cursor(self):
+        """
+        New cursor (duckdb connection sharing the same database) with postgres-like settings
+        """
+        cursor = self.conn.cursor()
+        # postgres folds unquoted aliases (min_V -> min_v), duckdb preserves them by default
+        cursor.execute("set preserve_identifier_case = false")
+        return cursor
+
+    def set_streaming(self, chunksize: Optional[int] = 50_000, compact: bool = True):
+        self.chunksize = chunksize
+        self.compact = compact
+
+        return self
+
+    def open_conn(self):
+        """
+        Creates in-memory database and registers every csv/parquet file from data_dir as a table
+        """
+        import duckdb
+
+        self.conn = duckdb.connect(":memory:")
+        if self.threads is not None:
+            self.conn.execute(f"set global threads to {int(self.threads)}")
+        # datediff_* functions used by the extractor queries
+        self.conn.execute(self.macros)
+
+        for filename in sorted(os.listdir(self.data_dir)):
+            table, ext = os.path.splitext(filename)
+            path = os.path.join(self.data_dir, filename)
+            if ext == ".csv":
+                self.conn.execute(f"""create table "{table}" as select * from {self.read_csv_sql(table, path)}""")
+            elif ext == ".parquet":
+                self.conn.execute(f"""create view "{table}" as select * from read_parquet('{escape(path)}')""")
+
+        return self
+
+    @staticmethod
+    def read_csv_sql(table: str, path: str) -> str:
+        """
+        read_csv call with column names and types taken from evraz.schema,
+        so sparse columns (chronom.O2) are not inferred as VARCHAR
+        """
+        import csv
+        # imported here: both modules import settings
+        from evraz.loader import column_names
+        from evraz.schema import all_tables
+
+        with open(path, newline='', encoding='utf-8') as f:
+            names = column_names(next(csv.reader(f)))
+
+        types = {'integer': 'INTEGER', 'float8': 'DOUBLE', 'timestamp': 'TIMESTAMP', 'varchar': 'VARCHAR'}
+        schema = {name: types[type_] for name, type_, _ in all_tables().get(table, [])}
+        columns = ", ".join(f"'{escape(name)}': '{schema.get(name, 'VARCHAR')}'" for name in names)
+
+        return f"read_csv('{escape(path)}', header=true, columns={{{columns}}})"
+
+    def close_conn(self):
+        """
+        Close connection
+        """
+        self.conn.close()
+        return self
+
+    def ping(self):
+        """
+        Ping database
+        """
+        self.conn.execute("select 1")
+        return self
@@ -0,0 +1,228 @@
+"""
+Генератор синтетических данных в формате сырых таблиц соревнования
+
+Таблицы plavki, chugun, chronom, sip, gas, produv, lom и таргеты имеют те же колонки и типы,
+что и в devops/schemas.sql (порядок колонок берётся из evraz.schema.TABLES).
+Число плавок и частота отсчётов газа настраиваются, поэтому на этих данных можно мерить,
+как пайплайн масштабируется (см. evraz.benchmark).
+
+Пример запуска:
+
+    PYTHONPATH=. python -m evraz.synthetic ../data/synthetic --heats 10000 --gas-rate 2
+"""
+import argparse
+import os
+import time
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+from evraz.schema import TABLES
+
+OPERATIONS = [
+    'Нагрев лома', 'Завалка лома', 'Заливка чугуна', 'Продувка', 'Повалка',
+    'Замер положения фурм', 'Слив стали', 'Слив шлака', 'Полусухое торкрет.',
+    'Наведение гарнисажа', 'Ожидание стали', 'Неиспр. оборуд', 'Отсутствие O2',
+]
+SIP_MATERIALS = ['Уголь ТО', 'ФЛЮМАГ', 'изв_ЦОИ', 'Флюс ФОМИ', 'Кокс', 'известь']
+LOM_MATERIALS = ['3А', 'НЛ', 'ОБР_ДЕЛ', '3АЖД', 'ПЛ']
+STEEL_GRADES = ['Э76ХФ', 'Св-08А', 'Э90ХАФ', 'St3', '09Г2С']
+
+
+def generate_mode(mode: str,
+                  n_heats: int,
+                  gas_rate: float = 1.0,
+                  seed: int = 0,
+                  first_nplv: int = 510000) -> Dict[str, pd.DataFrame]:
+    """
+    Все таблицы одного режима: имя таблицы без суффикса режима -> датафрейм
+    """
+    rng = np.random.default_rng([seed, mode == 'test'])
+    nplv = first_nplv + np.arange(n_heats)
+
+    start = (
+        pd.Timestamp('2021-01-01')
+        + pd.to_timedelta(np.arange(n_heats) * 3600 + rng.integers(0, 600, n_heats), unit='s')
+    )
+    duration = rng.integers(35 * 60, 60 * 60, n_heats)
+    end = start + pd.to_timedelta(duration, unit='s')
+
+    tables = {}
+    tables['plavki'] = pd.DataFrame({
+        'NPLV': nplv,
+        'plavka_VR_NACH': start,
+        'plavka_VR_KON': end,
+        'plavka_NMZ': rng.choice(STEEL_GRADES, n_heats),
+        'plavka_NAPR_ZAD': rng.choice(['УСТ', 'ОПН'], n_heats),
+        'plavka_STFUT': rng.integers(1, 500, n_heats).astype(float),
+        'plavka_TIPE_FUR': rng.choice(['цилиндрическая', 'конусная'], n_heats),
+        'plavka_ST_FURM': rng.integers(1, 100, n_heats).astype(float),
+        'plavka_TIPE_GOL': rng.choice(['5 сопловая', '6 сопловая'], n_heats),
+        'plavka_ST_GOL': rng.integers(1, 100, n_heats).astype(float),
+    })
+
+    chugun_t = rng.normal(1380, 15, n_heats)
+    chugun_si = rng.uniform(0.2, 0.8, n_heats)
+    tables['chugun'] = pd.DataFrame({
+        'NPLV': nplv,
+        'VES': rng.normal(260_000, 5_000, n_heats),
+        'T': chugun_t,
+        'SI': chugun_si,
+        **{element: rng.uniform(0, 0.5, n_heats) for element in ['MN', 'S', 'P', 'CR', 'NI', 'CU', 'V', 'TI']},
+        'DATA_ZAMERA': start - pd.Timedelta(minutes=20),
+    })
+
+    # операции идут подряд от начала плавки, продувка есть в каждой плавке
+    n_ops = rng.integers(5, len(OPERATIONS), n_heats)
+    op_heat = np.repeat(np.arange(n_heats), n_ops)
+    op_names = np.concatenate([
+        ['Продувка'] + list(rng.choice([op for op in OPERATIONS if op != 'Продувка'], k - 1, replace=False))
+        for k in n_ops
+    ])
+    op_share = rng.uniform(0.5, 1.5, len(op_heat)) * np.where(op_names == 'Продувка', 6, 1)
+    op_share /= np.bincount(op_heat, weights=op_share)[op_heat]
+    op_seconds = op_share * duration[op_heat]
+    # смещение конца операции от начала плавки: сумма длительностей плавки равна duration
+    op_offset = np.cumsum(op_seconds) - np.repeat(np.cumsum(duration) - duration, n_ops)
+    op_start = start[op_heat] + pd.to_timedelta(op_offset - op_seconds, unit='s').round('s')
+    op_end = start[op_heat] + pd.to_timedelta(op_offset, unit='s').round('s')
+    tables['chronom'] = pd.DataFrame({
+        'a': np.arange(len(op_heat)),
+        'NPLV': nplv[op_heat],
+        'TYPE_OPER': 'текущая',
+        'NOP': op_names,
+        'VR_NACH': op_start,
+        'VR_KON': op_end,
+        'O2': np.where(op_names == 'Продувка', op_seconds * rng.uniform(10, 14, len(op_heat)), np.nan),
+    })
+    o2 = pd.Series(tables['chronom']['O2'].fillna(0).to_numpy()).groupby(op_heat).sum().to_numpy()
+
+    n_sip = rng.integers(2, 10, n_heats)
+    sip_heat = np.repeat(np.arange(n_heats), n_sip)
+    tables['sip'] = pd.DataFrame({
+        'NPLV': nplv[sip_heat],
+        'VDSYP': rng.integers(100, 200, len(sip_heat)).astype(float),
+        'NMSYP': rng.choice(SIP_MATERIALS, len(sip_heat)),
+        'VSSYP': rng.integers(100, 3000, len(sip_heat)).astype(float),
+        'DAT_OTD': start[sip_heat] + pd.to_timedelta(
+            rng.uniform(0, 1, len(sip_heat)) * duration[sip_heat], unit='s').round('s'),
+    })
+
+    n_lom = rng.integers(1, 5, n_heats)
+    lom_heat = np.repeat(np.arange(n_heats), n_lom)
+    tables['lom'] = pd.DataFrame({
+        'NPLV': nplv[lom_heat],
+        'VDL': rng.integers(1, 50, len(lom_heat)).astype(float),
+        'NML': rng.choice(LOM_MATERIALS, len(lom_heat)),
+        'VES': rng.uniform(1_000, 40_000, len(lom_heat)),
+    })
+
+    # газ с частотой gas_rate отсчётов в секунду на всей плавке
+    n_gas = np.maximum((duration * gas_rate).astype(int), 1)
+    gas_heat = np.repeat(np.arange(n_heats), n_gas)
+    gas_step = np.arange(len(gas_heat)) - np.repeat(np.cumsum(n_gas) - n_gas, n_gas)
+    gas_time = start[gas_heat] + pd.to_timedelta(gas_step / gas_rate, unit='s')
+    progress = gas_step / n_gas[gas_heat]
+    tables['gas'] = pd.DataFrame({
+        'NPLV': nplv[gas_heat],
+        'Time': gas_time,
+        'V': rng.uniform(0, 250_000, len(gas_heat)),
+        'T': 300 + 600 * progress + rng.normal(0, 30, len(gas_heat)),
+        'O2': rng.uniform(0, 20, len(gas_heat)),
+        'N2': rng.uniform(0, 80, len(gas_heat)),
+        'H2': rng.uniform(0, 5, len(gas_heat)),
+        'CO2': rng.uniform(0, 30, len(gas_heat)),
+        'CO': 60 * np.sin(np.pi * progress) + rng.normal(0, 3, len(gas_heat)),
+        'AR': rng.uniform(0, 2, len(gas_heat)),
+        'T фурмы 1': rng.normal(30, 3, len(gas_heat)),
+        'T фурмы 2': rng.normal(30, 3, len(gas_heat)),
+        'O2_pressure': rng.uniform(8, 14, len(gas_heat)),
+    })
+
+    # продувка: раз в секунду, только во время операции продувки
+    blow = tables['chronom'][op_names == 'Продувка']
+    n_produv = np.maximum(((blow['VR_KON'] - blow['VR_NACH']).dt.total_seconds().to_numpy()).astype(int), 1)
+    produv_heat = np.repeat(np.arange(len(blow)), n_produv)
+    produv_step = np.arange(len(produv_heat)) - np.repeat(np.cumsum(n_produv) - n_produv, n_produv)
+    tables['produv'] = pd.DataFrame({
+        'NPLV': blow['NPLV'].to_numpy()[produv_heat],
+        'SEC': blow['VR_NACH'].to_numpy()[produv_heat] + pd.to_timedelta(produv_step, unit='s'),
+        'RAS': rng.uniform(800, 1200, len(produv_heat)),
+        'POL': rng.uniform(1.5, 3.0, len(produv_heat)),
+    })
+
+    for name, columns in TABLES.items():
+        tables[name] = tables[name][[column for column, _, _ in columns]]
+
+    # таргет зависит от чугуна, кислорода и длительности, чтобы модели было что выучить
+    target = pd.DataFrame({
+        'NPLV': nplv,
+        'TST': 1650 + 0.5 * (chugun_t - 1380) + 0.002 * (o2 - o2.mean()) + rng.normal(0, 10, n_heats),
+        'C': np.clip(0.06 - 0.03 * (chugun_si - 0.5) - 1e-5 * (duration - duration.mean()) +
+                     rng.normal(0, 0.01, n_heats), 0.01, None),
+    })
+    if mode == 'train':
+        tables['target_train'] = target
+    else:
+        tables['sample_submission'] = target.assign(TST=np.nan, C=np.nan)
+
+    return tables
+
+
+def generate(out_dir: str,
+             n_heats: int = 1000,
+             gas_rate: float = 1.0,
+             test_fraction: float = 0.2,
+             fmt: str = 'csv',
+             seed: int = 0) -> Dict[str, int]:
+    """
+    Запись всех таблиц train и test в out_dir, n_heats - число плавок в train.
+
+    fmt='csv' - файлы для evraz.loader и DuckDBConnection, fmt='parquet' - только для DuckDBConnection.
+    Возвращает число строк каждой таблицы
+    """
+    if fmt not in ('csv', 'parquet'):
+        raise ValueError(f"fmt must be 'csv' or 'parquet', got {fmt}")
+    os.makedirs(out_dir, exist_ok=True)
+
+    rows = {}
+    modes = (
+        ('train', n_heats, 510000),
+        ('test', max(int(n_heats * test_fraction), 1), 510000 + n_heats),
+    )
+    for mode, heats, first_nplv in modes:
+        start = time.time()
+        for name, df in generate_mode(mode, heats, gas_rate, seed, first_nplv).items():
+            table = name if name in ('target_train', 'sample_submission') else f"{name}_{mode}"
+            path = os.path.join(out_dir, f"{table}.{fmt}")
+            if fmt == 'parquet':
+                df.to_parquet(path, index=False)
+            elif name == 'chronom':
+                # в исходных данных индекс chronom записан безымянной колонкой
+                df.rename(columns={'a': ''}).to_csv(path, index=False)
+            else:
+                df.to_csv(path, index=False)
+            rows[table] = len(df)
+        print(f"Generated {mode} data for {heats} heats in {time.time() - start:.1f}s")
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic raw tables")
+    parser.add_argument("out_dir")
+    parser.add_argument("--heats", type=int, default=1000, help="number of train heats")
+    parser.add_argument("--gas-rate", type=float, default=1.0, help="gas samples per second")
+    parser.add_argument("--test-fraction", type=float, default=0.2)
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rows = generate(args.out_dir, args.heats, args.gas_rate, args.test_fraction, args.format, args.seed)
+    for table, n in rows.items():
+        print(f"{table}: {n} rows")
+
+
+if __name__ == "__main__":
+    main()
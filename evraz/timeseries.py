@@ -0,0 +1,349 @@
+"""
+Колоночное хранилище временных рядов gas и produv с отображением в память
+
+Таблица режима хранится в директории {root}/{table}_{mode}:
+
+    heats.npy    - номера плавок по возрастанию
+    offsets.npy  - границы плавок: отсчёты плавки heats[i] занимают строки offsets[i]:offsets[i + 1]
+    time.npy     - время отсчёта (int64, наносекунды), внутри плавки по возрастанию
+    {сигнал}.npy - значения сигнала (float32)
+    meta.json    - сигналы, имена файлов и отпечаток исходной таблицы (число строк и максимальный NPLV)
+
+Массивы открываются через np.load(mmap_mode='r'), поэтому срез одной плавки (TimeSeries.heat)
+не копирует данные и не читает с диска ничего, кроме страниц этой плавки.
+Хранилище собирается из бд кусками по batch_rows строк и пересобирается при изменении отпечатка таблицы.
+
+Функции signal_features и timeseries_features считают оконные признаки всех плавок векторизованно:
+наклоны (за плавку и за последние window_seconds), статистики фаз плавки и кривую,
+передискретизированную в n_points точек (см. TimeSeriesFeatures в evraz.features)
+"""
+import json
+import os
+import shutil
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from slugify import slugify
+
+# таблица -> колонка времени и сигналы
+SOURCES: Dict[str, Tuple[str, List[str]]] = {
+    'gas': ('Time', ['V', 'T', 'O2', 'N2', 'H2', 'CO2', 'CO', 'AR', 'T фурмы 1', 'T фурмы 2', 'O2_pressure']),
+    'produv': ('SEC', ['RAS', 'POL']),
+}
+
+# так np.datetime64('NaT') выглядит в массиве time
+NAT = np.iinfo(np.int64).min
+
+
+def signal_file(signal: str) -> str:
+    return f"{slugify(signal, separator='_')}.npy"
+
+
+class TimeSeries:
+    """
+    Временные ряды одной таблицы одного режима, открытые в память
+    """
+    def __init__(self, path: str, mmap_mode: Optional[str] = 'r'):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+        self.heats = np.load(os.path.join(path, 'heats.npy'))
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.time = np.load(os.path.join(path, 'time.npy'), mmap_mode=mmap_mode)
+        self.values = {
+            signal: np.load(os.path.join(path, filename), mmap_mode=mmap_mode)
+            for signal, filename in self.meta['signals'].items()
+        }
+
+    @property
+    def signals(self) -> List[str]:
+        return list(self.values)
+
+    def __len__(self) -> int:
+        return len(self.heats)
+
+    def __contains__(self, nplv: int) -> bool:
+        i = np.searchsorted(self.heats, nplv)
+        return i < len(self.heats) and self.heats[i] == nplv
+
+    def bounds(self, nplv: int) -> Tuple[int, int]:
+        """
+        Строки плавки nplv; для отсутствующей плавки - пустой диапазон
+        """
+        i = np.searchsorted(self.heats, nplv)
+        if i == len(self.heats) or self.heats[i] != nplv:
+            return 0, 0
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def heat(self, nplv: int, signals: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+        """
+        Срез плавки без копирования: 'time' и значения сигналов signals (по умолчанию всех)
+        """
+        start, end = self.bounds(nplv)
+        signals = self.signals if signals is None else signals
+        return {'time': self.time[start:end], **{signal: self.values[signal][start:end] for signal in signals}}
+
+
+class TimeSeriesStore:
+    """
+    Директория с временными рядами всех таблиц и режимов
+
+        store = TimeSeriesStore("../data/timeseries")
+        gas = store.get(conn, 'gas', 'train')
+        gas.heat(510001)['T']
+    """
+    fingerprint_template = """select count(*) "rows", max("NPLV") "max_nplv" from {table}"""
+
+    def __init__(self, root: str = "../data/timeseries", batch_rows: int = 2_000_000):
+        self.root = root
+        # сколько строк читается из бд за один запрос при сборке
+        self.batch_rows = batch_rows
+        self.series: Dict[str, TimeSeries] = {}
+
+    def path(self, table: str, mode: str) -> str:
+        return os.path.join(self.root, f"{table}_{mode}")
+
+    def fingerprint(self, conn, table: str, mode: str) -> str:
+        df = conn.read_query(self.fingerprint_template.format(table=f"{table}_{mode}"), compact=False)
+        return df.astype(str).to_csv(index=False)
+
+    def get(self, conn, table: str, mode: str) -> TimeSeries:
+        """
+        Открытые ряды таблицы; собираются заново, если исходная таблица изменилась
+        """
+        path = self.path(table, mode)
+        fingerprint = self.fingerprint(conn, table, mode)
+
+        series = self.series.get(path)
+        if series is None and os.path.exists(os.path.join(path, 'meta.json')):
+            series = TimeSeries(path)
+        if series is None or series.meta['fingerprint'] != fingerprint:
+            series = self.build(conn, table, mode, fingerprint)
+
+        self.series[path] = series
+        return series
+
+    def build(self, conn, table: str, mode: str, fingerprint: Optional[str] = None) -> TimeSeries:
+        """
+        Сборка рядов из бд: плавки читаются диапазонами NPLV примерно по batch_rows строк
+        и пишутся в заранее выделенные массивы, так что в памяти не бывает больше одного куска
+        """
+        time_column, signals = SOURCES[table]
+        source = f"{table}_{mode}"
+        fingerprint = self.fingerprint(conn, table, mode) if fingerprint is None else fingerprint
+
+        counts = conn.read_query(
+            f'select "NPLV", count(*) "rows" from {source} where "NPLV" is not null group by "NPLV" order by "NPLV"',
+            compact=False
+        )
+        heats = counts["NPLV"].to_numpy(dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(counts["rows"].to_numpy(dtype=np.int64))])
+        n_rows = int(offsets[-1])
+
+        path = self.path(table, mode)
+        tmp_path = path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        open_memmap = np.lib.format.open_memmap
+        time = open_memmap(os.path.join(tmp_path, 'time.npy'), mode='w+', dtype=np.int64, shape=(n_rows,))
+        values = {
+            signal: open_memmap(os.path.join(tmp_path, signal_file(signal)), mode='w+', dtype=np.float32,
+                                shape=(n_rows,))
+            for signal in signals
+        }
+
+        columns = ", ".join(f'"{column}"' for column in [time_column] + signals)
+        first = 0
+        while first < len(heats):
+            # последняя плавка куска: набираем плавки, пока не наберётся batch_rows строк
+            last = max(int(np.searchsorted(offsets, offsets[first] + self.batch_rows, side='right')) - 2, first)
+            start, end = offsets[first], offsets[last + 1]
+            df = conn.read_query(
+                f'select {columns} from {source} where "NPLV" between {heats[first]} and {heats[last]} '
+                # NaT хранится как минимальный int64, поэтому пустое время идёт первым
+                f'order by "NPLV", "{time_column}" nulls first',
+                compact=False
+            )
+            if len(df) != end - start:
+                raise RuntimeError(f"{source} has changed while building the time series store")
+
+            time[start:end] = df[time_column].to_numpy(dtype='datetime64[ns]').view(np.int64)
+            for signal in signals:
+                values[signal][start:end] = df[signal].to_numpy(dtype=np.float32)
+            first = last + 1
+
+        time.flush()
+        for array in values.values():
+            array.flush()
+        del time, values
+
+        np.save(os.path.join(tmp_path, 'heats.npy'), heats)
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({
+                'table': source,
+                'time_column': time_column,
+                'signals': {signal: signal_file(signal) for signal in signals},
+                'rows': n_rows,
+                'fingerprint': fingerprint,
+            }, f, ensure_ascii=False, indent=2)
+
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        print(f"Built time series store {path}: {len(heats)} heats, {n_rows} rows")
+
+        return TimeSeries(path)
+
+
+def series_feature_names(prefix: str, n_phases: int, n_points: int) -> List[str]:
+    """
+    Порядок признаков одного сигнала, который возвращает timeseries_features
+    """
+    names = [f"{prefix}_{name}" for name in ('avg', 'std', 'slope', 'slope_last')]
+    for phase in range(n_phases):
+        names.extend(f"{prefix}_phase{phase}_{name}" for name in ('avg', 'std', 'slope'))
+    names.extend(f"{prefix}_r{point}" for point in range(n_points))
+    return names
+
+
+def group_stats(group: np.ndarray,
+                n_groups: int,
+                t: np.ndarray,
+                x: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Среднее, std и наклон прямой наименьших квадратов x(t) в каждой группе одним проходом bincount.
+
+    Отклонения считаются от средних группы (два прохода), чтобы не терять точность на больших значениях.
+    Для групп без точек - nan, std и наклон требуют хотя бы двух точек
+    """
+    n = np.bincount(group, minlength=n_groups).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_mean = np.bincount(group, x, n_groups) / n
+        t_mean = np.bincount(group, t, n_groups) / n
+        xc = x - x_mean[group]
+        tc = t - t_mean[group]
+        var = np.bincount(group, xc * xc, n_groups) / (n - 1)
+        t_var = np.bincount(group, tc * tc, n_groups)
+        slope = np.bincount(group, tc * xc, n_groups) / t_var
+
+    std = np.where(n > 1, np.sqrt(np.maximum(var, 0)), np.nan)
+    slope = np.where((n > 1) & (t_var > 0), slope, np.nan)
+    return x_mean, std, slope
+
+
+def segment_bounds(segment: np.ndarray, n_segments: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Первая и следующая за последней позиции каждого сегмента в отсортированном массиве segment
+    """
+    ids = np.arange(n_segments)
+    return np.searchsorted(segment, ids, side='left'), np.searchsorted(segment, ids, side='right')
+
+
+def signal_features(segment: np.ndarray,
+                    n_segments: int,
+                    seconds: np.ndarray,
+                    x: np.ndarray,
+                    n_phases: int = 3,
+                    n_points: int = 10,
+                    window_seconds: float = 300) -> List[np.ndarray]:
+    """
+    Признаки одного сигнала для всех сегментов (плавок) сразу, в порядке series_feature_names.
+
+    segment - номер плавки каждого отсчёта (по возрастанию), seconds - время от начала плавки.
+    Среднее, std и наклон (в единицах сигнала за минуту) за всю плавку и наклон за последние window_seconds;
+    среднее, std и наклон каждой из n_phases равных по времени фаз; значения кривой в n_points
+    равноотстоящих точках (линейная интерполяция, как np.interp). Пропуски сигнала не учитываются
+    """
+    finite = np.isfinite(x)
+    segment, seconds, x = segment[finite], seconds[finite], x[finite].astype(np.float64)
+    minutes = seconds / 60
+
+    starts, stops = segment_bounds(segment, n_segments)
+    present = stops > starts
+    first = np.where(present, seconds[np.minimum(starts, len(seconds) - 1)] if len(seconds) else 0, np.nan)
+    last = np.where(present, seconds[np.maximum(stops - 1, 0)] if len(seconds) else 0, np.nan)
+
+    avg, std, slope = group_stats(segment, n_segments, minutes, x)
+    features = [avg, std, slope]
+
+    window = seconds >= last[segment] - window_seconds
+    features.append(group_stats(segment[window], n_segments, minutes[window], x[window])[2])
+
+    duration = (last - first)[segment]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        phase = np.where(duration > 0, np.floor((seconds - first[segment]) / duration * n_phases), n_phases - 1)
+    phase = np.clip(phase, 0, n_phases - 1).astype(np.int64)
+    phase_stats = group_stats(segment * n_phases + phase, n_segments * n_phases, minutes, x)
+    for i in range(n_phases):
+        features.extend(stat[i::n_phases] for stat in phase_stats)
+
+    # интерполяция всех сегментов одним searchsorted: время сдвигается на номер сегмента * span
+    span = np.nanmax(last - first, initial=0) + 1
+    offset = np.arange(n_segments) * span - np.nan_to_num(first)
+    shifted = seconds + offset[segment]
+    for k in range(n_points):
+        fraction = k / (n_points - 1) if n_points > 1 else 0.0
+        grid = np.nan_to_num(first + (last - first) * fraction) + offset
+        left = np.clip(np.searchsorted(shifted, grid, side='right') - 1, starts, np.maximum(stops - 1, starts))
+        right = np.minimum(left + 1, np.maximum(stops - 1, starts))
+        values = np.full(n_segments, np.nan)
+        if len(x):
+            left, right = left[present], right[present]
+            dt = shifted[right] - shifted[left]
+            with np.errstate(invalid='ignore', divide='ignore'):
+                weight = np.where(dt > 0, (grid[present] - shifted[left]) / dt, 0.0)
+            values[present] = x[left] + (x[right] - x[left]) * np.clip(weight, 0, 1)
+        features.append(values)
+
+    return features
+
+
+def timeseries_features(series: Dict[str, TimeSeries],
+                        signals: Dict[str, Sequence[str]],
+                        heats: Sequence[int],
+                        ends: Optional[Dict[int, np.datetime64]] = None,
+                        n_phases: int = 3,
+                        n_points: int = 10,
+                        window_seconds: float = 300) -> pd.DataFrame:
+    """
+    Признаки signal_features по сигналам signals[таблица] каждой плавки heats.
+
+    Отсчёты всех плавок собираются по срезам хранилища в один массив, после чего признаки
+    считаются векторизованно по сегментам (плавкам), без цикла по плавкам.
+    ends - время окончания плавки: отсчёты после него отбрасываются (как в sql экстракторах).
+    Колонки: NPLV и {таблица}_{сигнал}_{признак}, у плавок без отсчётов признаки пустые
+    """
+    heats = np.asarray(heats, dtype=np.int64)
+    ends = ends or {}
+    columns = {'NPLV': heats}
+
+    for table, table_signals in signals.items():
+        ts = series[table]
+        lo = np.zeros(len(heats), dtype=np.int64)
+        hi = np.zeros(len(heats), dtype=np.int64)
+        for i, nplv in enumerate(heats):
+            start, stop = ts.bounds(nplv)
+            time = ts.time[start:stop]
+            # отсчёты без времени в начале среза и после окончания плавки отбрасываются
+            first = start + int(np.searchsorted(time, NAT, side='right'))
+            end = ends.get(nplv)
+            if end is not None and not np.isnat(end):
+                stop = start + int(np.searchsorted(time, end.astype('datetime64[ns]').astype(np.int64)))
+            lo[i], hi[i] = first, max(stop, first)
+
+        lengths = hi - lo
+        segment = np.repeat(np.arange(len(heats)), lengths)
+        positions = np.repeat(lo - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        time = ts.time[positions]
+        seconds = (time - np.repeat(ts.time[lo[lengths > 0]], lengths[lengths > 0])) / 1e9
+
+        for signal in table_signals:
+            prefix = f"{table}_{slugify(signal, separator='_')}"
+            features = signal_features(segment, len(heats), seconds, ts.values[signal][positions],
+                                       n_phases, n_points, window_seconds)
+            columns.update(zip(series_feature_names(prefix, n_phases, n_points), features))
+
+    return pd.DataFrame(columns)
@@ -0,0 +1,247 @@
+"""
+Структурированная трассировка этапов пайплайна
+
+Каждый этап (запрос к бд, экстрактор, обучение и предсказание модели) записывается как span:
+время выполнения, число строк и объём полученного датафрейма, прирост пика памяти процесса
+(ru_maxrss: меняется, только если этап поднял максимум, освобождённая после пика память не видна)
+и произвольные атрибуты, например текст запроса и EXPLAIN (ANALYZE, BUFFERS).
+Вложенность восстанавливается по parent_id, в том числе для экстракторов из пула потоков.
+
+Трасса сохраняется в json (save), summary сводит её в таблицу, где самые медленные этапы идут первыми:
+
+    from evraz.tracing import get_tracer
+    tracer = get_tracer().enable(explain=True)
+    ...
+    tracer.save("../data/traces/run.json")
+    tracer.print_summary()
+"""
+import hashlib
+import itertools
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+import pandas as pd
+
+
+def max_rss_mb() -> float:
+    """
+    Пик резидентной памяти процесса в Мб (ru_maxrss в килобайтах на linux и в байтах на macos)
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def query_id(query: str) -> str:
+    return hashlib.sha1(query.encode()).hexdigest()[:12]
+
+
+def query_preview(query: str, length: int = 160) -> str:
+    preview = re.sub(r'\s+', ' ', query).strip()
+    return preview if len(preview) <= length else preview[:length - 3] + '...'
+
+
+class Span:
+    """
+    Один этап: время, строки, байты, прирост пика памяти и атрибуты
+    """
+    def __init__(self, span_id: int, parent_id: Optional[int], name: str, kind: str, attrs: dict,
+                 enabled: bool = True):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attrs = attrs
+        self.thread = threading.current_thread().name
+        self.started_at = time.time()
+        self.wall_seconds = None
+        self.rows = None
+        self.bytes = None
+        self.peak_rss_delta_mb = None
+        self.error = None
+        self.enabled = enabled
+
+    def record_frame(self, df: pd.DataFrame):
+        """
+        Размер результата этапа; у выключенного трейсера memory_usage(deep=True) не считается
+        """
+        if not self.enabled:
+            return self
+        self.rows = len(df)
+        self.bytes = int(df.memory_usage(deep=True).sum())
+        return self
+
+    def to_dict(self) -> dict:
+        return {
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'thread': self.thread,
+            'started_at': self.started_at,
+            'wall_seconds': self.wall_seconds,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'peak_rss_delta_mb': self.peak_rss_delta_mb,
+            'error': self.error,
+            **self.attrs,
+        }
+
+
+class Tracer:
+    """
+    Сборщик span'ов. Выключенный трейсер не записывает ничего, накладные расходы - один вызов contextmanager
+    """
+    def __init__(self):
+        self.enabled = False
+        # снимать EXPLAIN (ANALYZE, BUFFERS) запросов экстракторов: запрос выполняется второй раз
+        self.explain = False
+        self.spans: List[Span] = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, explain: bool = False):
+        self.enabled = True
+        self.explain = explain
+        return self
+
+    def disable(self):
+        self.enabled = False
+        self.explain = False
+        return self
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+        return self
+
+    def _stack(self) -> List[int]:
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current_id(self) -> Optional[int]:
+        """
+        Текущий span потока: передаётся в span(parent_id=...) задач, запущенных в других потоках
+        """
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def attach(self, parent_id: Optional[int]):
+        """
+        Вложение span'ов текущего потока в parent_id (span другого потока)
+        """
+        stack = self._stack()
+        if parent_id is None:
+            yield
+            return
+        stack.append(parent_id)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    @contextmanager
+    def span(self, name: str, kind: str = 'stage', parent_id: Optional[int] = None, **attrs) -> Iterator[Span]:
+        """
+        Запись этапа name, внутри блока span можно дополнить через record_frame и attrs
+        """
+        stack = self._stack()
+        parent_id = parent_id if parent_id is not None else (stack[-1] if stack else None)
+        span = Span(next(self._ids), parent_id, name, kind, attrs, self.enabled)
+        if not self.enabled:
+            yield span
+            return
+
+        rss_before = max_rss_mb()
+        start = time.perf_counter()
+        stack.append(span.span_id)
+        try:
+            yield span
+        except Exception as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            span.wall_seconds = time.perf_counter() - start
+            span.peak_rss_delta_mb = max_rss_mb() - rss_before
+            with self._lock:
+                self.spans.append(span)
+
+    def to_frame(self) -> pd.DataFrame:
+        with self._lock:
+            return pd.DataFrame([span.to_dict() for span in self.spans])
+
+    def save(self, path: str):
+        """
+        Трасса в json: список span'ов в порядке завершения
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            spans = [span.to_dict() for span in self.spans]
+        with open(path, 'w') as f:
+            json.dump({'spans': spans}, f, ensure_ascii=False, indent=2, default=str)
+        return self
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Сводка по этапам: число вызовов, суммарное и максимальное время, строки, Мб и прирост пика памяти.
+
+        Запросы группируются по тексту, так что самый медленный запрос виден сразу
+        """
+        df = self.to_frame()
+        if df.empty:
+            return df
+
+        key = df['name']
+        if 'query_id' in df.columns:
+            key = df['query_id'].fillna(df['name'])
+        df = df.assign(key=key, mb=df['bytes'] / 2 ** 20)
+        summary = (
+            df.groupby(['kind', 'key'], sort=False)
+            .agg(name=('name', 'first'),
+                 calls=('span_id', 'count'),
+                 total_seconds=('wall_seconds', 'sum'),
+                 max_seconds=('wall_seconds', 'max'),
+                 rows=('rows', 'sum'),
+                 mb=('mb', 'sum'),
+                 peak_rss_delta_mb=('peak_rss_delta_mb', 'max'))
+            .reset_index()
+        )
+        if 'query' in df.columns:
+            summary['query'] = df.groupby(['kind', 'key'], sort=False)['query'].first().to_numpy()
+        return summary.drop(columns='key').sort_values('total_seconds', ascending=False, ignore_index=True)
+
+    def print_summary(self, top: int = 20):
+        summary = self.summary()
+        if summary.empty:
+            print("Trace is empty")
+            return
+        with pd.option_context('display.max_colwidth', 80, 'display.width', 200):
+            print(summary.head(top).to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """
+    Общий трейсер процесса
+    """
+    return _tracer
+
+
+def query_attrs(query: str) -> dict:
+    """
+    Атрибуты span'а запроса: короткий идентификатор и сжатый текст
+    """
+    return {'query_id': query_id(query), 'query': query_preview(query)}
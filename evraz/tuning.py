@@ -0,0 +1,225 @@
+"""
+Подбор параметров CatBoost для BaselineModel последовательным делением (successive halving)
+
+Случайные конфигурации из пространства параметров проходят несколько раундов.
+На первом раунде каждая обучается с небольшим числом итераций на нескольких фолдах,
+после раунда остаётся лучшая 1/eta часть, а число итераций и фолдов растёт,
+так что полный бюджет (max_iterations на всех фолдах) получают только несколько конфигураций.
+
+Оценка - хит-рейт бизнес-метрики (evraz.metrics): при per_target=True параметры
+TST и C подбираются независимо по хит-рейту своего таргета (метрика - их среднее),
+иначе одни параметры на оба таргета по metric.
+time_budget - общий лимит в секундах: после него новые обучения не запускаются,
+а лучшей считается конфигурация последнего завершённого раунда.
+
+    search = SuccessiveHalvingSearch({'verbose': 0}, time_budget=600).fit(X, y)
+    model = search.best_estimator()
+"""
+import math
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import KFold
+
+from evraz.metrics import hit_rate
+from evraz.model import BaselineModel, QuantizedDataset
+from evraz.tracing import get_tracer
+
+# значение параметра - список вариантов или функция от генератора случайных чисел
+DEFAULT_SPACE: Dict[str, object] = {
+    'depth': [4, 5, 6, 7, 8],
+    'learning_rate': lambda rng: float(np.exp(rng.uniform(np.log(0.01), np.log(0.3)))),
+    'l2_leaf_reg': lambda rng: float(np.exp(rng.uniform(np.log(1), np.log(30)))),
+    'random_strength': lambda rng: float(rng.uniform(0, 2)),
+    'bagging_temperature': lambda rng: float(rng.uniform(0, 1)),
+}
+
+
+def sample_params(space: Dict[str, object], n: int, random_state: int = 42) -> List[dict]:
+    """
+    n случайных конфигураций из пространства space
+    """
+    rng = np.random.default_rng(random_state)
+    configs = []
+    for _ in range(n):
+        params = {}
+        for name, values in space.items():
+            if callable(values):
+                params[name] = values(rng)
+            else:
+                params[name] = values[rng.integers(len(values))]
+                params[name] = params[name].item() if isinstance(params[name], np.generic) else params[name]
+        configs.append(params)
+    return configs
+
+
+class SuccessiveHalvingSearch:
+    """
+    Поиск параметров BaselineModel с отсевом слабых конфигураций и общим лимитом времени
+
+    model_params - общие параметры моделей (verbose, cat_features, ...), конфигурации их дополняют,
+    n_configs - число случайных конфигураций на первом раунде,
+    eta - во сколько раз сокращается число конфигураций и растёт число итераций на каждом раунде,
+    min_iterations, max_iterations - итерации бустинга на первом и последнем раунде,
+    cv - разбиение на фолды (по умолчанию KFold на 5 фолдов), min_folds - фолдов на первом раунде
+    """
+    targets = ['TST', 'C']
+
+    def __init__(self,
+                 model_params: dict,
+                 space: Optional[Dict[str, object]] = None,
+                 n_configs: int = 27,
+                 eta: int = 3,
+                 min_iterations: int = 100,
+                 max_iterations: int = 900,
+                 cv=None,
+                 min_folds: int = 2,
+                 time_budget: Optional[float] = 600,
+                 per_target: bool = True,
+                 random_state: int = 42):
+        self.model_params = model_params
+        self.space = space if space is not None else DEFAULT_SPACE
+        self.n_configs = n_configs
+        self.eta = eta
+        self.min_iterations = min_iterations
+        self.max_iterations = max_iterations
+        self.cv = cv if cv is not None else KFold(n_splits=5, random_state=random_state, shuffle=True)
+        self.min_folds = min_folds
+        self.time_budget = time_budget
+        self.per_target = per_target
+        self.random_state = random_state
+
+        self.best_params_: Dict[str, dict] = {}
+        self.best_scores_: Dict[str, float] = {}
+        self.results_ = pd.DataFrame()
+        self.dataset_: Optional[QuantizedDataset] = None
+
+    def rungs(self, n_splits: int) -> List[Tuple[int, int]]:
+        """
+        (итерации, фолды) каждого раунда: итерации растут в eta раз до max_iterations,
+        фолды - равномерно от min_folds до всех
+        """
+        n_rungs = 1
+        while (self.min_iterations * self.eta ** n_rungs <= self.max_iterations
+               and self.n_configs // self.eta ** n_rungs >= 1):
+            n_rungs += 1
+
+        min_folds = min(self.min_folds, n_splits)
+        folds = np.linspace(min_folds, n_splits, n_rungs).round().astype(int)
+        iterations = [min(self.min_iterations * self.eta ** rung, self.max_iterations) for rung in range(n_rungs)]
+        iterations[-1] = self.max_iterations
+        return list(zip(iterations, folds.tolist()))
+
+    def time_left(self) -> float:
+        if self.time_budget is None:
+            return math.inf
+        return self.time_budget - (time.time() - self._start)
+
+    def evaluate(self,
+                 params: dict,
+                 targets: Sequence[str],
+                 iterations: int,
+                 X: pd.DataFrame,
+                 y: pd.DataFrame,
+                 folds: Sequence[Tuple[np.ndarray, np.ndarray]],
+                 dataset: QuantizedDataset,
+                 deadline: float) -> Optional[float]:
+        """
+        Средний по таргетам хит-рейт out-of-fold предсказаний на фолдах folds,
+        None, если время закончилось до конца оценки
+        """
+        model_params = dict(self.model_params, **params, iterations=iterations)
+        y_pred = pd.DataFrame(np.nan, index=y.index, columns=list(targets))
+        test_index = np.concatenate([test for _, test in folds])
+
+        for train, test in folds:
+            if time.time() >= deadline:
+                return None
+            model = BaselineModel(dict(model_params), dataset=dataset)
+            for target in targets:
+                model.fit_target(X.iloc[train], y.iloc[train], target)
+                y_pred.iloc[test, y_pred.columns.get_loc(target)] = model.predict_target(X.iloc[test], target)
+
+        return float(np.mean([hit_rate(y.iloc[test_index], y_pred.iloc[test_index], target) for target in targets]))
+
+    def search(self,
+               targets: Sequence[str],
+               X: pd.DataFrame,
+               y: pd.DataFrame,
+               folds: Sequence[Tuple[np.ndarray, np.ndarray]],
+               dataset: QuantizedDataset,
+               deadline: float) -> Tuple[dict, float, List[dict]]:
+        """
+        Successive halving для одной группы таргетов, возвращает лучшие параметры, их оценку и журнал раундов
+        """
+        name = '+'.join(targets)
+        configs = list(enumerate(sample_params(self.space, self.n_configs, self.random_state)))
+        best = ({}, math.nan, self.min_iterations)
+        log = []
+
+        for rung, (iterations, n_folds) in enumerate(self.rungs(len(folds))):
+            with get_tracer().span("SuccessiveHalvingSearch.rung", kind="model", target=name, rung=rung,
+                                   configs=len(configs), iterations=iterations, folds=n_folds):
+                scores = []
+                for config_id, params in configs:
+                    if time.time() >= deadline:
+                        break
+                    start = time.time()
+                    score = self.evaluate(params, targets, iterations, X, y, folds[:n_folds], dataset, deadline)
+                    if score is None:
+                        break
+                    scores.append((score, config_id, params))
+                    log.append({'targets': name, 'rung': rung, 'config': config_id, 'iterations': iterations,
+                                'folds': n_folds, 'score': score, 'seconds': time.time() - start, **params})
+
+            complete = len(scores) == len(configs)
+            if scores and (complete or math.isnan(best[1])):
+                # оценки неполного раунда используются, только если нет ни одного завершённого
+                score, _, params = max(scores, key=lambda item: item[0])
+                best = (params, score, iterations)
+            print(f"{name}: rung {rung}, {len(scores)}/{len(configs)} configs with {iterations} iterations "
+                  f"on {n_folds} folds, best score {best[1]:.4f}, {self.time_left():.0f}s left")
+            if not complete or len(configs) == 1:
+                break
+
+            scores.sort(key=lambda item: item[0], reverse=True)
+            configs = [(config_id, params) for _, config_id, params in scores[:max(1, len(scores) // self.eta)]]
+
+        params, score, iterations = best
+        return dict(params, iterations=iterations), score, log
+
+    def fit(self, X: pd.DataFrame, y: pd.DataFrame, dataset: Optional[QuantizedDataset] = None):
+        """
+        Подбор параметров; квантование выполняется один раз, все конфигурации и фолды
+        берут выборки из общего QuantizedDataset
+        """
+        self._start = time.time()
+        folds = list(self.cv.split(X, y))
+        dataset = dataset if dataset is not None else QuantizedDataset(X, y, self.model_params.get('cat_features'))
+        self.dataset_ = dataset
+        groups = [[target] for target in self.targets] if self.per_target else [self.targets]
+
+        logs = []
+        for i, targets in enumerate(groups):
+            # оставшееся время делится поровну между группами таргетов, которые ещё не подбирались
+            deadline = time.time() + self.time_left() / (len(groups) - i)
+            params, score, log = self.search(targets, X, y, folds, dataset, deadline)
+            logs.extend(log)
+            for target in targets:
+                self.best_params_[target] = params
+                self.best_scores_[target] = score
+
+        self.results_ = pd.DataFrame(logs)
+        print(f"Search finished in {time.time() - self._start:.1f}s, "
+              f"best score {np.nanmean(list(self.best_scores_.values())):.4f}")
+        return self
+
+    def best_estimator(self, dataset: Optional[QuantizedDataset] = None) -> BaselineModel:
+        """
+        Необученная BaselineModel с найденными параметрами каждого таргета,
+        по умолчанию на том же квантованном датасете, что и поиск
+        """
+        dataset = dataset if dataset is not None else self.dataset_
+        return BaselineModel(dict(self.model_params), dataset=dataset, target_params=self.best_params_)
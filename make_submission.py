@@ -1,50 +1,110 @@
 import os
 
-from sklearn.model_selection import KFold, cross_val_score
+from sklearn.model_selection import KFold
 
-from evraz.features import AllFeaturesExtractor
-from evraz.metrics import sklearn_scorer
+from evraz.artifacts import save_artifact
+from evraz.cv import cross_validate_parallel
+from evraz.features import AllFeaturesExtractor, FeatureCache, FeatureStore
 from evraz.model import LightAutoMLModel
-from evraz.settings import Connection
+from evraz.pruning import FeaturePruner
+from evraz.settings import Connection, DuckDBConnection
+from evraz.timeseries import TimeSeriesStore
+from evraz.tracing import get_tracer
+from evraz.tuning import SuccessiveHalvingSearch
 
 
 def main():
-    # Establish connection
-    conn = Connection().open_conn().ping()
-
-    # Extract features from db
-    fe = AllFeaturesExtractor(conn).fit()
+    # TRACE=path records every query, extractor and model stage into a json trace,
+    # TRACE_EXPLAIN=1 additionally captures EXPLAIN (ANALYZE, BUFFERS) of extractor queries
+    if os.environ.get("TRACE"):
+        get_tracer().enable(explain=bool(os.environ.get("TRACE_EXPLAIN")))
+
+    # Establish connection (results are streamed in chunks and stored in compact dtypes)
+    if os.environ.get("BACKEND") == "duckdb":
+        # in-process backend over raw files, no postgres required
+        conn = DuckDBConnection("../data/raw").open_conn().set_streaming().ping()
+    else:
+        # TRANSPORT=copy fetches results with COPY TO STDOUT parsed by pyarrow instead of the DBAPI cursor
+        conn = Connection().open_conn().set_streaming().set_transport(os.environ.get("TRANSPORT", "dbapi")).ping()
+
+    # Extract features from db (sql extractors are fused into one query, the rest run concurrently,
+    # results are cached on disk between runs).
+    # MATERIALIZE=1 keeps features in db tables instead, only new heats are computed on each run
+    store = FeatureStore(conn) if os.environ.get("MATERIALIZE") else None
+    # TIMESERIES=1 adds windowed gas/produv features computed over the memory-mapped time series store
+    timeseries = TimeSeriesStore("../data/timeseries") if os.environ.get("TIMESERIES") else None
+    fe = (
+        AllFeaturesExtractor(conn, cache=FeatureCache("../data/cache"), n_jobs=5, fused=True, store=store,
+                             timeseries=timeseries)
+        .fit(schema_path="../data/cache/schema.json")
+    )
 
     df = fe.transform(mode="train")
+    if os.environ.get("PRUNE"):
+        # PRUNE=share keeps the cheapest features covering this share of total importance,
+        # extractor queries (and test/inference extraction) compute only the kept columns
+        pruner = FeaturePruner({'verbose': 0}, keep_importance=float(os.environ["PRUNE"])).fit(fe, df)
+        pruner.print_summary()
+        pruner.transform(fe)
     print("NUmber of feature columns:", len(fe.feature_columns))
 
     cv = KFold(n_splits=5, random_state=42, shuffle=True)
 
-    model = LightAutoMLModel(automl_params={
-        'timeout': 60 * 10,
-        'general_params': {
-            'use_algos': [['cb_tuned']]
-        },
-        'selection_params': {
-            'mode': 2
-        }
-    })
+    if os.environ.get("TUNE"):
+        # TUNE=seconds replaces LightAutoML with BaselineModel, whose catboost parameters are searched
+        # per target by successive halving within the given time budget
+        cat_features = list(df[fe.feature_columns].select_dtypes(include=['category', 'object']).columns)
+        search = SuccessiveHalvingSearch(
+            {'verbose': 0, 'cat_features': cat_features},
+            cv=cv,
+            time_budget=float(os.environ["TUNE"])
+        ).fit(df[fe.feature_columns], df[fe.target_columns])
+        model = search.best_estimator()
+    else:
+        model = LightAutoMLModel(automl_params={
+            'timeout': 60 * 10,
+            'general_params': {
+                'use_algos': [['cb_tuned']]
+            },
+            'selection_params': {
+                'mode': 2
+            }
+        })
 
-    cv_score = cross_val_score(
+    # folds and both targets are fitted concurrently in worker processes,
+    # CPU_BUDGET cores and MEMORY_BUDGET Gb are split evenly between running jobs;
+    # out-of-fold predictions and fold models are kept
+    cv_result = cross_validate_parallel(
         estimator=model,
         X=df[fe.feature_columns],
         y=df[fe.target_columns],
-        scoring=sklearn_scorer,
-        cv=cv
+        cv=cv,
+        cpu_budget=int(os.environ.get("CPU_BUDGET", os.cpu_count())),
+        memory_budget=float(os.environ.get("MEMORY_BUDGET", 50)),
+        keep_models=True
     )
+    cv_score = cv_result.fold_scores()
 
-    final_model = model.fit(
-        X=df[fe.feature_columns],
-        y=df[fe.target_columns],
-    )
+    filename = os.environ.get("SUB_NAME")
+    cv_result.save(f"../data/cv/{filename}")
 
     submission_df = fe.transform(mode='test')
-    predictions = final_model.predict(submission_df[fe.feature_columns])
+    if os.environ.get("REFIT"):
+        final_model = model.fit(
+            X=df[fe.feature_columns],
+            y=df[fe.target_columns],
+        )
+        predictions = final_model.predict(submission_df[fe.feature_columns])
+    else:
+        # average of fold models, no final refit on the whole train
+        final_model = cv_result
+        predictions = cv_result.predict(submission_df[fe.feature_columns])
+
+    # model and extractor schema for `python -m evraz.inference ../data/artifacts/{SUB_NAME}`
+    save_artifact(f"../data/artifacts/{filename}", final_model, fe, metadata={
+        'cv_score': cv_score.tolist(),
+        'oof_score': cv_result.score()
+    })
 
     submission = (
         submission_df[['NPLV']]
@@ -56,10 +116,13 @@ def main():
         .sort_values("NPLV")
     )
 
-    filename = os.environ.get("SUB_NAME")
     submission.to_csv(f"../data/submissions/{filename}.csv", index=False)
 
     print("CV score:", cv_score)
+    print("OOF score:", cv_result.score())
+
+    if os.environ.get("TRACE"):
+        get_tracer().save(os.environ["TRACE"]).print_summary()
 
 
 if __name__ == "__main__":